@@ -0,0 +1,133 @@
+#
+# Slasti -- Cold start of the WSGI application
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: python bench/coldstart.py [-n marks] [-r reps] [-w workdir]
+#
+# Measures what a daemon that just started goes through, in a fresh Python
+# for every run: importing the application of slasti.wsgi, the first
+# request, which is the front page, and the second one, which is the same
+# page again, both with and without preload() of slasti/wsgi.py. Reported
+# are the medians of the times, the time of the preload itself, and the
+# number of modules loaded before the first request.
+#
+
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run
+from run import AppError
+
+TAG = "coldstart"
+
+MARKS = 10000
+REPS = 5
+
+# What the fresh Python runs, with the path to the top directory, the user
+# configuration, and whether to preload.
+CHILD = """
+import json, sys, time
+t0 = time.time()
+sys.path.insert(0, sys.argv[1])
+sys.path.insert(0, sys.argv[1] + "/bench")
+import run
+application = run.load_wsgi().application
+t1 = time.time()
+if sys.argv[3] == "1":
+    import slasti.wsgi
+    slasti.wsgi.preload(sys.argv[2])
+t2 = time.time()
+modules = len(sys.modules)
+client = run.Client(application, sys.argv[2])
+status, headers = client.call("GET", "/%s/" % run.USER)
+t3 = time.time()
+client.call("GET", "/%s/" % run.USER)
+t4 = time.time()
+json.dump({"status": status, "import": t1 - t0, "preload": t2 - t1,
+           "first": t3 - t2, "second": t4 - t3, "modules": modules},
+          sys.stdout)
+"""
+
+KEYS = ("import", "preload", "first", "second")
+
+
+def child(userconf, preload):
+    out = subprocess.check_output([sys.executable, "-c", CHILD, run.TOPDIR,
+                                   userconf, "1" if preload else "0"])
+    result = json.loads(out.decode('utf-8'))
+    if result["status"] != 200:
+        raise AppError("front page: status %d" % result["status"])
+    return result
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+# Returns {"cold": {...}, "preload": {...}} with the medians.
+def measure(dirname, reps=REPS):
+    userconf = run.write_userconf(dirname)
+    # The first run ever builds the index file, which a restarted daemon
+    # finds already there, so it is not counted.
+    child(userconf, False)
+    results = {}
+    for (name, preload) in (("cold", False), ("preload", True)):
+        runs = [child(userconf, preload) for n in range(reps)]
+        results[name] = dict((k, median([r[k] for r in runs]))
+                             for k in KEYS + ("modules",))
+    return results
+
+def report(results, out):
+    out.write("%-8s %10s %10s %10s %10s %8s\n" %
+              ("", "import ms", "preload ms", "first ms", "second ms",
+               "modules"))
+    for name in ("cold", "preload"):
+        r = results[name]
+        out.write("%-8s %10.2f %10.2f %10.2f %10.2f %8d\n" %
+                  (name, r["import"] * 1000, r["preload"] * 1000,
+                   r["first"] * 1000, r["second"] * 1000, r["modules"]))
+
+
+def Usage():
+    sys.stderr.write("Usage: " + TAG + " [-n marks] [-r reps] [-w workdir]\n")
+    sys.exit(2)
+
+def main(args):
+    nmarks = MARKS
+    reps = REPS
+    workdir = os.path.join(run.TOPDIR, "bench", "work")
+    while args:
+        if len(args) < 2:
+            Usage()
+        opt, val = args[0], args[1]
+        args = args[2:]
+        try:
+            if opt == '-n':
+                nmarks = int(val)
+            elif opt == '-r':
+                reps = int(val)
+            elif opt == '-w':
+                workdir = val
+            else:
+                Usage()
+        except ValueError:
+            Usage()
+    if reps < 1:
+        Usage()
+    if not os.path.isdir(workdir):
+        os.mkdir(workdir)
+
+    dirname = run.corpus_dir(workdir, nmarks, run.SEED)
+    report(measure(dirname, reps), sys.stdout)
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except AppError as e:
+        sys.stderr.write(TAG + ": " + str(e) + "\n")
+        sys.exit(1)
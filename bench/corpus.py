@@ -0,0 +1,158 @@
+#
+# Slasti -- Synthetic bookmark corpus for benchmarks
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: python bench/corpus.py [-s seed] target_dir nmarks
+#
+# Builds a tagbase of nmarks marks through TagBase.add1, so the files are
+# exactly what the application writes. Tags follow a Zipf distribution,
+# like real ones do: a few are on a large fraction of marks, and most are
+# on a handful. Titles, notes, and URLs have lengths like those found in
+# a real base of some 15 years. The same seed builds the same base.
+#
+# Since add1 rewrites the tag files of the mark, building is quadratic in
+# the size of the popular tags. A base of 100,000 marks takes a while, and
+# 1,000,000 takes hours, so bench/run.py keeps the bases it builds.
+#
+
+import bisect
+import os
+import random
+import string
+import sys
+
+# Run from the top of the tree or from anywhere else.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import slasti
+from slasti import AppError
+
+TAG = "corpus"
+
+# The base starts in 2009, a mark every 3 hours or so on the average.
+TIME0 = 1230768000
+TIME_STEP = 3 * 3600
+
+TAGS_MAX = 5000
+ZIPF_S = 1.1
+HOSTS = 2000
+NOTE_RATE = 0.4
+
+
+def make_word(rnd):
+    n = min(max(int(rnd.expovariate(1.0 / 6)), 1), 14)
+    return "".join(rnd.choice(string.ascii_lowercase) for i in range(n))
+
+def make_text(rnd, mean_len):
+    length = max(int(rnd.lognormvariate(0, 0.6) * mean_len), 3)
+    words = []
+    total = 0
+    while total < length:
+        w = make_word(rnd)
+        words.append(w)
+        total += len(w) + 1
+    text = " ".join(words)
+    return text[0].upper() + text[1:]
+
+class Zipf(object):
+    def __init__(self, rnd, n, s=ZIPF_S):
+        self.rnd = rnd
+        self.cum = []
+        total = 0.0
+        for k in range(1, n + 1):
+            total += 1.0 / (k ** s)
+            self.cum.append(total)
+        self.total = total
+
+    # An index from 0 to n-1, 0 being the most likely.
+    def sample(self):
+        return bisect.bisect_left(self.cum, self.rnd.random() * self.total)
+
+
+class Corpus(object):
+    def __init__(self, nmarks, seed=1):
+        self.nmarks = nmarks
+        self.rnd = random.Random(seed)
+        ntags = min(max(nmarks // 10, 20), TAGS_MAX)
+        self.tags = [make_word(self.rnd) + str(i) for i in range(ntags)]
+        self.tagz = Zipf(self.rnd, ntags)
+        self.hosts = ["www.%s.%s" % (make_word(self.rnd),
+                                     self.rnd.choice(("com", "org", "net")))
+                      for i in range(HOSTS)]
+        self.hostz = Zipf(self.rnd, HOSTS)
+
+    # The marks as (stamp, title, url, note, tags), oldest first.
+    def __iter__(self):
+        rnd = self.rnd
+        stamp = TIME0
+        for n in range(self.nmarks):
+            # Sometimes two marks in the same second, to exercise the fix.
+            if rnd.random() > 0.02:
+                stamp += int(rnd.expovariate(1.0 / TIME_STEP)) + 1
+            title = make_text(rnd, 50)
+            url = "https://%s/%s/%s" % (
+                self.hosts[self.hostz.sample()], make_word(rnd),
+                "-".join(make_word(rnd) for i in range(rnd.randint(1, 6))))
+            if rnd.random() < NOTE_RATE:
+                note = make_text(rnd, 80)
+            else:
+                note = ""
+            tags = []
+            for i in range(rnd.randint(1, 5)):
+                tag = self.tags[self.tagz.sample()]
+                if tag not in tags:
+                    tags.append(tag)
+            yield (stamp, title, url, note, tags)
+
+    # The most popular tag, for the benchmarks of tag pages.
+    def top_tag(self):
+        return self.tags[0]
+
+
+def build(dirname, nmarks, seed=1, progress=None):
+    base = slasti.tagbase.TagBase(dirname)
+    base.open()
+    n = 0
+    for (stamp, title, url, note, tags) in Corpus(nmarks, seed):
+        if base.add1(stamp, title, url, note, tags) < 0:
+            raise AppError("Out of fix: %d" % stamp)
+        n += 1
+        if progress and n % 10000 == 0:
+            progress(n)
+    base.close()
+
+
+def Usage():
+    sys.stderr.write("Usage: " + TAG + " [-s seed] target_dir nmarks\n")
+    sys.exit(2)
+
+def main(args):
+    seed = 1
+    if len(args) >= 2 and args[0] == '-s':
+        try:
+            seed = int(args[1])
+        except ValueError:
+            Usage()
+        args = args[2:]
+    if len(args) != 2:
+        Usage()
+    try:
+        nmarks = int(args[1])
+    except ValueError:
+        Usage()
+    if not os.path.isdir(args[0]):
+        os.mkdir(args[0])
+    def progress(n):
+        sys.stdout.write("%s: %d\n" % (TAG, n))
+        sys.stdout.flush()
+    build(args[0], nmarks, seed, progress)
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except AppError as e:
+        sys.stderr.write(TAG + ": " + str(e) + "\n")
+        sys.exit(1)
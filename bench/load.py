@@ -0,0 +1,333 @@
+#
+# Slasti -- Load driver for the WSGI application
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: python bench/load.py [-n marks] [-p processes] [-c threads]
+#                             [-r requests] [-m browse=70,tag=20,edit=10]
+#                             [-s seed] [-w workdir]
+#
+# Runs the application of slasti.wsgi in-process, from threads in one or
+# more processes, the way mod_wsgi runs it (processes=P threads=C), over
+# a copy of a synthetic base from bench/corpus.py. Every thread makes its
+# own requests, r of them, drawn from the mix:
+#
+#  browse -- anonymous: the front page, a page deep in the base, a mark
+#  tag    -- anonymous: a tag's first page and the next pages of it
+#  edit   -- logged in: change the note of a mark, or add a mark and
+#            delete it again
+#
+# The requests of a thread depend only on the seed and the number of the
+# thread, so a run can be repeated exactly, e.g. before and after a change.
+# Reported are the throughput, and the latency and errors by kind.
+#
+
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import traceback
+
+from six.moves.urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run
+from run import AppError, slasti
+
+TAG = "load"
+
+MIX = {"browse": 70, "tag": 20, "edit": 10}
+MARKS = 10000
+PROCESSES = 1
+THREADS = 6
+REQUESTS = 200
+SEED = 1
+# How many pages down the tag paging goes.
+TAG_DEPTH = 3
+
+
+class Workload(object):
+    def __init__(self, dirname):
+        names = sorted(os.listdir(os.path.join(dirname, "marks")))
+        self.keys = []
+        for name in names:
+            p = name.split(".")
+            self.keys.append("%d.%s" % (int(p[0]),
+                                        p[1] if len(p) > 1 else "00"))
+        tagdir = os.path.join(dirname, "tags")
+        names = sorted(os.listdir(tagdir))
+        self.tags = slasti.tagbase.fs_decode_list(names)
+        # Popular tags get paged more, like in real life.
+        self.tagsizes = [os.path.getsize(os.path.join(tagdir, name))
+                         for name in names]
+
+    # The requests of one thread, each a list of (method, path, body),
+    # since some kinds are several requests in a row.
+    def requests(self, mix, seed, thread, count):
+        rnd = random.Random("%d.%d" % (seed, thread))
+        kinds = sorted(mix.keys())
+        weights = [mix[k] for k in kinds]
+        for n in range(count):
+            kind = rnd.choices(kinds, weights)[0]
+            if kind == "browse":
+                r = rnd.random()
+                if r < 0.3:
+                    reqs = [("GET", "", None)]
+                elif r < 0.6:
+                    reqs = [("GET", "page." + rnd.choice(self.keys), None)]
+                else:
+                    reqs = [("GET", "mark." + rnd.choice(self.keys), None)]
+            elif kind == "tag":
+                tag = rnd.choices(self.tags, self.tagsizes)[0]
+                reqs = [("GET", tag.encode('utf-8').decode('latin-1') + "/",
+                         None)]
+                # The next pages are found by following the links.
+                # The WSGI path is bytes in a str, not quoted.
+                reqs += [("NEXT", None, None)] * rnd.randint(0, TAG_DEPTH)
+            elif kind == "edit":
+                if rnd.random() < 0.5:
+                    key = rnd.choice(self.keys)
+                    reqs = [("EDIT", "mark." + key,
+                             "load %d.%d.%d" % (seed, thread, n))]
+                else:
+                    reqs = [("POST", "edit",
+                             "title=Load+%d&href=https%%3A%%2F%%2Fexample"
+                             ".com%%2F%d.%d&tags=load&extra=" %
+                             (n, thread, n)),
+                            ("DELETE", None, None)]
+            yield (kind, reqs)
+
+
+class Worker(object):
+    def __init__(self, application, userconf, dirname, login):
+        self.client = run.Client(application, userconf)
+        if login:
+            self.client.login()
+        self.base = slasti.tagbase.TagBase(dirname)
+        self.base.open()
+        # results: (kind, seconds, ok)
+        self.results = []
+
+    def path(self, p):
+        return "/%s/%s" % (run.USER, p)
+
+    # Do one request of a kind, following up as it says.
+    def do(self, reqs):
+        last = None
+        for (method, path, body) in reqs:
+            if method == "NEXT":
+                # We do not parse the page for the link to the next one,
+                # but ask the base like the page did.
+                if last is None:
+                    break
+                method, path = "GET", last
+            elif method == "EDIT":
+                (stamp0, stamp1) = slasti.main.findmark(path[5:])
+                mark = self.base.lookup(stamp0, stamp1)
+                if mark is None:
+                    return False
+                body = "title=%s&href=%s&tags=%s&extra=%s" % (
+                    quote(mark.title.encode('utf-8')),
+                    quote(mark.url.encode('utf-8')),
+                    quote(" ".join(mark.tags).encode('utf-8')),
+                    quote(body))
+                method = "POST"
+            elif method == "DELETE":
+                key = last.rsplit("/", 1)[1][len("mark."):]
+                method, path, body = "POST", "delete", "mark=" + key
+            status, headers = self.client.call(method, self.path(path), body)
+            if status >= 400:
+                return False
+            last = headers.get("location") or self.next_page(path)
+        return True
+
+    # The first key of the next page of a tag, like page_next() finds it.
+    def next_page(self, path):
+        p = path.split("/", 1)
+        if len(p) != 2:
+            return None
+        tag = p[0].encode('latin-1').decode('utf-8')
+        if p[1] == "":
+            mark = self.base.tagfirst(tag)
+        else:
+            (stamp0, stamp1) = slasti.main.findmark(p[1][5:])
+            mark = self.base.taglookup(tag, stamp0, stamp1)
+        if mark is None:
+            return None
+        mark = slasti.main.page_next(mark)
+        if mark is None:
+            return None
+        (stamp0, stamp1) = mark.key()
+        return "%s/page.%d.%02d" % (p[0], stamp0, stamp1)
+
+    def run(self, workload, mix, seed, thread, count):
+        for (kind, reqs) in workload.requests(mix, seed, thread, count):
+            t0 = time.time()
+            try:
+                ok = self.do(reqs)
+            except Exception:
+                ok = False
+            self.results.append((kind, time.time() - t0, ok))
+
+
+# One process: start the threads and collect their results.
+def process_main(dirname, userconf, mix, seed, first_thread, nthreads,
+                 count):
+    application = run.load_wsgi().application
+    workload = Workload(dirname)
+    login = "edit" in mix and mix["edit"] > 0
+    workers = [Worker(application, userconf, dirname, login)
+               for n in range(nthreads)]
+    threads = [threading.Thread(target=workers[n].run,
+                                args=(workload, mix, seed,
+                                      first_thread + n, count))
+               for n in range(nthreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results = []
+    for w in workers:
+        results += w.results
+    return results
+
+# The parent waits for a result from every child, so a child must give
+# something even if it fails.
+def _process_put(queue, args):
+    results = []
+    try:
+        results = process_main(*args)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        queue.put(results)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def summary(results, wall):
+    kinds = sorted(set(r[0] for r in results))
+    total = {"requests": len(results),
+             "errors": len([r for r in results if not r[2]]),
+             "wall": wall,
+             "throughput": len(results) / wall if wall > 0 else 0.0,
+             "kinds": {}}
+    for kind in kinds:
+        times = [r[1] for r in results if r[0] == kind]
+        errors = len([r for r in results if r[0] == kind and not r[2]])
+        total["kinds"][kind] = {"count": len(times), "errors": errors,
+                                "p50": percentile(times, 0.50),
+                                "p99": percentile(times, 0.99)}
+    return total
+
+def report(total, out):
+    out.write("%d requests in %.2f s, %.1f/s, %d errors (%.2f%%)\n" %
+              (total["requests"], total["wall"], total["throughput"],
+               total["errors"],
+               100.0 * total["errors"] / max(total["requests"], 1)))
+    out.write("%-8s %8s %8s %10s %10s\n" %
+              ("kind", "count", "errors", "p50 ms", "p99 ms"))
+    for kind in sorted(total["kinds"].keys()):
+        k = total["kinds"][kind]
+        out.write("%-8s %8d %8d %10.2f %10.2f\n" %
+                  (kind, k["count"], k["errors"], k["p50"] * 1000,
+                   k["p99"] * 1000))
+
+# Run the load against a copy of the base in dirname.
+def load(dirname, mix=MIX, processes=PROCESSES, threads=THREADS,
+         count=REQUESTS, seed=SEED):
+    rundir = dirname + ".load"
+    shutil.rmtree(rundir, True)
+    shutil.copytree(dirname, rundir)
+    try:
+        userconf = run.write_userconf(rundir)
+        t0 = time.time()
+        if processes <= 1:
+            results = process_main(rundir, userconf, mix, seed, 0, threads,
+                                   count)
+        else:
+            # Forked, so that the children do not need to find this module
+            # by name, in case it was not loaded as a module.
+            mp = multiprocessing.get_context("fork")
+            queue = mp.Queue()
+            procs = [mp.Process(target=_process_put,
+                                args=(queue, (rundir, userconf, mix, seed,
+                                              p * threads, threads, count)))
+                     for p in range(processes)]
+            for proc in procs:
+                proc.start()
+            results = []
+            for proc in procs:
+                results += queue.get()
+            for proc in procs:
+                proc.join()
+        wall = time.time() - t0
+    finally:
+        shutil.rmtree(rundir, True)
+    return summary(results, wall)
+
+
+def Usage():
+    sys.stderr.write("Usage: " + TAG + " [-n marks] [-p processes]"
+                     " [-c threads] [-r requests] [-m kind=weight,...]"
+                     " [-s seed] [-w workdir]\n")
+    sys.exit(2)
+
+def main(args):
+    nmarks = MARKS
+    processes = PROCESSES
+    threads = THREADS
+    count = REQUESTS
+    mix = MIX
+    seed = SEED
+    workdir = os.path.join(run.TOPDIR, "bench", "work")
+    while args:
+        if len(args) < 2:
+            Usage()
+        opt, val = args[0], args[1]
+        args = args[2:]
+        try:
+            if opt == '-n':
+                nmarks = int(val)
+            elif opt == '-p':
+                processes = int(val)
+            elif opt == '-c':
+                threads = int(val)
+            elif opt == '-r':
+                count = int(val)
+            elif opt == '-s':
+                seed = int(val)
+            elif opt == '-w':
+                workdir = val
+            elif opt == '-m':
+                mix = {}
+                for kw in val.split(','):
+                    (kind, weight) = kw.split('=')
+                    if kind not in MIX:
+                        Usage()
+                    mix[kind] = int(weight)
+            else:
+                Usage()
+        except ValueError:
+            Usage()
+    if not os.path.isdir(workdir):
+        os.mkdir(workdir)
+
+    dirname = run.corpus_dir(workdir, nmarks, run.SEED)
+    report(load(dirname, mix, processes, threads, count, seed), sys.stdout)
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except AppError as e:
+        sys.stderr.write(TAG + ": " + str(e) + "\n")
+        sys.exit(1)
@@ -0,0 +1,329 @@
+#
+# Slasti -- Benchmarks of the application over synthetic bases
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: python bench/run.py [-n 1000,10000] [-r reps] [-w workdir]
+#                            [-o results.json] [-b baseline.json] [-t 0.25]
+#
+# For every size, builds a base with bench/corpus.py (or reuses one built
+# before in the workdir), then calls the WSGI application of slasti.wsgi
+# in-process for each operation, reps times. Reported are the median and
+# the minimum wall time, the files that TagBase opened and directories it
+# listed (those are most of our system calls, and unlike time they do not
+# depend on the machine), and the peak of memory allocated by Python, as
+# measured by tracemalloc in a separate run.
+#
+# With -b, results are compared to a baseline saved earlier with -o,
+# and the exit code is 1 if any operation got slower by more than the
+# tolerance, or opens more files, or takes more memory by the tolerance.
+# Timings are only comparable on the same machine, of course.
+#
+
+import gc
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+
+TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, TOPDIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import slasti
+from slasti import AppError
+import corpus
+
+TAG = "bench"
+
+SIZES = (1000, 10000)
+REPS = 5
+TOLERANCE = 0.25
+SEED = 1
+USER = "bench"
+# user_password = "PassWord"
+SALT = "abcdef"
+PASS = "8bb4b4f91dcfafbfea438ae0132bbd20"
+
+OPS = ("front", "deep", "mark", "tag", "tags", "export", "add", "edit",
+       "delete")
+
+
+def load_wsgi():
+    path = os.path.join(TOPDIR, "slasti.wsgi")
+    loader = importlib.machinery.SourceFileLoader("slasti_wsgi", path)
+    spec = importlib.util.spec_from_loader("slasti_wsgi", loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+def corpus_dir(workdir, nmarks, seed):
+    dirname = os.path.join(workdir, "corpus-%d-s%d" % (nmarks, seed))
+    if os.path.exists(dirname):
+        return dirname
+    tmpname = dirname + ".tmp"
+    if os.path.exists(tmpname):
+        shutil.rmtree(tmpname)
+    os.mkdir(tmpname)
+    t0 = time.time()
+    def progress(n):
+        sys.stderr.write("%s: building %d: %d\n" % (TAG, nmarks, n))
+    corpus.build(tmpname, nmarks, seed, progress)
+    sys.stderr.write("%s: built %d marks in %.1f s\n" %
+                     (TAG, nmarks, time.time() - t0))
+    os.rename(tmpname, dirname)
+    return dirname
+
+
+class Client(object):
+    def __init__(self, application, userconf):
+        self.application = application
+        self.userconf = userconf
+        self.cookie = None
+
+    def call(self, method, path, body=None):
+        if body is not None:
+            body = body.encode('utf-8')
+        if '?' in path:
+            path, query = path.split('?', 1)
+        else:
+            query = ''
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'HTTP_HOST': 'localhost',
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body or b''),
+            'slasti.userconf': self.userconf,
+        }
+        if body is not None:
+            environ['CONTENT_LENGTH'] = str(len(body))
+            environ['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+        if self.cookie:
+            environ['HTTP_COOKIE'] = self.cookie
+        result = {}
+        def start_response(status, headers):
+            result['status'] = int(status.split()[0])
+            result['headers'] = dict((k.lower(), v) for (k, v) in headers)
+        output = self.application(environ, start_response)
+        for chunk in output:
+            pass
+        if hasattr(output, 'close'):
+            output.close()
+        return (result['status'], result['headers'])
+
+    def login(self):
+        status, headers = self.call('POST', '/%s/login' % USER,
+                                    'password=PassWord&OK=Enter')
+        if status != 303:
+            raise AppError("login failed: %d" % status)
+        self.cookie = headers['set-cookie'].split(';')[0]
+
+
+# The configuration of the one user whose base is in dirname.
+def write_userconf(dirname):
+    userconf = os.path.join(dirname, os.pardir,
+                            "users-%s.conf" % os.path.basename(dirname))
+    with open(userconf, "w") as f:
+        json.dump([{"name": USER, "type": "fs", "root": dirname,
+                    "salt": SALT, "pass": PASS}], f)
+    return userconf
+
+
+class Bench(object):
+    def __init__(self, dirname, nmarks, seed):
+        self.dirname = dirname
+        userconf = write_userconf(dirname)
+        self.client = Client(load_wsgi().application, userconf)
+        self.client.login()
+
+        names = sorted(os.listdir(os.path.join(dirname, "marks")))
+        self.deep = names[len(names) // 2].split(".")
+        if len(self.deep) == 1:
+            self.deep.append("00")
+        self.tag = corpus.Corpus(nmarks, seed).top_tag()
+        # The marks added, to be deleted later.
+        self.added = []
+        self.nadd = 0
+
+    def path(self, p):
+        return "/%s/%s" % (USER, p)
+
+    def op(self, name):
+        c = self.client
+        deep = "%s.%s" % (int(self.deep[0]), self.deep[1])
+        if name == "front":
+            return c.call('GET', self.path(""))
+        if name == "deep":
+            return c.call('GET', self.path("page." + deep))
+        if name == "mark":
+            return c.call('GET', self.path("mark." + deep))
+        if name == "tag":
+            return c.call('GET', self.path(self.tag + "/"))
+        if name == "tags":
+            return c.call('GET', self.path("tags"))
+        if name == "export":
+            # Without the snapshot, or we only measure sending a file.
+            shutil.rmtree(os.path.join(self.dirname, "cache"), True)
+            return c.call('GET', self.path("export.xml"))
+        if name == "add":
+            self.nadd += 1
+            status, headers = c.call('POST', self.path("edit"),
+                'title=Bench+%d&href=https%%3A%%2F%%2Fexample.com%%2F%d'
+                '&tags=bench+%s&extra=' % (self.nadd, self.nadd, self.tag))
+            self.added.append(headers['location'].rsplit('/', 1)[1])
+            return (status, headers)
+        if name == "edit":
+            return c.call('POST', self.path("mark." + deep),
+                'title=Edited&href=https%3A%2F%2Fexample.com%2Fedited'
+                '&tags=bench&extra=note')
+        if name == "delete":
+            key = self.added.pop(0)[len("mark."):]
+            return c.call('POST', self.path("delete"), 'mark=' + key)
+        raise AppError("Unknown operation: " + name)
+
+    def files(self):
+        counters = slasti.stats.get_stats().snapshot()["counters"]
+        return counters.get("files.open", 0) + \
+               counters.get("files.listdir", 0)
+
+    def measure(self, name, reps):
+        times = []
+        files = None
+        for n in range(reps):
+            gc.collect()
+            f0 = self.files()
+            t0 = time.time()
+            status, headers = self.op(name)
+            t1 = time.time()
+            if status >= 400:
+                raise AppError("%s: status %d" % (name, status))
+            times.append(t1 - t0)
+            files = self.files() - f0
+        times.sort()
+
+        # The memory goes separately, tracemalloc slows everything down.
+        tracemalloc.start()
+        self.op(name)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return {"median": times[len(times) // 2], "min": times[0],
+                "files": files, "peak": peak}
+
+
+def compare(results, baseline, tolerance):
+    bad = []
+    for size in sorted(results.keys(), key=int):
+        if size not in baseline:
+            continue
+        for name in OPS:
+            r = results[size].get(name)
+            b = baseline[size].get(name)
+            if r is None or b is None:
+                continue
+            if r["median"] > b["median"] * (1 + tolerance):
+                bad.append("%s %s: time %.4f was %.4f" %
+                           (size, name, r["median"], b["median"]))
+            if r["files"] > b["files"]:
+                bad.append("%s %s: files %d was %d" %
+                           (size, name, r["files"], b["files"]))
+            if r["peak"] > b["peak"] * (1 + tolerance):
+                bad.append("%s %s: peak %d was %d" %
+                           (size, name, r["peak"], b["peak"]))
+    return bad
+
+def report(results, out):
+    out.write("%8s %-8s %10s %10s %8s %10s\n" %
+              ("marks", "op", "median ms", "min ms", "files", "peak KB"))
+    for size in sorted(results.keys(), key=int):
+        for name in OPS:
+            r = results[size][name]
+            out.write("%8s %-8s %10.2f %10.2f %8d %10d\n" %
+                      (size, name, r["median"] * 1000, r["min"] * 1000,
+                       r["files"], r["peak"] // 1024))
+
+# The operations change the base, so every run gets a fresh copy.
+def run(sizes, reps, workdir, seed=SEED, ops=OPS):
+    results = {}
+    for nmarks in sizes:
+        dirname = corpus_dir(workdir, nmarks, seed)
+        rundir = dirname + ".run"
+        shutil.rmtree(rundir, True)
+        shutil.copytree(dirname, rundir)
+        try:
+            bench = Bench(rundir, nmarks, seed)
+            results[str(nmarks)] = dict((name, bench.measure(name, reps))
+                                        for name in ops)
+        finally:
+            shutil.rmtree(rundir, True)
+    return results
+
+
+def Usage():
+    sys.stderr.write("Usage: " + TAG + " [-n size,size...] [-r reps]"
+                     " [-w workdir] [-o results.json]"
+                     " [-b baseline.json] [-t tolerance]\n")
+    sys.exit(2)
+
+def main(args):
+    sizes = SIZES
+    reps = REPS
+    workdir = os.path.join(TOPDIR, "bench", "work")
+    output = None
+    baseline = None
+    tolerance = TOLERANCE
+    while args:
+        if len(args) < 2:
+            Usage()
+        opt, val = args[0], args[1]
+        args = args[2:]
+        try:
+            if opt == '-n':
+                sizes = [int(s) for s in val.split(',')]
+            elif opt == '-r':
+                reps = int(val)
+            elif opt == '-w':
+                workdir = val
+            elif opt == '-o':
+                output = val
+            elif opt == '-b':
+                baseline = val
+            elif opt == '-t':
+                tolerance = float(val)
+            else:
+                Usage()
+        except ValueError:
+            Usage()
+    if reps < 1:
+        Usage()
+    if not os.path.isdir(workdir):
+        os.mkdir(workdir)
+
+    results = run(sizes, reps, workdir)
+    report(results, sys.stdout)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if baseline:
+        with open(baseline) as f:
+            bad = compare(results, json.load(f), tolerance)
+        for line in bad:
+            sys.stdout.write("REGRESSION %s\n" % line)
+        if bad:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except AppError as e:
+        sys.stderr.write(TAG + ": " + str(e) + "\n")
+        sys.exit(1)
@@ -21,6 +21,8 @@ class AppLoginError(Exception):
     pass
 class App404Error(Exception):
     pass
+class App503Error(Exception):
+    pass
 class AppGetError(Exception):
     pass
 class AppGetHeadError(Exception):
@@ -32,6 +34,13 @@ class AppGetPostError(Exception):
 class AppGetHeadPostError(Exception):
     pass
 
+# Raised by the view of fetchtitle instead of waiting for the title, if the
+# server runs the fetch itself (slasti/asgi.py). Not an error.
+class TitlePending(Exception):
+    def __init__(self, url):
+        Exception.__init__(self, url)
+        self.url = url
+
 
 def safestr(u):
     if isinstance(u, six.text_type):
@@ -124,7 +133,7 @@ def ims_make_ts(ims_hdr):
 
 class Context:
     def __init__(self, pfx, user, base, method, scheme, netloc, path,
-                 query, pinput, coos, ims_ts):
+                 query, pinput, coos, ims_ts, headers=None):
         # prefix: Path where the application is mounted in WSGI or empty string.
         self.prefix = pfx
         # user: User entry.
@@ -149,10 +158,16 @@ class Context:
         self.cookies = coos
         # ims_ts: If-Modified-Since converted to time.time()
         self.ims_ts = ims_ts
+        # _headers: Other request headers that views care about, such as
+        #           If-None-Match or Range. Use get_header() to access.
+        self._headers = headers or {}
         # flogin: Login flag, to be derived from self.user and self.cookies.
         self.flogin = 0
         # j2env: the jinja2.Environment
         self.j2env = None
+        # defer_fetch: Raise TitlePending instead of waiting for a title,
+        #              because the server runs the fetch itself.
+        self.defer_fetch = False
 
         self._query_args = None
         self._pinput_args = None
@@ -216,6 +231,9 @@ class Context:
 
         return qdic
 
+    def get_header(self, name):
+        return self._headers.get(name, None)
+
     def get_query_arg(self, argname):
         if self._query_args is None:
             self._query_args = self._parse_args(self._query)
@@ -227,4 +245,9 @@ class Context:
         return self._pinput_args.get(argname, None)
 
 
-import slasti.main, slasti.tagbase
+import slasti.stats, slasti.trace
+import slasti.main, slasti.tagbase, slasti.export, slasti.backfill
+import slasti.profiling, slasti.indexfile, slasti.watch
+# Not slasti.fetch, slasti.follow and slasti.render, which bring in jinja2,
+# http.client and ssl, and are not needed to serve pages. Import them where
+# they are used.
@@ -0,0 +1,214 @@
+#
+# Slasti -- The ASGI application
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: SLASTI_USERCONF=/etc/slasti-users.conf uvicorn slasti.asgi:application
+#
+# The requests go through the WSGI application of slasti/wsgi.py, so the
+# routing and everything after it is the same. Since TagBase reads files,
+# the application runs in a pool of ASGI_THREADS threads, and so does the
+# walk of its output, which reads the marks while the page is generated.
+# The event loop only moves bytes, so slow clients cost no threads.
+# Every chunk may come from another thread, so what slasti.stats and
+# slasti.trace keep of the request in the thread goes along with it.
+#
+# The one place where a request waits for long is fetchtitle. There, the
+# view raises TitlePending instead of waiting (we ask for that with
+# slasti.defer_fetch), and we run slasti.fetch.fetch_title as a step of its
+# own, with the cache, limits and deadline of slasti/fetch.py. The fetch
+# itself is still blocking I/O in the threads of the fetch pool, and the
+# step waits for it in a thread of ASGI_FETCH_THREADS, which are not the
+# ones of the pages, so that fetches never hold up pages.
+# This needs Python 3, unlike the rest of Slasti.
+#
+
+import asyncio
+import io
+import os
+import sys
+
+from concurrent import futures
+
+import slasti
+import slasti.fetch
+import slasti.wsgi
+from slasti import AppError, App400Error, App503Error
+
+ASGI_THREADS = 16
+# Any more fetches than that get 503 from the fetch pool anyway.
+ASGI_FETCH_THREADS = slasti.fetch.FETCH_WORKERS + slasti.fetch.FETCH_QUEUE
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+def make_environ(scope, body):
+    path = scope['path']
+    root_path = scope.get('root_path', '')
+    # Servers differ in whether the path includes the root path.
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        # The WSGI way: bytes of the URL in a str.
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'slasti.defer_fetch': True,
+    }
+    server = scope.get('server')
+    if server:
+        environ['SERVER_NAME'] = server[0]
+        environ['SERVER_PORT'] = str(server[1])
+    for (name, value) in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        if key in environ:
+            sep = '; ' if key == 'HTTP_COOKIE' else ','
+            value = environ[key] + sep + value
+        environ[key] = value
+    if 'HTTP_HOST' not in environ:
+        if server:
+            environ['HTTP_HOST'] = "%s:%d" % (server[0], server[1])
+        else:
+            environ['HTTP_HOST'] = 'localhost'
+    return environ
+
+
+class Response(object):
+    def __init__(self):
+        self.status = None
+        self.headers = None
+
+    def start_response(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = headers
+
+    def start_message(self):
+        return {
+            'type': 'http.response.start',
+            'status': int(self.status.split()[0]),
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                        for (k, v) in self.headers],
+        }
+
+
+# The counters and the trace of one request, put into the thread for each
+# step of the request and taken out after, so no thread keeps them.
+class RequestState(object):
+    def __init__(self):
+        self.req = None
+        self.trace = None
+
+    def run(self, func, *args):
+        stats = slasti.stats.get_stats()
+        stats.request_resume(self.req)
+        slasti.trace.resume(self.trace)
+        try:
+            return func(*args)
+        finally:
+            self.req = stats.request_state()
+            self.trace = slasti.trace.current()
+            stats.request_resume(None)
+            slasti.trace.resume(None)
+
+
+class Application(object):
+    def __init__(self, userconf, threads=ASGI_THREADS, extra=None):
+        self.environ = {'slasti.userconf': userconf}
+        self.environ.update(extra or {})
+        self.executor = futures.ThreadPoolExecutor(max_workers=threads)
+        self.fetch_executor = futures.ThreadPoolExecutor(
+            max_workers=ASGI_FETCH_THREADS)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise AppError("Unsupported ASGI scope: " + scope['type'])
+
+        body = await read_body(receive)
+        if body is None:
+            return
+        environ = make_environ(scope, body)
+        environ.update(self.environ)
+        loop = asyncio.get_running_loop()
+        response = Response()
+        state = RequestState()
+        try:
+            output = await loop.run_in_executor(
+                self.executor, state.run, slasti.wsgi.application,
+                environ, response.start_response)
+        except slasti.TitlePending as e:
+            try:
+                title = await loop.run_in_executor(
+                    self.fetch_executor, state.run, slasti.fetch.fetch_title,
+                    e.url)
+                output = slasti.main.title_output(response.start_response,
+                                                  title)
+            except (App400Error, App503Error) as e:
+                output = slasti.wsgi.error_output(environ,
+                                                  response.start_response, e)
+        await self.send_output(loop, send, response, output, state)
+
+    async def send_output(self, loop, send, response, output, state):
+        chunks = iter(output)
+        try:
+            chunk = b''
+            # An application may start the response with its first chunk.
+            if response.status is None:
+                chunk = await loop.run_in_executor(self.executor, state.run,
+                                                   next, chunks, None)
+            await send(response.start_message())
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, state.run,
+                                                   next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b'',
+                        'more_body': False})
+        finally:
+            if hasattr(output, 'close'):
+                await loop.run_in_executor(self.executor, state.run,
+                                           output.close)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                loop = asyncio.get_running_loop()
+                try:
+                    await loop.run_in_executor(
+                        self.executor, slasti.wsgi.preload,
+                        self.environ['slasti.userconf'])
+                except AppError:
+                    # The requests will tell what is wrong.
+                    pass
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                self.fetch_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+# Like SetEnv slasti.userconf for mod_wsgi.
+application = Application(os.environ.get('SLASTI_USERCONF',
+                                         '/etc/slasti-users.conf'))
@@ -0,0 +1,195 @@
+#
+# Slasti -- Backfill titles of marks that were saved without one
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: python -m slasti.backfill target_dir [target_dir...]
+#
+# When the bookmarklet's preload fails, the mark is saved with no title,
+# and add1 puts it into the backfill queue of the base. A worker thread in
+# the server process goes through the queue in the background, at a polite
+# rate, and writes the titles back with edit1. The queue is persistent, so
+# whatever the server did not get to before a restart can be drained with
+# the command above, e.g. from cron.
+#
+
+import sys
+import threading
+import time
+import traceback
+
+from six.moves.urllib.parse import urlsplit
+
+import slasti
+from slasti import AppError, App400Error, App503Error
+
+TAG = "slasti.backfill"
+
+# Seconds between any two fetches, and between fetches from the same host.
+BACKFILL_INTERVAL = 2
+BACKFILL_HOST_INTERVAL = 30
+# A job that failed this many times is dropped.
+BACKFILL_ATTEMPTS = 5
+# The wait after a failure, doubled with every attempt.
+BACKFILL_RETRY = 60
+
+
+class Backfiller(object):
+    def __init__(self, fetch=None, interval=BACKFILL_INTERVAL,
+                 host_interval=BACKFILL_HOST_INTERVAL):
+        if fetch is None:
+            from slasti.fetch import fetch_title as fetch
+        self.fetch = fetch
+        self.interval = interval
+        self.host_interval = host_interval
+        self.last_fetch = 0.0
+        # host_last: host -> time of the last fetch
+        self.host_last = {}
+
+    # Run the jobs of the base that are due and allowed by the rate limits.
+    # Returns the number of jobs left in the queue.
+    def run_once(self, base):
+        names = base.backfill_list()
+        left = len(names)
+        for markname in names:
+            job = base.backfill_get(markname)
+            if job is None:
+                base.backfill_del(markname)
+                left -= 1
+                continue
+            now = time.time()
+            if job.get("next", 0) > now:
+                continue
+            host = urlsplit(job["url"]).netloc.lower()
+            if now - self.host_last.get(host, 0) < self.host_interval:
+                continue
+            wait = self.last_fetch + self.interval - now
+            if wait > 0:
+                time.sleep(wait)
+            if self.run_job(base, markname, job, host):
+                left -= 1
+        return left
+
+    # Returns True if the job is finished, one way or the other.
+    def run_job(self, base, markname, job, host):
+        self.last_fetch = time.time()
+        self.host_last[host] = self.last_fetch
+
+        mark = base.lookup_file(markname)
+        if mark is None or mark.title or mark.url != job["url"]:
+            # Deleted, or the user got to it before we did.
+            base.backfill_del(markname)
+            return True
+
+        try:
+            title = self.fetch(job["url"])
+        except (App400Error, App503Error):
+            job["attempts"] = job.get("attempts", 0) + 1
+            if job["attempts"] >= BACKFILL_ATTEMPTS:
+                base.backfill_del(markname)
+                return True
+            job["next"] = time.time() + \
+                          BACKFILL_RETRY * 2 ** (job["attempts"] - 1)
+            base.backfill_put(markname, job)
+            return False
+
+        # Check again, the fetch took a while.
+        mark = base.lookup_file(markname)
+        if mark is not None and not mark.title and mark.url == job["url"]:
+            (stamp0, stamp1) = mark.key()
+            tags = [t for t in mark.tags if t]
+            base.edit1(stamp0, stamp1, title, mark.url, mark.note, tags)
+        base.backfill_del(markname)
+        return True
+
+
+#
+# The worker thread of the server process. It only knows about the bases
+# that were kicked since it started, and forgets a base once its queue
+# is empty, or when something goes wrong with it; the next kick or the
+# command from cron get to the rest. The bases are those of the pool of
+# the server, see slasti.tagbase.get_pool().
+#
+class BackfillThread(object):
+    def __init__(self, backfiller=None):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.dirnames = set()
+        self.thread = None
+        if backfiller is None:
+            backfiller = Backfiller()
+        self.backfiller = backfiller
+
+    def kick(self, dirname):
+        with self.lock:
+            self.dirnames.add(dirname)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name="slasti-backfill")
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+
+    def run(self):
+        try:
+            self.loop()
+        finally:
+            # So that the next kick starts another thread.
+            with self.lock:
+                self.thread = None
+
+    def loop(self):
+        pool = slasti.tagbase.get_pool()
+        while True:
+            self.wakeup.clear()
+            with self.lock:
+                dirnames = list(self.dirnames)
+            for dirname in dirnames:
+                try:
+                    left = self.backfiller.run_once(pool.get(dirname))
+                except AppError:
+                    left = 0
+                except Exception:
+                    sys.stderr.write("%s: %s: error in backfill\n" %
+                                     (TAG, dirname))
+                    traceback.print_exc()
+                    left = 0
+                if left == 0:
+                    with self.lock:
+                        self.dirnames.discard(dirname)
+            # Jobs that are not due yet get looked at again in a while.
+            self.wakeup.wait(BACKFILL_INTERVAL * 5)
+
+_thread = None
+_thread_lock = threading.Lock()
+
+def kick(dirname):
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            _thread = BackfillThread()
+    _thread.kick(dirname)
+
+
+def Usage():
+    sys.stderr.write("Usage: " + TAG + " target_dir [target_dir...]\n")
+    sys.exit(2)
+
+def main(args):
+    if len(args) == 0:
+        Usage()
+    backfiller = Backfiller()
+    for dirname in args:
+        base = slasti.tagbase.TagBase(dirname)
+        base.open()
+        left = backfiller.run_once(base)
+        base.close()
+        sys.stdout.write("%s: %s: %d left\n" % (TAG, dirname, left))
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except AppError as e:
+        sys.stderr.write(TAG + ": " + str(e) + "\n")
+        sys.exit(1)
@@ -0,0 +1,206 @@
+#
+# Slasti -- Export snapshots
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Building export.xml means parsing every mark in the base. Backup scripts
+# poll it all the time, so we materialize it into a file next to the marks,
+# named after the generation of the base, together with a gzipped copy.
+# As long as the generation stays the same, requests are served from the
+# files, with ETag, If-None-Match, and Range working like for any static file.
+#
+
+import errno
+import gzip
+import os
+
+from slasti import AppError
+import slasti
+
+SNAPDIR = "cache"
+READSZ = 65536
+
+
+class Snapshot(object):
+    def __init__(self, base):
+        self.base = base
+        self.snapdir = base.dirname + "/" + SNAPDIR
+        self.gen = base.generation()
+
+    def path(self, gz=False):
+        return "%s/export.%d.xml%s" % (self.snapdir, self.gen,
+                                       ".gz" if gz else "")
+
+    def etag(self, gz=False):
+        return '"x%d%s"' % (self.gen, "z" if gz else "")
+
+    # Make sure the files for the current generation exist. The dumper
+    # is an iterable that produces the XML, same as served unsnapshotted.
+    def ensure(self, dumper):
+        if os.path.exists(self.path()) and os.path.exists(self.path(True)):
+            slasti.stats.incr("export.cache.hit")
+            return False
+        slasti.stats.incr("export.cache.miss")
+        try:
+            os.mkdir(self.snapdir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise AppError(str(e))
+
+        # Concurrent builders each write their own temporary files, and the
+        # last rename wins. Since they build the same thing, it's harmless.
+        tmpsfx = ".%d.tmp" % os.getpid()
+        tmp_xml = self.path() + tmpsfx
+        tmp_gz = self.path(True) + tmpsfx
+        try:
+            f = open(tmp_xml, "wb")
+            fz = open(tmp_gz, "wb")
+            # The mtime=0 keeps the gzip stable from build to build.
+            z = gzip.GzipFile(fileobj=fz, mode="wb", mtime=0)
+            for chunk in dumper:
+                f.write(chunk)
+                z.write(chunk)
+            z.close()
+            fz.close()
+            f.close()
+            # The .gz goes first, because we test for the .xml above.
+            os.rename(tmp_gz, self.path(True))
+            os.rename(tmp_xml, self.path())
+        except (IOError, OSError) as e:
+            for tmp in (tmp_xml, tmp_gz):
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+            raise AppError(str(e))
+
+        self.prune()
+        return True
+
+    # Remove snapshots of past generations.
+    def prune(self):
+        try:
+            names = os.listdir(self.snapdir)
+        except OSError:
+            return
+        keep = (os.path.basename(self.path()),
+                os.path.basename(self.path(True)))
+        for name in names:
+            if not name.startswith("export.") or name in keep:
+                continue
+            # Leave alone temporary files of builders in progress.
+            if name.endswith(".tmp"):
+                continue
+            try:
+                os.unlink(self.snapdir + "/" + name)
+            except OSError:
+                pass
+
+    # Returns None if the file is gone, see open_snapshot().
+    def open(self, gz=False):
+        try:
+            return open(self.path(gz), "rb")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise AppError(str(e))
+
+
+# Make sure the snapshot of the current generation exists and open it.
+# A request that comes after a write may prune our files between the two,
+# and then we go again with its generation, once. The make_dumper makes
+# the dumper, like for ensure().
+def open_snapshot(base, make_dumper, gz=False):
+    for attempt in (0, 1):
+        snap = Snapshot(base)
+        snap.ensure(make_dumper())
+        f = snap.open(gz)
+        if f is not None:
+            return (snap, f)
+        slasti.stats.incr("export.cache.pruned")
+    raise AppError("Snapshot removed: " + snap.path(gz))
+
+
+# Parse If-None-Match. Weak tags compare equal for our purposes.
+def etag_match(inm, etag):
+    if not inm:
+        return False
+    for t in inm.split(","):
+        t = t.strip()
+        if t == "*":
+            return True
+        if t.startswith("W/"):
+            t = t[2:]
+        if t == etag:
+            return True
+    return False
+
+def accepts_gzip(accenc):
+    if not accenc:
+        return False
+    for coding in accenc.split(","):
+        p = coding.strip().split(";")
+        if p[0].strip().lower() != "gzip":
+            continue
+        for param in p[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    return float(param[2:]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+# Parse Range for a resource of size bytes. Returns None when the header
+# should be ignored (absent, malformed, or multiple ranges, which we are
+# allowed not to support), (start, end) inclusive, or (None, None) when
+# the range is not satisfiable.
+def parse_range(hrange, size):
+    if not hrange:
+        return None
+    hrange = hrange.strip()
+    if not hrange.startswith("bytes="):
+        return None
+    spec = hrange[6:].strip()
+    if "," in spec:
+        return None
+    p = spec.split("-")
+    if len(p) != 2:
+        return None
+    try:
+        if p[0] == "":
+            # Suffix range: the last N bytes.
+            n = int(p[1])
+            if n <= 0:
+                return (None, None)
+            start = max(size - n, 0)
+            end = size - 1
+        else:
+            start = int(p[0])
+            end = int(p[1]) if p[1] != "" else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end < start):
+        return None
+    if start >= size:
+        return (None, None)
+    if end is None:
+        end = size - 1
+    if end >= size:
+        end = size - 1
+    return (start, end)
+
+# Read length bytes off an open file from the current position.
+# The file is already open, so a concurrent prune cannot yank it from us.
+def file_iter(f, length):
+    try:
+        while length > 0:
+            buf = f.read(min(READSZ, length))
+            if not buf:
+                break
+            length -= len(buf)
+            yield buf
+    finally:
+        f.close()
@@ -0,0 +1,545 @@
+#
+# Slasti -- Fetching of titles for the form pre-fill
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# The fetch used to run right in the WSGI request thread, so a few slow
+# targets tied up every thread of the daemon ("Preload hangs the whole
+# server"). Now fetches run in a small pool of worker threads of their own.
+# The request thread waits for its fetch no longer than FETCH_DEADLINE.
+# If all workers are busy and FETCH_QUEUE requests are waiting already,
+# or if a host has FETCH_PER_HOST fetches in flight, we return 503 at once.
+# A host that times out FETCH_FAILURES times in a row is not contacted
+# for FETCH_COOLDOWN seconds, and requests for it fail fast with 503 too.
+# We read the page only until the title ends, but no more than FETCH_BUDGET.
+# Titles (and failures) are cached, connections are kept alive in a pool,
+# and up to FETCH_REDIRECTS redirects are followed over the same pool.
+#
+
+import codecs
+import collections
+import socket
+import threading
+import time
+
+from concurrent import futures
+
+import six
+from six.moves import html_parser, http_client
+from six.moves.html_entities import name2codepoint
+from six.moves.urllib.parse import urljoin, urlsplit
+
+from slasti import App400Error, App503Error, TitlePending
+from slasti.trace import traced
+import slasti
+
+FETCH_WORKERS = 6
+FETCH_QUEUE = 6
+FETCH_PER_HOST = 2
+FETCH_TIMEOUT = 10
+FETCH_DEADLINE = 15
+FETCH_FAILURES = 3
+FETCH_COOLDOWN = 300
+FETCH_BUDGET = 256 * 1024
+FETCH_CHUNK = 8192
+FETCH_REDIRECTS = 5
+REDIRECTS = (301, 302, 303, 307, 308)
+CONN_PER_HOST = 2
+CONN_IDLE = 30
+DRAIN_MAX = 64 * 1024
+CACHE_SIZE = 1000
+CACHE_TTL = 3600
+CACHE_NEG_TTL = 300
+HOSTS_MAX = 1000
+
+
+#
+# The TitleParser is fed the page as it arrives and notes when the title
+# is complete, so we stop reading right there, instead of parsing the whole
+# document with BeautifulSoup. Since the charset may be declared in a <meta>
+# that we only see after we started parsing, the bytes are fed in as
+# latin-1, which maps them 1:1, and the title is decoded in the end.
+# Character references are resolved on the spot, since they are
+# independent of the charset.
+#
+class TitleParser(html_parser.HTMLParser):
+    def __init__(self, raw=True):
+        html_parser.HTMLParser.__init__(self)
+        # We deal with the references ourselves (py3 only, py2 never did).
+        self.convert_charrefs = False
+        # raw: the data is bytes fed as latin-1, to be decoded at the end
+        self.raw = raw
+        self.in_title = False
+        self.done = False
+        # charset: what a <meta> in the page said, if anything
+        self.charset = None
+        # pieces: (is_raw, text)
+        self.pieces = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and not self.done:
+            self.in_title = True
+        elif tag == 'meta' and self.charset is None:
+            attrd = dict(attrs)
+            charset = attrd.get('charset')
+            if charset is None and \
+               (attrd.get('http-equiv') or '').lower() == 'content-type':
+                charset = content_charset(attrd.get('content'))
+            if charset and known_charset(charset):
+                self.charset = charset
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.in_title:
+            self.in_title = False
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.pieces.append((self.raw, data))
+
+    def handle_entityref(self, name):
+        if self.in_title:
+            if name in name2codepoint:
+                self.pieces.append((False, six.unichr(name2codepoint[name])))
+            else:
+                self.pieces.append((self.raw, '&' + name))
+
+    def handle_charref(self, name):
+        if self.in_title:
+            try:
+                if name[0] in 'xX':
+                    c = six.unichr(int(name[1:], 16))
+                else:
+                    c = six.unichr(int(name))
+            except (ValueError, OverflowError):
+                c = u'\ufffd'
+            self.pieces.append((False, c))
+
+    def title(self, charset):
+        if not self.done and not self.pieces:
+            return None
+        charset = charset or self.charset
+        out = []
+        run = []
+        for (raw, text) in self.pieces + [(False, u'')]:
+            if raw:
+                run.append(text)
+                continue
+            if run:
+                out.append(decode_title(u''.join(run).encode('latin-1'),
+                                        charset))
+                run = []
+            out.append(text)
+        # Titles are often broken over lines in the source.
+        return u' '.join(u''.join(out).split())
+
+def known_charset(charset):
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return False
+    return True
+
+# The charset parameter out of a Content-Type value, or None.
+def content_charset(typeval):
+    if not typeval:
+        return None
+    for param in typeval.split(";")[1:]:
+        p = param.strip().split("=", 1)
+        if len(p) == 2 and p[0].strip().lower() == 'charset':
+            return p[1].strip().strip('"\'')
+    return None
+
+def decode_title(b, charset):
+    if charset:
+        return b.decode(charset, 'replace')
+    # Undeclared is most often UTF-8 nowadays, or else some Windows codepage.
+    try:
+        return b.decode('utf-8')
+    except UnicodeDecodeError:
+        return b.decode('windows-1252', 'replace')
+
+def fetch_parse(chunk):
+    if isinstance(chunk, six.binary_type):
+        parser = TitleParser(raw=True)
+        parser.feed(chunk.decode('latin-1'))
+    else:
+        parser = TitleParser(raw=False)
+        parser.feed(chunk)
+    parser.close()
+    titlestr = parser.title(None)
+    if titlestr is None:
+        raise App400Error("target no title")
+    return titlestr
+
+# Read the response until the title is complete. We give up when the
+# page is over FETCH_BUDGET bytes without a title, or the time is up.
+def fetch_read_title(response, charset, deadline):
+    parser = TitleParser(raw=True)
+    # The read() waits for the whole amount, but read1() returns what came.
+    read = getattr(response, 'read1', response.read)
+    nread = 0
+    while not parser.done:
+        if nread >= FETCH_BUDGET:
+            break
+        if time.time() > deadline:
+            raise socket.timeout("target too slow")
+        chunk = read(min(FETCH_CHUNK, FETCH_BUDGET - nread))
+        if not chunk:
+            break
+        nread += len(chunk)
+        parser.feed(chunk.decode('latin-1'))
+    titlestr = parser.title(charset)
+    if titlestr is None:
+        raise App400Error("target no title")
+    return titlestr
+
+#
+# The ConnPool keeps a few idle keep-alive connections per host, since
+# people tend to bookmark several pages off the same site in a row.
+# A connection only goes back to the pool if its response was read to
+# the end, so if we stopped at the title, we drain what's left, as long
+# as it is known to be short. Otherwise the connection is closed.
+#
+class ConnPool(object):
+    def __init__(self, per_host=CONN_PER_HOST, idle=CONN_IDLE):
+        self.per_host = per_host
+        self.idle = idle
+        self.lock = threading.Lock()
+        # idle: (scheme, host) -> [(conn, time_released)]
+        self.conns = {}
+
+    def _get(self, scheme, host, timeout):
+        now = time.time()
+        with self.lock:
+            idle_list = self.conns.get((scheme, host), [])
+            while idle_list:
+                (conn, t) = idle_list.pop()
+                if now - t < self.idle:
+                    return (conn, True)
+                conn.close()
+        if scheme == 'http':
+            conn = http_client.HTTPConnection(host, timeout=timeout)
+        else:
+            conn = http_client.HTTPSConnection(host, timeout=timeout)
+        return (conn, False)
+
+    # Returns the connection, to be released later, and the response.
+    def request(self, scheme, host, path, headers, timeout):
+        (conn, reused) = self._get(scheme, host, timeout)
+        try:
+            conn.request("GET", path, None, headers)
+            return (conn, conn.getresponse())
+        except socket.timeout:
+            conn.close()
+            raise
+        except (socket.error, http_client.HTTPException):
+            conn.close()
+            # The server may have dropped the idle connection. Once more.
+            if not reused:
+                raise
+        (conn, reused) = self._get(scheme, host, timeout)
+        try:
+            conn.request("GET", path, None, headers)
+            return (conn, conn.getresponse())
+        except Exception:
+            conn.close()
+            raise
+
+    def release(self, scheme, host, conn, response):
+        try:
+            if not response.isclosed():
+                if response.length is None or response.length > DRAIN_MAX:
+                    conn.close()
+                    return
+                response.read()
+        except (socket.error, http_client.HTTPException):
+            conn.close()
+            return
+        if response.will_close:
+            conn.close()
+            return
+        with self.lock:
+            idle_list = self.conns.setdefault((scheme, host), [])
+            if len(idle_list) >= self.per_host:
+                conn.close()
+                return
+            idle_list.append((conn, time.time()))
+
+    def close(self):
+        with self.lock:
+            for idle_list in self.conns.values():
+                for (conn, t) in idle_list:
+                    conn.close()
+            self.conns = {}
+
+@traced("fetch.url")
+def fetch_url_title(url, timeout=FETCH_TIMEOUT, conns=None):
+    if conns is None:
+        conns = get_conns()
+    deadline = time.time() + FETCH_DEADLINE
+
+    for n in range(FETCH_REDIRECTS + 1):
+        # XXX Seriously, sanitize url before parsing
+        scheme, host, path, u_query, u_frag = urlsplit(url)
+        if scheme != 'http' and scheme != 'https':
+            raise App400Error("bad url scheme")
+
+        headers = {}
+        # XXX Forward the Referer: that we received from the client, if any.
+
+        # Unfortunately, passing a scheme of None blows up in py3 when coercing
+        # the arguments of urlunsplit(): None is mistaken for bytes (not an str).
+        # fullpath = urlunsplit((None, None, path, u_query, None))
+        fullpath = path + '?' + u_query if u_query else path
+        if not fullpath:
+            fullpath = '/'
+
+        (conn, response) = conns.request(scheme, host, fullpath, headers,
+                                         timeout)
+        broken = False
+        try:
+            if response.status in REDIRECTS:
+                location = response.getheader("Location")
+                if not location:
+                    raise App400Error("target redirect with no location")
+                url = urljoin(url, location)
+                continue
+
+            # XXX A different return code for 201 and 204?
+            if response.status != 200:
+                raise App400Error("target error %d" % response.status)
+
+            typeval = response.getheader("Content-Type")
+            if typeval == None:
+                raise App400Error("target no type")
+            typestr = typeval.split(";")
+            if len(typestr) == 0:
+                raise App400Error("target type none")
+            if typestr[0] != 'text/html':
+                raise App400Error("target type %s" % typestr[0])
+
+            charset = content_charset(typeval)
+            if charset and not known_charset(charset):
+                charset = None
+            return fetch_read_title(response, charset, deadline)
+        except (socket.error, http_client.HTTPException):
+            broken = True
+            raise
+        finally:
+            if broken:
+                conn.close()
+            else:
+                conns.release(scheme, host, conn, response)
+
+    raise App400Error("target redirects too many times")
+
+#
+# The TitleCache remembers titles by URL, and errors too, though not as
+# long. It is in front of the worker pool, so a retry of the bookmarklet
+# does not even take a worker. Our own 503s are not cached.
+#
+class TitleCache(object):
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, neg_ttl=CACHE_NEG_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self.lock = threading.Lock()
+        # entries: url -> (expires, title, error), oldest first
+        self.entries = collections.OrderedDict()
+
+    # Returns (title, error) or None if we do not know.
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            (expires, title, error) = entry
+            if expires < time.time():
+                del self.entries[url]
+                return None
+            # Move to the young end.
+            del self.entries[url]
+            self.entries[url] = entry
+            return (title, error)
+
+    def put(self, url, title, error):
+        ttl = self.ttl if error is None else self.neg_ttl
+        with self.lock:
+            if url in self.entries:
+                del self.entries[url]
+            self.entries[url] = (time.time() + ttl, title, error)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class HostState(object):
+    def __init__(self):
+        # inflight: fetches running or queued for the host
+        self.inflight = 0
+        # failures: timeouts in a row
+        self.failures = 0
+        # open_until: the breaker is open (we do not call) until this time
+        self.open_until = 0.0
+
+
+class FetchPool(object):
+    def __init__(self, workers=FETCH_WORKERS, queue=FETCH_QUEUE,
+                 per_host=FETCH_PER_HOST, deadline=FETCH_DEADLINE,
+                 failures=FETCH_FAILURES, cooldown=FETCH_COOLDOWN):
+        self.workers = workers
+        self.per_host = per_host
+        self.deadline = deadline
+        self.max_failures = failures
+        self.cooldown = cooldown
+
+        self.lock = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        # Every fetch holds a slot from submission until its worker is done,
+        # so running plus waiting never exceeds workers plus queue.
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.hosts = {}
+
+    # Run fn(url) in the pool and return its result.
+    def call(self, url, fn):
+        (state, future) = self.submit(url, fn)
+        return self.result(state, future, self.deadline)
+
+    # Start fn(url) in the pool, returning the host state and the future,
+    # which must be given to result() once done or the deadline is up.
+    def submit(self, url, fn):
+        host = urlsplit(url).netloc.lower()
+
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                if len(self.hosts) >= HOSTS_MAX:
+                    self._prune()
+                state = HostState()
+                self.hosts[host] = state
+            if state.open_until > time.time():
+                raise App503Error("target keeps timing out, try later")
+            if state.inflight >= self.per_host:
+                raise App503Error("too many fetches from the target")
+            if not self.slots.acquire(False):
+                raise App503Error("too many fetches")
+            state.inflight += 1
+
+        try:
+            future = self.executor.submit(self._run, state, fn, url)
+        except RuntimeError:
+            # The pool was shut down under us.
+            self._done(state)
+            raise App503Error("fetch pool is shut down")
+        return (state, future)
+
+    def result(self, state, future, timeout):
+        try:
+            return future.result(timeout=timeout)
+        except futures.TimeoutError:
+            # The worker keeps its slot until its socket times out.
+            self._failed(state)
+            raise App503Error("target timeout")
+        except socket.timeout:
+            raise App503Error("target timeout")
+        except (socket.error, http_client.HTTPException) as e:
+            raise App400Error("target error: %s" % str(e))
+
+    # If the fetch took longer than the deadline, the waiting request
+    # has counted the failure already, whatever the outcome here.
+    def _run(self, state, fn, url):
+        t0 = time.time()
+        try:
+            result = fn(url)
+        except socket.timeout:
+            # Only timeouts count: a host that refuses or does not resolve
+            # costs us nothing, and may be just a typo in one URL.
+            if time.time() - t0 <= self.deadline:
+                self._failed(state)
+            raise
+        finally:
+            self._done(state)
+        if time.time() - t0 <= self.deadline:
+            with self.lock:
+                state.failures = 0
+        return result
+
+    # Forget hosts that have nothing going and nothing against them.
+    # Called with the lock held.
+    def _prune(self):
+        now = time.time()
+        for host in list(self.hosts.keys()):
+            state = self.hosts[host]
+            if state.inflight == 0 and state.open_until < now:
+                del self.hosts[host]
+
+    def _failed(self, state):
+        with self.lock:
+            state.failures += 1
+            if state.failures >= self.max_failures:
+                state.open_until = time.time() + self.cooldown
+
+    def _done(self, state):
+        with self.lock:
+            state.inflight -= 1
+        self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+# The pool is per process and created on first use, because mod_wsgi
+# imports us before forking, and threads do not survive a fork.
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = FetchPool()
+        return _pool
+
+_conns = None
+_cache = None
+
+def get_conns():
+    global _conns
+    with _pool_lock:
+        if _conns is None:
+            _conns = ConnPool()
+        return _conns
+
+def get_cache():
+    global _cache
+    with _pool_lock:
+        if _cache is None:
+            _cache = TitleCache()
+        return _cache
+
+@traced("fetch.title")
+def fetch_title(url):
+    cache = get_cache()
+    hit = cache.get(url)
+    if hit is not None:
+        slasti.stats.incr("fetch.cache.hit")
+        (title, error) = hit
+        if error is not None:
+            raise App400Error(error)
+        return title
+    slasti.stats.incr("fetch.cache.miss")
+    t0 = time.time()
+    try:
+        title = get_pool().call(url, fetch_url_title)
+    except App400Error as e:
+        cache.put(url, None, str(e))
+        slasti.stats.incr("fetch.failed")
+        raise
+    except App503Error:
+        slasti.stats.incr("fetch.unavailable")
+        raise
+    finally:
+        slasti.stats.observe("fetch.title", time.time() - t0)
+    cache.put(url, title, None)
+    return title
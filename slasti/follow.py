@@ -0,0 +1,223 @@
+#
+# Slasti -- Follower: mirror a base by replaying its change log
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: SLASTI_PASSWORD=xxx python -m slasti.follow [-i secs] dir url
+#
+# The url is the user's root, e.g. https://slasti.example.com/zaitcev.
+# We log in like a browser would, then fetch changes?after=N repeatedly,
+# apply them to the local base, and remember N in the file "follow" there.
+# With -i 0 we catch up once and exit, otherwise poll every secs seconds.
+#
+
+import json
+import os
+import sys
+import time
+
+from six.moves import http_client
+from six.moves.urllib.parse import urlencode, urlsplit
+
+import slasti
+from slasti import AppError
+
+TAG = "slasti.follow"
+TIMEOUT = 60
+
+
+# The body of a response, which closes the connection with it.
+class HTTPBody(object):
+    def __init__(self, conn, response):
+        self.conn = conn
+        self.response = response
+
+    def read(self, *args):
+        return self.response.read(*args)
+
+    def readline(self):
+        return self.response.readline()
+
+    def close(self):
+        self.response.close()
+        self.conn.close()
+
+
+class HTTPSource(object):
+    def __init__(self, url, password):
+        scheme, host, path, u_query, u_frag = urlsplit(url)
+        if scheme != 'http' and scheme != 'https':
+            raise AppError("bad url scheme: " + url)
+        self.scheme = scheme
+        self.host = host
+        self.path = path.rstrip('/')
+        self.password = password
+        self.cookie = None
+
+    # Returns status, headers (with lowercase names), and a file-like
+    # body that is read line by line, so big responses are not buffered.
+    # The caller must close the body.
+    def request(self, method, path, body, headers):
+        if self.scheme == 'http':
+            conn = http_client.HTTPConnection(self.host, timeout=TIMEOUT)
+        else:
+            conn = http_client.HTTPSConnection(self.host, timeout=TIMEOUT)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+        rhdrs = dict((k.lower(), v) for (k, v) in response.getheaders())
+        return (response.status, rhdrs, HTTPBody(conn, response))
+
+    def login(self):
+        body = urlencode({'password': self.password, 'OK': 'Enter'})
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        status, rhdrs, f = self.request('POST', self.path + '/login',
+                                        body, headers)
+        f.close()
+        if status != 303 or 'set-cookie' not in rhdrs:
+            raise AppError("login failed: %d" % status)
+        self.cookie = rhdrs['set-cookie'].split(';')[0]
+
+    def changes(self, after, resume=None):
+        if self.cookie is None:
+            self.login()
+        path = '%s/changes?after=%d' % (self.path, after)
+        if resume is not None:
+            path += '&' + urlencode({'resume': resume})
+        status, rhdrs, f = self.request('GET', path, None,
+                                        {'Cookie': self.cookie})
+        if status == 403:
+            # The cookie expired, presumably.
+            f.close()
+            self.login()
+            status, rhdrs, f = self.request('GET', path, None,
+                                            {'Cookie': self.cookie})
+        try:
+            if status != 200:
+                raise AppError("changes failed: %d" % status)
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            f.close()
+
+
+class Follower(object):
+    def __init__(self, base, source):
+        self.base = base
+        self.source = source
+        self.posname = base.dirname + "/follow"
+
+    # The sequence number of the last change of the primary applied here.
+    def position(self):
+        return self.read_position()[0]
+
+    # The position, and the name of the last mark applied while we are in
+    # the middle of the marks older than the change log of the primary,
+    # see TagBase.changes_after(), or None.
+    def read_position(self):
+        try:
+            f = open(self.posname, "r")
+        except IOError:
+            return (0, None)
+        p = f.read().split()
+        f.close()
+        try:
+            seq = int(p[0])
+        except (ValueError, IndexError):
+            return (0, None)
+        if len(p) > 1:
+            return (seq, p[1])
+        return (seq, None)
+
+    def set_position(self, seq, resume=None):
+        tmpname = self.posname + ".tmp"
+        f = open(tmpname, "w")
+        if resume is not None:
+            f.write("%d %s\n" % (seq, resume))
+        else:
+            f.write("%d\n" % seq)
+        f.close()
+        os.rename(tmpname, self.posname)
+
+    # Applying a record is idempotent, so a crash between applying and
+    # saving the position only means that we apply some records again.
+    def apply(self, record):
+        (stamp0, stamp1) = slasti.tagbase.name_key(record['key'])
+        if record['op'] == 'store':
+            self.base.edit1(stamp0, stamp1, record['title'], record['url'],
+                            record['note'], record['tags'],
+                            mtime=record['mtime'])
+        elif record['op'] == 'delete':
+            markname = slasti.tagbase.key_name(stamp0, stamp1)
+            if self.base.lookup_file(markname) is not None:
+                self.base.delete(stamp0, stamp1)
+        else:
+            raise AppError("Unknown change: %s" % record['op'])
+
+    # Catch up with the primary. Returns the number of records applied.
+    def poll(self):
+        total = 0
+        while True:
+            pos = self.read_position()
+            last = pos
+            for record in self.source.changes(pos[0], pos[1]):
+                self.apply(record)
+                if 'resume' in record:
+                    last = (pos[0], record['resume'])
+                else:
+                    last = (record['seq'], None)
+                total += 1
+            if last == pos:
+                break
+            self.set_position(last[0], last[1])
+        return total
+
+
+def Usage():
+    sys.stderr.write("Usage: SLASTI_PASSWORD=xxx " + TAG +
+                     " [-i interval] target_dir url\n")
+    sys.exit(2)
+
+def main(args):
+    interval = 60
+    if len(args) >= 2 and args[0] == '-i':
+        try:
+            interval = int(args[1])
+        except ValueError:
+            Usage()
+        args = args[2:]
+    if len(args) != 2:
+        Usage()
+    password = os.environ.get('SLASTI_PASSWORD')
+    if not password:
+        Usage()
+
+    base = slasti.tagbase.TagBase(args[0])
+    base.open()
+    follower = Follower(base, HTTPSource(args[1], password))
+    while True:
+        n = follower.poll()
+        if n:
+            sys.stdout.write("%s: applied %d changes, at %d\n" %
+                             (TAG, n, follower.position()))
+            sys.stdout.flush()
+        if interval <= 0:
+            break
+        time.sleep(interval)
+    base.close()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except AppError as e:
+        sys.stderr.write(TAG + ": " + str(e) + "\n")
+        sys.exit(1)
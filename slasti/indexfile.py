@@ -0,0 +1,382 @@
+#
+# Slasti -- Shared index files
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Every process of a mod_wsgi daemon group would build its own index of
+# a base (see Index in slasti/tagbase.py), so we write the index into a file
+# next to the marks, and all processes map it. The pages of the file are
+# in the page cache once, however many processes there are, and a process
+# that comes up later finds the index built already.
+#
+# The file starts with the stamp of the base it was built from, which is
+# the generation and the directories (see TagBase.index_stamp). A write
+# does not write the file anew, which would cost as much as the base.
+# Before the writer lets go of the generation, it appends a record of the
+# change to the journal "index.journal", and readers of any process map
+# the file and apply the records up to their stamp (see derive_index in
+# slasti/tagbase.py). The journal starts with the stamp of its file, and
+# every record has the stamps before and after it, so a journal of
+# another file, or records that do not follow one another, are not used.
+# After JOURNAL_MAX records, the writer writes the file anew instead, and
+# the journal starts over. Only when a reader finds no index of the
+# current stamp after that, like after a change by hand, it builds a new
+# file from the base. Either way the file is renamed over the old one,
+# and the journal of the old one removed; processes that mapped the old
+# file keep it until they look at the stamp again, so nobody sees half
+# a file.
+#
+# Layout, all integers little-endian:
+#   header: magic, version, the stamp, counts of marks, tags and postings
+#   marks: names of all marks, newest first, NAME_WIDTH bytes each
+#   tags: for every tag by name, the offset and length of its name,
+#         the index of its first posting and the number of postings
+#   postings: names of the marks of every tag, newest first, like marks
+#   names: the names of the tags in UTF-8
+#
+
+import json
+import mmap
+import os
+import struct
+import threading
+
+import six
+
+from slasti import AppError
+import slasti
+
+INDEXFILE = "index"
+JOURNAL = "index.journal"
+JOURNAL_MAX = 128
+MAGIC = b"SLXI"
+VERSION = 1
+# The mark names are "%010d" or "%010d.%02d".
+NAME_WIDTH = 16
+
+HEADER = struct.Struct("<4sIQQdQdIII")
+TAGENT = struct.Struct("<IIII")
+
+
+def _pack_name(name):
+    s = name.encode('ascii')
+    if len(s) > NAME_WIDTH:
+        raise AppError("Mark name too long: %s" % name)
+    return s.ljust(NAME_WIDTH, b"\0")
+
+def _unpack_name(s):
+    return str(s.rstrip(b"\0").decode('ascii'))
+
+# A read-only list of names in the file, good for TagMark and bisect_desc.
+class NameArray(object):
+    def __init__(self, mm, offset, count):
+        self.mm = mm
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.count
+        if n < 0 or n >= self.count:
+            raise IndexError(n)
+        p = self.offset + n * NAME_WIDTH
+        return _unpack_name(self.mm[p:p + NAME_WIDTH])
+
+
+class IndexFile(object):
+    def __init__(self, mm, ino, stamp, nmarks, ntags):
+        self.mm = mm
+        self.ino = ino
+        self.stamp = stamp
+        self.ntags = ntags
+        self.marks = NameArray(mm, HEADER.size, nmarks)
+        self.tagoff = HEADER.size + nmarks * NAME_WIDTH
+        self.postoff = self.tagoff + ntags * TAGENT.size
+        self._tagnames = None
+
+    # The pages are shared, so they do not count against the process.
+    def size(self):
+        return 0
+
+    def _entry(self, n):
+        return TAGENT.unpack_from(self.mm, self.tagoff + n * TAGENT.size)
+
+    def _name(self, entry):
+        return self.mm[entry[0]:entry[0] + entry[1]]
+
+    # The entry of the tag, or None.
+    def _find(self, tagname):
+        if isinstance(tagname, six.text_type):
+            tagname = tagname.encode('utf-8')
+        lo = 0
+        hi = self.ntags
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(self._entry(mid)) < tagname:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.ntags:
+            entry = self._entry(lo)
+            if self._name(entry) == tagname:
+                return entry
+        return None
+
+    def tag(self, tagname):
+        entry = self._find(tagname)
+        if entry is None:
+            return NameArray(self.mm, self.postoff, 0)
+        return NameArray(self.mm, self.postoff + entry[2] * NAME_WIDTH,
+                         entry[3])
+
+    def tagnames(self):
+        names = self._tagnames
+        if names is None:
+            names = [self._name(self._entry(n)).decode('utf-8')
+                     for n in range(self.ntags)]
+            self._tagnames = names
+        return names
+
+
+# Map the index file of the base, whatever its stamp.
+def _map(base):
+    slasti.stats.incr("files.open")
+    try:
+        f = open(os.path.join(base.dirname, INDEXFILE), "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            ino = os.fstat(f.fileno()).st_ino
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Empty, or a file system that cannot map.
+            return None
+    finally:
+        f.close()
+    if len(mm) < HEADER.size:
+        mm.close()
+        return None
+    h = HEADER.unpack_from(mm, 0)
+    if h[0] != MAGIC or h[1] != VERSION:
+        mm.close()
+        return None
+    return IndexFile(mm, ino, tuple(h[2:7]), h[7], h[8])
+
+# The records of the journal of the file with the stamp, as tuples of
+# the stamps before and after, and the arguments of derive_index.
+def _journal(base, stamp):
+    slasti.stats.incr("files.open")
+    try:
+        f = open(os.path.join(base.dirname, JOURNAL), "r")
+    except IOError:
+        return []
+    try:
+        lines = f.read().split("\n")
+    finally:
+        f.close()
+    try:
+        head = json.loads(lines[0])
+        if tuple(head["stamp"]) != tuple(stamp):
+            return []
+    except (ValueError, KeyError, TypeError):
+        return []
+    records = []
+    for line in lines[1:]:
+        try:
+            r = json.loads(line)
+        except ValueError:
+            # The end, or a record that is being appended.
+            break
+        records.append((tuple(r["prev"]), tuple(r["stamp"]), r["mark"],
+                        r["old"], r["new"], r["present"]))
+    return records
+
+# The index of the base for the stamp: the file, if it was built for the
+# stamp, or else the file with the records of its journal applied up to
+# the stamp, if they get there. The have is an index that we have already
+# and may start from, if it was made from the same file.
+def open_index(base, stamp, have=None):
+    stamp = tuple(stamp)
+    index = _map(base)
+    if index is None or index.stamp == stamp:
+        return index
+    records = _journal(base, index.stamp)
+    start = 0
+    if isinstance(have, slasti.tagbase.Index) and have.depth is not None \
+       and have.parent is not None and have.parent.ino == index.ino:
+        for (n, record) in enumerate(records):
+            if record[1] == have.stamp:
+                start = n + 1
+                index = have
+                break
+    for (prev, new, markname, old_tags, new_tags, present) in \
+            records[start:]:
+        if prev != index.stamp:
+            break
+        index = slasti.tagbase.derive_index(base, index, new, markname,
+                                            old_tags, new_tags, present)
+        if new == stamp:
+            return index
+    return None
+
+# Build the index file for the stamp, which the caller took before we read
+# anything, so a change made meanwhile leaves the file stale, not wrong.
+def build(base, stamp):
+    slasti.stats.incr("indexfile.build")
+    slasti.stats.incr("files.listdir")
+    marks = os.listdir(base.markdir)
+    marks.sort()
+    marks.reverse()
+    slasti.stats.incr("files.listdir")
+    tagnames = slasti.tagbase.fs_decode_list(os.listdir(base.tagdir))
+    # A mark added while we build may be in its tags already, but not in
+    # the marks we listed, and it must not be in one and not the other.
+    markset = set(marks)
+    tags = []
+    for tagname in tagnames:
+        dlist = slasti.tagbase.split_marks(
+            slasti.tagbase.load_tag(base.tagdir, tagname))
+        dlist = [markname for markname in dlist if markname in markset]
+        dlist.sort()
+        dlist.reverse()
+        tags.append((tagname.encode('utf-8'), len(dlist),
+                     b"".join([_pack_name(markname) for markname in dlist])))
+    tags.sort()
+    write(base, stamp,
+          (len(marks), b"".join([_pack_name(name) for name in marks])), tags)
+
+# The names of a list packed as in the file, copied from the file where
+# they come from one.
+def _packed(dlist):
+    if isinstance(dlist, NameArray):
+        return dlist.mm[dlist.offset:dlist.offset + dlist.count * NAME_WIDTH]
+    if isinstance(dlist, slasti.tagbase.OverlayList):
+        chunks = []
+        for (start, off, length, name) in dlist.runs:
+            if off is None:
+                chunks.append(_pack_name(name))
+            elif isinstance(dlist.under, NameArray):
+                p = dlist.under.offset + off * NAME_WIDTH
+                chunks.append(dlist.under.mm[p:p + length * NAME_WIDTH])
+            else:
+                chunks.append(b"".join([_pack_name(name) for name in
+                                        dlist.under[off:off + length]]))
+        return b"".join(chunks)
+    return b"".join([_pack_name(name) for name in dlist])
+
+# Publish the write of the generation of the stamp to other processes,
+# where old is the index of the last generation, after the mark was stored
+# (present) or deleted, its tags changing from old_tags to new_tags (see
+# TagBase.index_commit). The caller holds the generation. Returns the
+# index of the new generation.
+def derive(base, old, stamp, markname, old_tags, new_tags, present):
+    index = slasti.tagbase.derive_index(base, old, stamp, markname,
+                                        old_tags, new_tags, present)
+    if index.depth < JOURNAL_MAX and \
+       _append(base, old, stamp, markname, old_tags, new_tags, present):
+        slasti.stats.incr("indexfile.derive")
+        return index
+    # Too many records to apply, or no journal to append them to.
+    slasti.stats.incr("indexfile.compact")
+    tags = []
+    for tagname in index.tagnames():
+        dlist = index.tag(tagname)
+        if len(dlist) != 0:
+            tags.append((tagname.encode('utf-8'), len(dlist), _packed(dlist)))
+    tags.sort()
+    write(base, stamp, (len(index.marks), _packed(index.marks)), tags)
+    return open_index(base, stamp)
+
+def _append(base, old, stamp, markname, old_tags, new_tags, present):
+    line = json.dumps({"prev": list(old.stamp), "stamp": list(stamp),
+                       "mark": markname, "old": list(old_tags),
+                       "new": list(new_tags), "present": present},
+                      sort_keys=True) + "\n"
+    fname = os.path.join(base.dirname, JOURNAL)
+    if isinstance(old, IndexFile):
+        # The first write since the file was written starts its journal.
+        head = json.dumps({"stamp": list(old.stamp)}) + "\n"
+        tmpname = fname + ".%d.%d.tmp" % (os.getpid(),
+                                          threading.current_thread().ident)
+        try:
+            with open(tmpname, "w") as f:
+                f.write(head + line)
+            os.rename(tmpname, fname)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            return False
+        return True
+    # Not created if it is gone: someone wrote the file meanwhile.
+    try:
+        fd = os.open(fname, os.O_WRONLY | os.O_APPEND)
+    except OSError:
+        return False
+    try:
+        os.write(fd, line.encode('ascii'))
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+# The marks are (number of marks, packed names), and the tags are
+# (name in UTF-8, number of postings, packed postings), sorted by name.
+def write(base, stamp, marks, tags):
+    (nmarks, packed) = marks
+    chunks = [None, packed]
+    npost = 0
+    nameoff = HEADER.size + nmarks * NAME_WIDTH + \
+              len(tags) * TAGENT.size + \
+              sum(count for (name, count, postings) in tags) * NAME_WIDTH
+    for (name, count, postings) in tags:
+        chunks.append(TAGENT.pack(nameoff, len(name), npost, count))
+        nameoff += len(name)
+        npost += count
+    for (name, count, postings) in tags:
+        chunks.append(postings)
+    for (name, count, postings) in tags:
+        chunks.append(name)
+    chunks[0] = HEADER.pack(MAGIC, VERSION, stamp[0], stamp[1], stamp[2],
+                            stamp[3], stamp[4], nmarks, len(tags), npost)
+
+    # Like snapshots, concurrent builders write their own temporary files,
+    # and the last rename wins.
+    fname = os.path.join(base.dirname, INDEXFILE)
+    tmpname = fname + ".%d.%d.tmp" % (os.getpid(),
+                                      threading.current_thread().ident)
+    try:
+        with open(tmpname, "wb") as f:
+            f.write(b"".join(chunks))
+        # The journal is of the file that was there.
+        try:
+            os.unlink(os.path.join(base.dirname, JOURNAL))
+        except OSError:
+            pass
+        os.rename(tmpname, fname)
+    except (IOError, OSError) as e:
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        raise AppError(str(e))
+
+def get_index(base, stamp, have=None):
+    index = open_index(base, stamp, have)
+    if index is None:
+        # A writer publishes its generation while it holds the generation
+        # locked, so we wait for it and look again. Only if that is not it
+        # either, the file is built from the base.
+        stamp = base.index_stamp_locked()
+        index = open_index(base, stamp, have)
+    if index is None:
+        build(base, stamp)
+        index = open_index(base, stamp)
+    return index
@@ -0,0 +1,228 @@
+#
+# Slasti -- Link checker
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: python -m slasti.linkcheck [-a max_age_days] target_dir [...]
+#
+# Probes the URLs of all marks and records the outcome in the link index
+# of the base (see TagBase.links_load), which the "broken" page shows.
+# A pass only probes marks that are new, whose URL changed, or whose last
+# check is older than the max age (a day for broken ones, so that a site
+# that was down for a moment is not written off for a month), so running
+# it from cron daily is cheap. Probes are HEAD requests made with asyncio,
+# LINKCHECK_CONCURRENCY at a time overall and LINKCHECK_PER_HOST at a time
+# for any host; if a server does not like HEAD, we try GET and read just
+# the headers. This needs Python 3, unlike the rest of Slasti.
+#
+
+import asyncio
+import socket
+import ssl
+import sys
+import time
+
+from six.moves.urllib.parse import urljoin, urlsplit
+
+import slasti
+from slasti import AppError
+
+TAG = "slasti.linkcheck"
+
+LINKCHECK_CONCURRENCY = 20
+LINKCHECK_PER_HOST = 2
+LINKCHECK_TIMEOUT = 20
+LINKCHECK_REDIRECTS = 5
+LINKCHECK_MAX_AGE = 30 * 86400
+LINKCHECK_BROKEN_AGE = 86400
+LINKCHECK_HEADER_MAX = 64 * 1024
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class ProbeError(Exception):
+    pass
+
+
+def link_stale(entry, url, now, max_age):
+    if entry is None or entry.get("url") != url:
+        return True
+    if slasti.tagbase.link_broken(entry):
+        max_age = min(max_age, LINKCHECK_BROKEN_AGE)
+    return entry.get("checked", 0) + max_age <= now
+
+
+class LinkChecker(object):
+    def __init__(self, concurrency=LINKCHECK_CONCURRENCY,
+                 per_host=LINKCHECK_PER_HOST, timeout=LINKCHECK_TIMEOUT,
+                 max_age=LINKCHECK_MAX_AGE):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_age = max_age
+
+    # Make one request and return (status, location), reading nothing
+    # past the headers.
+    async def request(self, method, url):
+        scheme, host, path, u_query, u_frag = urlsplit(url)
+        if scheme == 'http':
+            port = 80
+            sslctx = None
+        elif scheme == 'https':
+            port = 443
+            sslctx = ssl.create_default_context()
+        else:
+            raise ProbeError("bad url scheme")
+        p = urlsplit(url)
+        if not p.hostname:
+            raise ProbeError("no host")
+        try:
+            if p.port:
+                port = p.port
+        except ValueError:
+            raise ProbeError("bad port")
+        fullpath = path + '?' + u_query if u_query else path
+        if not fullpath:
+            fullpath = '/'
+
+        reader, writer = await asyncio.open_connection(
+            p.hostname, port, ssl=sslctx, limit=LINKCHECK_HEADER_MAX)
+        try:
+            req = "%s %s HTTP/1.1\r\nHost: %s\r\n" \
+                  "User-Agent: Slasti-linkcheck\r\n" \
+                  "Connection: close\r\n\r\n" % (method, fullpath, host)
+            writer.write(req.encode('latin-1'))
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise ProbeError("headers too long")
+        except asyncio.IncompleteReadError:
+            raise ProbeError("no response")
+        finally:
+            writer.close()
+
+        lines = head.decode('latin-1').split("\r\n")
+        status = lines[0].split(None, 2)
+        if len(status) < 2 or not status[0].startswith("HTTP/"):
+            raise ProbeError("bad status line")
+        try:
+            code = int(status[1])
+        except ValueError:
+            raise ProbeError("bad status line")
+        location = None
+        for line in lines[1:]:
+            p = line.split(":", 1)
+            if len(p) == 2 and p[0].strip().lower() == "location":
+                location = p[1].strip()
+        return (code, location)
+
+    # Returns the link index entry for the url, without "checked".
+    async def probe(self, url):
+        final = url
+        try:
+            for n in range(LINKCHECK_REDIRECTS + 1):
+                host = urlsplit(final).netloc.lower()
+                hostsem = self.hosts.get(host)
+                if hostsem is None:
+                    hostsem = asyncio.Semaphore(self.per_host)
+                    self.hosts[host] = hostsem
+                # The host first, so that a host with many marks does not
+                # hold the global slots while its own are busy.
+                async with hostsem, self.sem:
+                    code, location = await asyncio.wait_for(
+                        self.request("HEAD", final), self.timeout)
+                    if code in (403, 405, 501):
+                        code, location = await asyncio.wait_for(
+                            self.request("GET", final), self.timeout)
+                if code in REDIRECTS and location:
+                    final = urljoin(final, location)
+                    continue
+                return {"url": url, "status": code, "final": final,
+                        "error": None}
+            error = "too many redirects"
+        except asyncio.TimeoutError:
+            error = "timeout"
+        except ProbeError as e:
+            error = str(e)
+        except (socket.error, ssl.SSLError, ValueError) as e:
+            error = str(e) or e.__class__.__name__
+        return {"url": url, "status": None, "final": final, "error": error}
+
+    # Every result goes to the journal right away, so that an interrupted
+    # pass is not lost, see TagBase.links_load.
+    async def check_one(self, base, index, markname, url):
+        entry = await self.probe(url)
+        entry["checked"] = int(time.time())
+        index[markname] = entry
+        base.links_append(markname, entry)
+
+    async def run(self, base, index, todo):
+        self.sem = asyncio.Semaphore(self.concurrency)
+        self.hosts = {}
+        pending = set()
+        for (markname, url) in todo:
+            # Keep the number of tasks bounded, there may be 100,000 marks.
+            if len(pending) >= self.concurrency * 2:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.add(asyncio.ensure_future(
+                self.check_one(base, index, markname, url)))
+        if pending:
+            await asyncio.wait(pending)
+
+    # One pass over the base. Returns the number of marks probed.
+    def check(self, base):
+        index = base.links_load()
+        now = time.time()
+        todo = []
+        marknames = set()
+        for mark in base:
+            markname = mark.name()
+            marknames.add(markname)
+            if link_stale(index.get(markname), mark.url, now, self.max_age):
+                todo.append((markname, mark.url))
+        # Forget deleted marks.
+        for markname in list(index.keys()):
+            if markname not in marknames:
+                del index[markname]
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.run(base, index, todo))
+        finally:
+            loop.close()
+        base.links_save(index)
+        return len(todo)
+
+
+def Usage():
+    sys.stderr.write("Usage: " + TAG +
+                     " [-a max_age_days] target_dir [target_dir...]\n")
+    sys.exit(2)
+
+def main(args):
+    max_age = LINKCHECK_MAX_AGE
+    if len(args) >= 2 and args[0] == '-a':
+        try:
+            max_age = int(float(args[1]) * 86400)
+        except ValueError:
+            Usage()
+        args = args[2:]
+    if len(args) == 0:
+        Usage()
+    checker = LinkChecker(max_age=max_age)
+    for dirname in args:
+        base = slasti.tagbase.TagBase(dirname)
+        base.open()
+        n = checker.check(base)
+        broken = [e for e in base.links_load().values()
+                  if slasti.tagbase.link_broken(e)]
+        base.close()
+        sys.stdout.write("%s: %s: checked %d, broken %d\n" %
+                         (TAG, dirname, n, len(broken)))
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except AppError as e:
+        sys.stderr.write(TAG + ": " + str(e) + "\n")
+        sys.exit(1)
@@ -7,15 +7,16 @@
 #
 
 import base64
-import bs4
+import collections
 import hashlib
+import json
 import os
+import threading
 import time
 
-from jinja2 import Environment, DictLoader, select_autoescape
+from markupsafe import Markup
 
-from six.moves import http_client
-from six.moves.urllib.parse import quote, urlsplit
+from six.moves.urllib.parse import quote
 
 from slasti import (
    AppError, App400Error, AppLoginError, App404Error, AppGetError,
@@ -27,19 +28,13 @@ PAGESZ = 25
 BLACKSTAR = u"\u2605"     # "&#9733;"
 WHITESTAR = u"\u2606"     # "&#9734;"
 
+# In all cases except the very first mark, we'll return something,
+# even if 1 entry back.
 def page_back(mark):
-    mark = mark.pred()
-    if mark == None:
-        return None
-    # In all other cases, we'll return something, even if 1 entry back.
-    n = 1
-    while n < PAGESZ:
-        m = mark.pred()
-        if m == None:
-            return mark
-        mark = m
-        n += 1
-    return mark
+    return mark.pred(PAGESZ)
+
+def page_next(mark):
+    return mark.succ(PAGESZ)
 
 def page_anchor_href(mark, path):
     if mark == None:
@@ -74,6 +69,114 @@ def findmark(mark_str):
         raise App400Error("bad mark format")
     return (stamp0, stamp1)
 
+#
+# The RenderStream is what we return instead of [result.encode('utf-8')]
+# for pages that may be big. The template is generated piecemeal and the
+# pieces are batched into chunks, so the first bytes go out before the
+# last mark is even read, and we never hold the whole page in memory.
+# It is an iterable and not a generator, so that it can be walked twice
+# (tests do that), as long as the jsondict values can be walked twice too.
+#
+RENDER_CHUNK = 8192
+
+class RenderStream(object):
+    def __init__(self, template, jsondict):
+        self.template = template
+        self.jsondict = jsondict
+
+    def __iter__(self):
+        # The span includes the time to send the chunks, unfortunately.
+        with slasti.trace.span("render." + self.template.name):
+            buf = []
+            buflen = 0
+            for s in self.template.generate(**self.jsondict):
+                buf.append(s)
+                buflen += len(s)
+                if buflen >= RENDER_CHUNK:
+                    yield u''.join(buf).encode('utf-8')
+                    buf = []
+                    buflen = 0
+            if buflen:
+                yield u''.join(buf).encode('utf-8')
+
+#
+# The FragmentCache keeps the HTML of marks as they appear on pages, so
+# a page only renders the marks that changed since they were last shown.
+# A fragment depends on the mark, on the path of the user (the links),
+# and on the login (the edit link). The mtime of the mark only has whole
+# seconds, so the contents are checked too, which is cheap compared to
+# rendering. The key has the directory of the base because one process
+# serves many users.
+#
+FRAGMENT_CACHE_SIZE = 5000
+
+class FragmentCache(object):
+    def __init__(self, size=FRAGMENT_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        # entries: key -> (contents, html), oldest first
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, contents):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != contents:
+                del self.entries[key]
+                return None
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry[1]
+
+    def put(self, key, contents, html):
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            self.entries[key] = (contents, html)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+_fragments = FragmentCache()
+
+def get_fragments():
+    return _fragments
+
+def mark_fragment(ctx, mark, userpath):
+    key = (ctx.base.dirname, mark.stamp0, mark.stamp1, mark.mtime,
+           userpath, bool(ctx.flogin))
+    contents = (mark.title, mark.url, mark.note, tuple(mark.tags))
+    cache = get_fragments()
+    html = cache.get(key, contents)
+    if html is not None:
+        slasti.stats.incr("fragment.hit")
+        return html
+    slasti.stats.incr("fragment.miss")
+    template = ctx.j2env.get_template('mark_fragment.html')
+    html = Markup(template.render(mark=mark.to_jsondict(userpath),
+                                  flogin=ctx.flogin))
+    cache.put(key, contents, html)
+    return html
+
+# The marks of one page, produced lazily for the template, already in HTML.
+class PageMarks(object):
+    def __init__(self, ctx, mark_top, userpath):
+        self.ctx = ctx
+        self.mark_top = mark_top
+        self.userpath = userpath
+
+    def __iter__(self):
+        mark = self.mark_top
+        for n in range(PAGESZ):
+            yield mark_fragment(self.ctx, mark, self.userpath)
+            mark = mark.succ()
+            if mark == None:
+                break
+
 def page_any_html(start_response, ctx, mark_top, headonly=False):
     userpath = ctx.prefix+'/'+ctx.user['name']
 
@@ -87,32 +190,20 @@ def page_any_html(start_response, ctx, mark_top, headonly=False):
         path = userpath
         jsondict['main_text_ext'] = BLACKSTAR
 
-    jsondict["marks"] = []
-
-    mark = mark_top
-    mark_next = None
-    n = 0
-    for n in range(PAGESZ):
-        jsondict["marks"].append(mark.to_jsondict(userpath))
-
-        mark_next = mark.succ()
-        if mark_next == None:
-            break
-        mark = mark_next
+    jsondict["marks"] = PageMarks(ctx, mark_top, userpath)
 
     jsondict.update({
         "page_prev_href": page_anchor_href(page_back(mark_top), path),
         "page_this_href": page_anchor_href(mark_top,            path),
         "page_this_text": BLACKSTAR,
-        "page_next_href": page_anchor_href(mark_next,           path)
+        "page_next_href": page_anchor_href(page_next(mark_top), path)
     })
 
     start_response("200 OK", [('Content-type', 'text/html; charset=utf-8')])
     if headonly:
         return [b'']
     template = ctx.j2env.get_template('page.html')
-    result = template.render(**jsondict)
-    return [result.encode('utf-8')]
+    return RenderStream(template, jsondict)
 
 def page_mark_html(start_response, ctx, stamp0, stamp1):
     mark = ctx.base.lookup(stamp0, stamp1)
@@ -136,6 +227,95 @@ def page_tag_html(start_response, ctx, tag, stamp0, stamp1):
         return page_any_html(start_response, ctx, mark, headonly=True)
     raise AppGetHeadError(ctx.method)
 
+#
+# The JSON views are for the bookmarklet and scripts, so they don't have
+# to scrape HTML. The pages use keyset cursors: an opaque string that names
+# the last mark of the page, and the next page starts right after it,
+# even if that mark was deleted meanwhile. No offsets, no Jinja.
+#
+def cursor_make(mark):
+    if mark == None:
+        return None
+    (stamp0, stamp1) = mark.key()
+    return slasti.to_str(
+        base64.urlsafe_b64encode(('%d.%02d' % (stamp0, stamp1)).encode('ascii')))
+
+def cursor_parse(cursor):
+    try:
+        key_str = base64.urlsafe_b64decode(slasti.safestr(cursor))
+        return findmark(key_str.decode('ascii'))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise App400Error("bad cursor")
+
+def mark_to_json(mark, userpath):
+    jsondict = mark.to_jsondict(userpath)
+    # Drop the internal keys that only templates might care about.
+    for k in list(jsondict.keys()):
+        if k.startswith('_'):
+            del jsondict[k]
+    return jsondict
+
+def json_output(start_response, obj, headonly):
+    start_response("200 OK",
+                   [('Content-type', 'application/json; charset=utf-8')])
+    if headonly:
+        return [b'']
+    return [slasti.safestr(json.dumps(obj, sort_keys=True))]
+
+def page_any_json(start_response, ctx, tag, headonly=False):
+    userpath = ctx.prefix+'/'+ctx.user['name']
+
+    cursor = ctx.get_query_arg("cursor")
+    if cursor:
+        (stamp0, stamp1) = cursor_parse(cursor)
+        if tag:
+            mark = ctx.base.tagseek(tag, stamp0, stamp1)
+        else:
+            mark = ctx.base.seek(stamp0, stamp1)
+    else:
+        if tag:
+            mark = ctx.base.tagfirst(tag)
+            if mark == None:
+                raise App404Error("Tag page not found: "+tag)
+        else:
+            mark = ctx.base.first()
+
+    marks = []
+    last = None
+    while mark != None and len(marks) < PAGESZ:
+        marks.append(mark_to_json(mark, userpath))
+        last = mark
+        mark = mark.succ()
+
+    # The mark is the first one of the next page now, if any.
+    obj = {"tag": tag, "marks": marks,
+           "next": cursor_make(last) if mark != None else None}
+    return json_output(start_response, obj, headonly)
+
+def page_json(start_response, ctx, tag):
+    if ctx.method == 'GET':
+        return page_any_json(start_response, ctx, tag)
+    if ctx.method == 'HEAD':
+        return page_any_json(start_response, ctx, tag, headonly=True)
+    raise AppGetHeadError(ctx.method)
+
+def one_mark_json(start_response, ctx, stamp0, stamp1):
+    if ctx.method != 'GET' and ctx.method != 'HEAD':
+        raise AppGetHeadError(ctx.method)
+    mark = ctx.base.lookup(stamp0, stamp1)
+    if mark == None:
+        raise App404Error("Mark not found: "+str(stamp0)+"."+str(stamp1))
+    userpath = ctx.prefix+'/'+ctx.user['name']
+    obj = {
+        "mark": mark_to_json(mark, userpath),
+        "href_prev": mark_anchor_href(mark.pred(), userpath),
+        "href_next": mark_anchor_href(mark.succ(), userpath),
+    }
+    for k in ("href_prev", "href_next"):
+        if obj[k]:
+            obj[k] += '.json'
+    return json_output(start_response, obj, ctx.method == 'HEAD')
+
 def page_empty_html(start_response, ctx, headonly=False):
     username = ctx.user['name']
     userpath = ctx.prefix+'/'+username
@@ -180,52 +360,6 @@ def delete_post(start_response, ctx):
     result = template.render(**jsondict)
     return [result.encode('utf-8')]
 
-def fetch_parse(chunk):
-    # BeautifulSoup prints a warning about "using the best available HTML
-    # parser for this system" if defaults are used, so we must specify "lxml".
-    soup = bs4.BeautifulSoup(chunk, "lxml")
-    titlestr = soup.head.title.get_text()
-    return titlestr
-
-# XXX This may need switching to urllib yet, if 301 redirects become a problem.
-def fetch_body(url):
-    # XXX Seriously, sanitize url before parsing
-
-    scheme, host, path, u_query, u_frag = urlsplit(url)
-    if scheme != 'http' and scheme != 'https':
-        raise App400Error("bad url scheme")
-
-    headers = {}
-    # XXX Forward the Referer: that we received from the client, if any.
-
-    if scheme == 'http':
-        conn = http_client.HTTPConnection(host, timeout=25)
-    else:
-        conn = http_client.HTTPSConnection(host, timeout=25)
-
-    # Unfortunately, passing a scheme of None blows up in py3 when coercing
-    # the arguments of urlunsplit(): None is mistaken for bytes (not an str).
-    # fullpath = urlunsplit((None, None, path, u_query, None))
-    fullpath = path + '?' + u_query if u_query else path
-
-    conn.request("GET", fullpath, None, headers)
-    response = conn.getresponse()
-    # XXX A different return code for 201 and 204?
-    if response.status != 200:
-        raise App400Error("target error %d" % response.status)
-
-    typeval = response.getheader("Content-Type")
-    if typeval == None:
-        raise App400Error("target no type")
-    typestr = typeval.split(";")
-    if len(typestr) == 0:
-        raise App400Error("target type none")
-    if typestr[0] != 'text/html':
-        raise App400Error("target type %s" % typestr[0])
-
-    body = response.read(10000)
-    return body
-
 #
 # The server-side indirection requires extreme care to prevent abuse.
 # User may hit us with URLs that point to generated pages, slow servers, etc.
@@ -236,9 +370,13 @@ def fetch_get(start_response, ctx):
     url = ctx.get_query_arg("url")
     if not url:
         raise App400Error("no query")
-    body = fetch_body(url)
-    title = fetch_parse(body)
+    if ctx.defer_fetch:
+        raise slasti.TitlePending(url)
+    # Only here we need the fetch, which needs http.client, ssl and more.
+    from slasti import fetch
+    return title_output(start_response, fetch.fetch_title(url))
 
+def title_output(start_response, title):
     output = [b'%s\r\n' % slasti.safestr(title)]
     start_response("200 OK", [('Content-type', 'text/plain')])
     return output
@@ -342,13 +480,153 @@ class MarkDumper(object):
         finally:
             self.base.close()
 
+#
+# The incremental export lists marks stored after a given time, newest last,
+# and tombstones for marks deleted after it. Unlike the full export, posts
+# carry our key and mtime, so that a mirror knows what to replace.
+#
+class ChangeDumper(object):
+    def __init__(self, base, user, since):
+        self.username = user['name']
+        self.base = slasti.tagbase.TagBase(base.dirname)
+        self.since = since
+
+    def __iter__(self):
+        self.base.open()
+        try:
+            yield b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            yield b'<posts user="' + slasti.safestr(self.username) + \
+                  b'" tag="" since="' + b'%d' % self.since + b'">\n'
+            for (mtime, markname, op) in self.base.changed_since(self.since):
+                mark = None
+                if op == '+':
+                    mark = self.base.lookup_file(markname)
+                if mark is not None:
+                    yield slasti.safestr(mark.xml(stamped=True))
+                else:
+                    (stamp0, stamp1) = slasti.tagbase.name_key(markname)
+                    yield b'  <deleted key="%d.%02d" mtime="%d" />\n' % (
+                        stamp0, stamp1, mtime)
+            yield b'</posts>\n'
+        finally:
+            self.base.close()
+
+def since_mark_xml(start_response, ctx, since_str):
+    try:
+        since = float(since_str)
+    except ValueError:
+        raise App400Error("bad since")
+    response_headers = [('Content-type', 'text/xml; charset=utf-8')]
+    start_response("200 OK", response_headers)
+    return ChangeDumper(ctx.base, ctx.user, since)
+
+#
+# The change log for followers, as JSON, one record per line.
+#
+CHANGES_LIMIT = 1000
+
+class ChangeStream(object):
+    def __init__(self, base, after, limit, resume):
+        self.base = slasti.tagbase.TagBase(base.dirname)
+        self.after = after
+        self.limit = limit
+        self.resume = resume
+
+    def __iter__(self):
+        self.base.open()
+        try:
+            for record in self.base.changes_after(self.after, self.limit,
+                                                  self.resume):
+                yield slasti.safestr(json.dumps(record, sort_keys=True)) + \
+                      b'\n'
+        finally:
+            self.base.close()
+
+def changes_get(start_response, ctx):
+    try:
+        after = int(ctx.get_query_arg("after") or "0")
+        limit = int(ctx.get_query_arg("limit") or CHANGES_LIMIT)
+    except ValueError:
+        raise App400Error("bad after or limit")
+    if limit <= 0:
+        raise App400Error("bad limit")
+    resume = ctx.get_query_arg("resume") or None
+    response_headers = [('Content-type', 'application/json; charset=utf-8')]
+    start_response("200 OK", response_headers)
+    return ChangeStream(ctx.base, after, limit, resume)
+
+def changes(start_response, ctx):
+    if ctx.method == 'GET':
+        return changes_get(start_response, ctx)
+    raise AppGetError(ctx.method)
+
 # full_mark_html() would be a Netscape bookmarks file, perhaps.
 def full_mark_xml(start_response, ctx):
     if ctx.method != 'GET':
         raise AppGetError(ctx.method)
+
+    since_str = ctx.get_query_arg("since")
+    if since_str:
+        return since_mark_xml(start_response, ctx, since_str)
+
+    gz = slasti.export.accepts_gzip(ctx.get_header('Accept-Encoding'))
+    (snap, f) = slasti.export.open_snapshot(
+        ctx.base, lambda: MarkDumper(ctx.base, ctx.user), gz)
+    etag = snap.etag(gz)
+
     response_headers = [('Content-type', 'text/xml; charset=utf-8')]
-    start_response("200 OK", response_headers)
-    return MarkDumper(ctx.base, ctx.user)
+    response_headers.append(('ETag', etag))
+    response_headers.append(('Vary', 'Accept-Encoding'))
+    if gz:
+        response_headers.append(('Content-Encoding', 'gzip'))
+
+    if slasti.export.etag_match(ctx.get_header('If-None-Match'), etag):
+        f.close()
+        start_response("304 Not Modified", response_headers)
+        return [b'']
+
+    size = os.fstat(f.fileno()).st_size
+    response_headers.append(('Accept-Ranges', 'bytes'))
+
+    # A stale If-Range means the client's piece is of another generation.
+    brange = None
+    if_range = ctx.get_header('If-Range')
+    if not if_range or if_range.strip() == etag:
+        brange = slasti.export.parse_range(ctx.get_header('Range'), size)
+
+    if brange is None:
+        response_headers.append(('Content-Length', str(size)))
+        start_response("200 OK", response_headers)
+        return slasti.export.file_iter(f, size)
+
+    (start, end) = brange
+    if start is None:
+        f.close()
+        response_headers.append(('Content-Range', 'bytes */%d' % size))
+        start_response("416 Range Not Satisfiable", response_headers)
+        return [b'']
+
+    f.seek(start)
+    response_headers.append(('Content-Length', str(end - start + 1)))
+    response_headers.append(('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size)))
+    start_response("206 Partial Content", response_headers)
+    return slasti.export.file_iter(f, end - start + 1)
+
+# All tags with their counts, produced lazily for the template.
+class TagList(object):
+    def __init__(self, base, userpath):
+        self.base = base
+        self.userpath = userpath
+
+    def __iter__(self):
+        for tag in self.base.tagcurs():
+            ref = tag.key()
+            yield {"href_tag": '%s/%s/' % (self.userpath,
+                                           slasti.escapeURLComponent(ref)),
+                   "name_tag": ref,
+                   "num_tagged": tag.num(),
+                  }
 
 def full_tag_html(start_response, ctx):
     if ctx.method == 'HEAD':
@@ -363,17 +641,63 @@ def full_tag_html(start_response, ctx):
     start_response("200 OK", [('Content-type', 'text/html; charset=utf-8')])
     jsondict = ctx.create_jsondict()
     jsondict['main_text_ext'] = 'tags'
-    jsondict["tags"] = []
-    for tag in ctx.base.tagcurs():
-        ref = tag.key()
-        jsondict["tags"].append(
-            {"href_tag": '%s/%s/' % (userpath, slasti.escapeURLComponent(ref)),
-             "name_tag": ref,
-             "num_tagged": tag.num(),
-            })
+    jsondict["tags"] = TagList(ctx.base, userpath)
     template = ctx.j2env.get_template('tags.html')
-    result = template.render(**jsondict)
-    return [result.encode('utf-8')]
+    return RenderStream(template, jsondict)
+
+# The marks that the link checker found broken, newest first.
+class BrokenMarks(object):
+    def __init__(self, base, userpath):
+        self.base = base
+        self.userpath = userpath
+
+    def __iter__(self):
+        index = self.base.links_load()
+        for markname in sorted(index.keys(), reverse=True):
+            entry = index[markname]
+            if not slasti.tagbase.link_broken(entry):
+                continue
+            mark = self.base.lookup_file(markname)
+            # The index may lag behind edits and deletions.
+            if mark is None or mark.url != entry.get("url"):
+                continue
+            jsondict = mark.to_jsondict(self.userpath)
+            if entry.get("status") is None:
+                jsondict["link_status"] = entry.get("error") or "error"
+            else:
+                jsondict["link_status"] = "%d" % entry["status"]
+            jsondict["link_checked"] = time.strftime("%Y-%m-%d",
+                time.gmtime(entry.get("checked", 0)))
+            yield jsondict
+
+def broken_html(start_response, ctx):
+    if ctx.method != 'GET':
+        raise AppGetError(ctx.method)
+
+    userpath = ctx.prefix + '/' + ctx.user['name']
+    start_response("200 OK", [('Content-type', 'text/html; charset=utf-8')])
+    jsondict = ctx.create_jsondict()
+    jsondict['main_text_ext'] = 'broken'
+    jsondict["marks"] = BrokenMarks(ctx.base, userpath)
+    template = ctx.j2env.get_template('broken.html')
+    return RenderStream(template, jsondict)
+
+# The statistics are of the whole process, not of the user's base,
+# but we only show them to someone logged in.
+def stats(start_response, ctx):
+    if ctx.method != 'GET':
+        raise AppGetError(ctx.method)
+    snap = slasti.stats.get_stats().snapshot()
+    if ctx.path == "stats.json":
+        return json_output(start_response, snap, False)
+    start_response("200 OK", [('Content-type', 'text/plain; charset=utf-8')])
+    return [slasti.stats.text_report(snap).encode('utf-8')]
+
+# Like the statistics, the traces are of all requests to the process.
+def trace_json(start_response, ctx):
+    if ctx.method != 'GET':
+        raise AppGetError(ctx.method)
+    return json_output(start_response, slasti.trace.chrome_trace(), False)
 
 def login_form(start_response, ctx):
     username = ctx.user['name']
@@ -553,6 +877,9 @@ def edit_post(start_response, ctx):
                            argd['title'], argd['href'], argd['extra'], tags)
     if stamp1 < 0:
         raise App404Error("Out of fix: %d" % stamp0)
+    if not argd['title']:
+        # The base queued the mark, so the title comes later.
+        slasti.backfill.kick(ctx.base.dirname)
 
     redihref = slasti.to_str('%s/mark.%d.%02d' % (userpath, stamp0, stamp1))
 
@@ -601,12 +928,43 @@ def redirect_to_login(start_response, ctx):
     result = template.render(**jsondict)
     return [result.encode('utf-8')]
 
+#
+# One jinja2 Environment serves all requests, and keeps the templates that
+# it compiled. Importing jinja2 is a good part of our start-up, so it waits
+# until the first page, or until preload() of slasti/wsgi.py. Since the
+# templates never change, jinja2 needs not check them on every use.
+#
+_j2env = None
+_j2env_lock = threading.Lock()
+
+def get_j2env():
+    global _j2env
+    with _j2env_lock:
+        if _j2env is None:
+            from jinja2 import Environment, DictLoader, select_autoescape
+            _j2env = Environment(loader=DictLoader(templates),
+                autoescape=select_autoescape(['html', 'xml']),
+                auto_reload=False)
+        return _j2env
+
+# Compile all templates now rather than in the first requests.
+def preload_templates():
+    j2env = get_j2env()
+    for name in sorted(templates.keys()):
+        j2env.get_template(name)
+
 #
 # Request paths:
 #   ''                  -- default index (page.XXXX.XX)
 #   page.1296951840.00  -- page off this down
 #   mark.1296951840.00
-#   export.xml          -- del-compatible XML
+#   mark.1296951840.00.json -- the same as JSON
+#   page.json           -- GET with ?cursor=, JSON pages
+#   export.xml          -- del-compatible XML, ?since=1296951840 for changes
+#   changes             -- GET with ?after=N, change log for followers
+#   broken              -- marks with dead links, as found by slasti.linkcheck
+#   stats               -- performance statistics of the process, stats.json
+#   trace.json          -- recent traces of the process, if tracing is on
 #   new                 -- GET for the form
 #   edit                -- PUT or POST here, GET may have ?query
 #   delete              -- POST
@@ -614,13 +972,13 @@ def redirect_to_login(start_response, ctx):
 #   login               -- GET or POST to obtain a cookie (not snoop-proof)
 #   anime/              -- tag (must have slash)
 #   anime/page.1293667202.11  -- tag page off this down
+#   anime/page.json     -- JSON tag pages, ?cursor= as above
 #   moo.xml/            -- tricky tag
 #   page.1293667202.11/ -- even trickier tag
 #
-def app(start_response, ctx):
+def app_route(start_response, ctx):
     ctx.flogin = login_verify(ctx)
-    ctx.j2env = Environment(loader=DictLoader(templates),
-        autoescape=select_autoescape(['html', 'xml']))
+    ctx.j2env = get_j2env()
 
     if ctx.path == "login":
         return login(start_response, ctx)
@@ -648,6 +1006,24 @@ def app(start_response, ctx):
         return full_mark_xml(start_response, ctx)
     if ctx.path == "tags":
         return full_tag_html(start_response, ctx)
+    if ctx.path == "changes":
+        if ctx.flogin == 0:
+            raise AppLoginError()
+        return changes(start_response, ctx)
+    if ctx.path == "broken":
+        if ctx.flogin == 0:
+            return redirect_to_login(start_response, ctx)
+        return broken_html(start_response, ctx)
+    if ctx.path == "page.json":
+        return page_json(start_response, ctx, None)
+    if ctx.path == "stats" or ctx.path == "stats.json":
+        if ctx.flogin == 0:
+            raise AppLoginError()
+        return stats(start_response, ctx)
+    if ctx.path == "trace.json":
+        if ctx.flogin == 0:
+            raise AppLoginError()
+        return trace_json(start_response, ctx)
     if "/" in ctx.path:
         # Trick: by splitting with limit 2 we prevent users from poisoning
         # the tag with slashes. Not that it matters all that much, but still.
@@ -656,6 +1032,8 @@ def app(start_response, ctx):
         page = p[1]
         if page == "":
             return root_tag_html(start_response, ctx, tag)
+        if page == "page.json":
+            return page_json(start_response, ctx, tag)
         p = page.split(".")
         if len(p) != 3:
             raise App404Error("Not found: "+ctx.path)
@@ -669,6 +1047,13 @@ def app(start_response, ctx):
         raise App404Error("Not found: "+ctx.path)
     else:
         p = ctx.path.split(".")
+        if len(p) == 4 and p[0] == "mark" and p[3] == "json":
+            try:
+                stamp0 = int(p[1])
+                stamp1 = int(p[2])
+            except ValueError:
+                raise App404Error("Not found: "+ctx.path)
+            return one_mark_json(start_response, ctx, stamp0, stamp1)
         if len(p) != 3:
             raise App404Error("Not found: "+ctx.path)
         try:
@@ -682,6 +1067,51 @@ def app(start_response, ctx):
             return page_mark_html(start_response, ctx, stamp0, stamp1)
         raise App404Error("Not found: "+ctx.path)
 
+# The paths that are their own routes for the statistics. The rest are
+# lumped by kind, or else every mark would get a histogram of its own.
+ROUTES = ("login", "new", "edit", "delete", "fetchtitle", "export.xml",
+          "tags", "changes", "broken", "page.json", "stats", "stats.json",
+          "trace.json")
+
+def route_name(path):
+    if path == "":
+        return "root"
+    if path in ROUTES:
+        return path
+    if "/" in path:
+        page = path.split("/", 2)[1]
+        if page == "":
+            return "tag"
+        if page == "page.json":
+            return "tag/page.json"
+        if page.startswith("page."):
+            return "tag/page"
+        return "other"
+    p = path.split(".")
+    if len(p) == 3 and p[0] in ("mark", "page"):
+        return p[0]
+    if len(p) == 4 and p[0] == "mark" and p[3] == "json":
+        return "mark.json"
+    return "other"
+
+def app(start_response, ctx):
+    st = slasti.stats.get_stats()
+    route = route_name(ctx.path)
+    t0 = time.time()
+    st.request_begin()
+    root = slasti.trace.begin("request." + route, path=ctx.path,
+                              method=ctx.method)
+    try:
+        output = app_route(start_response, ctx)
+    except Exception as e:
+        if not isinstance(e, slasti.TitlePending):
+            st.incr("errors")
+        st.request_end(route, time.time() - t0)
+        slasti.trace.end(root)
+        raise
+    return slasti.stats.TimedOutput(st, output, route, t0,
+                                    lambda: slasti.trace.end(root))
+
 template_header = \
 """
 <html>
@@ -761,7 +1191,13 @@ template_page = \
 """
     {% include 'header.html' %}
     {% include 'body_top.html' %}
-    {% for mark in marks %}
+    {% for mark in marks %}{{ mark }}{% endfor %}
+    {% include 'body_bottom.html' %}
+"""
+
+# One mark of template_page, see FragmentCache.
+template_mark_fragment = \
+"""
       <p>{{ mark.date }} [<a href="{{ mark.href_mark }}">&#9734;</a>]
        {% if flogin %}
          [<a href="{{ mark.href_edit }}">&#128393;</a>]
@@ -775,8 +1211,6 @@ template_page = \
          <a href="{{ tag.href_tag }}">{{ tag.name_tag }}</a>
        {% endfor %}
       </p>
-    {% endfor %}
-    {% include 'body_bottom.html' %}
 """
 
 template_empty = \
@@ -819,6 +1253,21 @@ template_tags = \
 </body></html>
 """
 
+template_broken = \
+"""
+{% include 'header.html' %}
+{% include 'body_top.html' %}
+{% for mark in marks %}
+  <p>{{ mark.date }} [<a href="{{ mark.href_mark }}">&#9734;</a>]
+     [<a href="{{ mark.href_edit }}">&#128393;</a>]
+     <a href="{{ mark.href_mark_url }}">{{ mark.title }}</a>
+     <br />{{ mark.link_status }} as of {{ mark.link_checked }}
+  </p>
+{% endfor %}
+<hr />
+</body></html>
+"""
+
 template_delete = \
 """
 {% include 'header.html' %}
@@ -910,6 +1359,7 @@ template_simple_output = """{{ output }}"""
 templates = {
     'body_bottom.html': template_body_bottom,
     'body_top.html': template_body_top,
+    'broken.html': template_broken,
     'delete.html': template_delete,
     'editform.html': template_editform,
     'empty.html': template_empty,
@@ -917,6 +1367,7 @@ templates = {
     'login.html': template_login,
     'mark.html': template_mark,
     'page.html': template_page,
+    'mark_fragment.html': template_mark_fragment,
     'redirect.html': template_redirect,
     'simple.txt': template_simple_output,
     'tags.html': template_tags
@@ -0,0 +1,249 @@
+#
+# Slasti -- Profiling of requests and the slow request log
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Both are off unless configured in the environ, e.g. with Apache:
+#
+#  SetEnv slasti.profile.dir /var/tmp/slasti-prof
+#  SetEnv slasti.profile.sample 1          # percent of requests
+#  SetEnv slasti.profile on                # or all of them, while debugging
+#  SetEnv slasti.slowlog /var/log/slasti/slow.log
+#  SetEnv slasti.slowlog.threshold 0.5     # seconds, 1 if not set
+#
+# A profiled request runs under cProfile, and its stats are written to
+# the directory, in a file named after the time, the user, the route,
+# and the wall time of the request. Look at them with python -m pstats.
+#
+# The slow log is one JSON line per request that took longer than the
+# threshold. Since we do not know that a request is going to be slow until
+# it is, we cannot profile it with cProfile just in case (that makes every
+# request twice slower). Instead, a sampler thread looks at the stacks of
+# requests in flight every SAMPLE_INTERVAL, and the functions seen most
+# often make the "top" of the record. A sample costs some microseconds.
+#
+
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import slasti
+
+SAMPLE_INTERVAL = 0.005
+SLOW_THRESHOLD = 1.0
+SLOW_TOP = 10
+
+
+class Config(object):
+    def __init__(self, environ):
+        self.profdir = environ.get('slasti.profile.dir')
+        self.always = environ.get('slasti.profile', '').lower() in \
+                      ('1', 'on', 'yes', 'true')
+        try:
+            self.sample = float(environ.get('slasti.profile.sample', 0))
+        except ValueError:
+            self.sample = 0.0
+        self.slowlog = environ.get('slasti.slowlog')
+        try:
+            self.threshold = float(environ.get('slasti.slowlog.threshold',
+                                               SLOW_THRESHOLD))
+        except ValueError:
+            self.threshold = SLOW_THRESHOLD
+
+    def want_profile(self):
+        if not self.profdir:
+            return False
+        if self.always:
+            return True
+        return self.sample > 0 and random.random() * 100 < self.sample
+
+
+#
+# The Sampler keeps a tally of the functions on the stack of every thread
+# that registered with it, while it is registered.
+#
+class Tally(object):
+    def __init__(self):
+        self.samples = 0
+        # own: function -> samples where it was running itself
+        self.own = {}
+        # cum: function -> samples where it was on the stack at all
+        self.cum = {}
+
+    def add(self, frame):
+        self.samples += 1
+        seen = set()
+        leaf = True
+        while frame is not None:
+            code = frame.f_code
+            func = "%s:%d(%s)" % (code.co_filename, code.co_firstlineno,
+                                  code.co_name)
+            if leaf:
+                self.own[func] = self.own.get(func, 0) + 1
+                leaf = False
+            if func not in seen:
+                seen.add(func)
+                self.cum[func] = self.cum.get(func, 0) + 1
+            frame = frame.f_back
+
+    def top(self, n):
+        funcs = sorted(self.cum.keys(),
+                       key=lambda f: (-self.own.get(f, 0), -self.cum[f], f))
+        return [[f, self.own.get(f, 0), self.cum[f]] for f in funcs[:n]]
+
+class Sampler(object):
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # tallies: thread ident -> Tally
+        self.tallies = {}
+        self.thread = None
+
+    def register(self):
+        tally = Tally()
+        with self.lock:
+            self.tallies[threading.current_thread().ident] = tally
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name="slasti-sampler")
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+        return tally
+
+    def unregister(self):
+        with self.lock:
+            self.tallies.pop(threading.current_thread().ident, None)
+
+    # The tallies are added to under the lock, so that once a thread has
+    # unregistered, its tally does not change anymore.
+    def run(self):
+        while True:
+            with self.lock:
+                idle = not self.tallies
+                if not idle:
+                    frames = sys._current_frames()
+                    for (ident, tally) in self.tallies.items():
+                        frame = frames.get(ident)
+                        if frame is not None:
+                            tally.add(frame)
+                    del frames
+            if idle:
+                self.wakeup.wait()
+                self.wakeup.clear()
+            else:
+                time.sleep(self.interval)
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+def get_sampler():
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = Sampler()
+    return _sampler
+
+
+def profile_name(profdir, t0, user, route, wall):
+    return "%s/%d.%06d.%d.%s.%s.%dms.pstats" % (
+        profdir, int(t0), int((t0 % 1) * 1000000), os.getpid(),
+        user, route.replace("/", "_"), int(wall * 1000))
+
+def slowlog_write(logname, record):
+    line = json.dumps(record, sort_keys=True) + "\n"
+    # One write of a line to a file in append mode does not interleave
+    # with other processes doing the same, at least on local filesystems.
+    fd = os.open(logname, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+# The output of an unprofiled request that goes to the slow log if the
+# server took too long with it, counting the time to send it.
+class SlowOutput(object):
+    def __init__(self, output, finish):
+        self.output = output
+        self.finish = finish
+        self.done = False
+
+    def __iter__(self):
+        for chunk in self.output:
+            yield chunk
+        self.close()
+
+    def close(self):
+        if not self.done:
+            self.done = True
+            if hasattr(self.output, "close"):
+                self.output.close()
+            self.finish()
+
+
+# Run slasti.main.app for the request, profiled and slow-logged as the
+# environ says. A profiled request is rendered in full before we return
+# it, so that the profile includes the rendering.
+def run(environ, start_response, ctx):
+    conf = Config(environ)
+    profiled = conf.want_profile()
+    if not profiled and not conf.slowlog:
+        return slasti.main.app(start_response, ctx)
+
+    route = slasti.main.route_name(ctx.path)
+    user = ctx.user['name']
+    prof = cProfile.Profile() if profiled else None
+    tally = get_sampler().register() if conf.slowlog else None
+    t0 = time.time()
+
+    def finish():
+        wall = time.time() - t0
+        if tally is not None:
+            get_sampler().unregister()
+        # Failing to write these is no reason to fail the request.
+        profname = None
+        try:
+            if prof is not None:
+                profname = profile_name(conf.profdir, t0, user, route, wall)
+                prof.dump_stats(profname)
+            if tally is not None and wall >= conf.threshold:
+                slowlog_write(conf.slowlog, {
+                    "time": int(t0),
+                    "pid": os.getpid(),
+                    "user": user,
+                    "route": route,
+                    "method": ctx.method,
+                    "path": ctx.path,
+                    "wall": round(wall, 6),
+                    "samples": tally.samples,
+                    "top": tally.top(SLOW_TOP),
+                    "profile": profname,
+                })
+        except (IOError, OSError) as e:
+            sys.stderr.write("slasti: profiling: %s\n" % str(e))
+
+    if prof is None:
+        try:
+            output = slasti.main.app(start_response, ctx)
+        except Exception:
+            finish()
+            raise
+        return SlowOutput(output, finish)
+
+    prof.enable()
+    try:
+        output = slasti.main.app(start_response, ctx)
+        chunks = list(output)
+        if hasattr(output, "close"):
+            output.close()
+    finally:
+        prof.disable()
+        finish()
+    return chunks
@@ -0,0 +1,265 @@
+#
+# Slasti -- Static pages for anonymous readers
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: python -m slasti.render [-p prefix] user target_dir output_dir
+#
+# Renders what an anonymous reader sees into output_dir/user/, with the
+# views and templates of slasti.main, so that the web server can send the
+# files without calling Python: the front page (index.html), the pages
+# that the front page links to in a chain (page.stamp.fix), every mark
+# (mark.stamp.fix), the first page and the chain of pages of every tag
+# (tag/index.html and tag/page.stamp.fix), and the list of tags (tags).
+# The prefix is where the application is mounted, as in the links.
+#
+# A page can start at any mark, but only the ones in the chains are linked,
+# so only those are rendered. Anything else, including logged-in users and
+# pages that links from elsewhere reference after marks were added, goes
+# to the application; see INSTALL for how to set up the web server.
+#
+# Every page is rendered from a few inputs: its marks, the links to its
+# neighbours, and the templates. A hash of them is kept for every file in
+# output_dir/user/.manifest, and a page whose hash did not change is not
+# rendered again, so running this after every edit, or from cron, only
+# rewrites the pages where something changed. Files of pages that are no
+# longer there are removed.
+#
+
+import hashlib
+import json
+import os
+import sys
+
+import slasti
+from slasti import AppError
+
+TAG = "slasti.render"
+
+MANIFEST = ".manifest"
+# Tags that cannot be directories next to our files. Their pages are left
+# to the application, and so are tags that would be hidden files or would
+# not be one directory under output_dir/user/ (tags are split on spaces
+# only, so a tag may well be "x/../../y").
+RESERVED = ("index.html", "tags", MANIFEST)
+UNSAFE = ("/", "\\", "..", "\0")
+
+def tag_rendered(tag):
+    if tag in RESERVED or tag.startswith("."):
+        return False
+    for s in UNSAFE:
+        if s in tag:
+            return False
+    return True
+
+
+def mark_inputs(mark):
+    (stamp0, stamp1) = mark.key()
+    return ["%d.%02d" % (stamp0, stamp1), mark.mtime, mark.title, mark.url,
+            mark.note, mark.tags]
+
+def mark_name(mark):
+    if mark is None:
+        return None
+    (stamp0, stamp1) = mark.key()
+    return "%d.%02d" % (stamp0, stamp1)
+
+def templates_hash():
+    h = hashlib.sha1()
+    for name in sorted(slasti.main.templates.keys()):
+        h.update(name.encode('utf-8'))
+        h.update(slasti.main.templates[name].encode('utf-8'))
+    return h.hexdigest()
+
+def write_file(fname, body):
+    dirname = os.path.dirname(fname)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    # The web server may be sending the old file right now.
+    tmpname = fname + ".%d.tmp" % os.getpid()
+    with open(tmpname, "wb") as f:
+        f.write(body)
+    os.rename(tmpname, fname)
+
+
+class Renderer(object):
+    def __init__(self, base, user, outdir, prefix=""):
+        self.base = base
+        self.user = user
+        self.prefix = prefix
+        self.userdir = os.path.join(outdir, user)
+        self.ctx = slasti.Context(prefix, {"name": user}, base,
+                                  'GET', 'http', 'localhost', "",
+                                  None, None, None, None)
+        self.ctx.j2env = slasti.main.get_j2env()
+        self.version = templates_hash()
+        self.old = {}
+        self.new = {}
+        self.written = 0
+        self.kept = 0
+        self.removed = 0
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.userdir, MANIFEST)) as f:
+                self.old = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.old = {}
+
+    # Whatever the manifest or the tags say, we only touch our own files.
+    def inside(self, fname):
+        top = os.path.realpath(self.userdir)
+        return os.path.realpath(fname).startswith(top + os.sep)
+
+    def save_manifest(self):
+        write_file(os.path.join(self.userdir, MANIFEST),
+                   json.dumps(self.new, sort_keys=True).encode('utf-8'))
+
+    # Render the page at ctxpath into relpath, unless its inputs are
+    # the same as the last time. The view is called like by app_route.
+    def emit(self, relpath, ctxpath, inputs, view, *args):
+        sig = hashlib.sha1(json.dumps(
+            [self.version, self.prefix, self.user, ctxpath, inputs],
+            sort_keys=True).encode('utf-8')).hexdigest()
+        self.new[relpath] = sig
+        fname = os.path.join(self.userdir, relpath)
+        if self.old.get(relpath) == sig and os.path.exists(fname):
+            self.kept += 1
+            return
+        status_ = [None]
+        def start_response(status, headers):
+            status_[0] = status
+        if not self.inside(fname):
+            raise AppError("%s: outside of %s" % (relpath, self.userdir))
+        self.ctx.path = ctxpath
+        output = view(start_response, self.ctx, *args)
+        body = b''.join(output)
+        if not status_[0].startswith("200 "):
+            raise AppError("%s: %s" % (ctxpath, status_[0]))
+        write_file(fname, body)
+        self.written += 1
+
+    # Walk a list of marks from the first one, rendering its chain of pages,
+    # and also the pages of its marks if it is the list of all marks.
+    # Pages are rendered when the next one is known, as the links need it.
+    def walk(self, first, tag):
+        tops = []
+        page = []
+        prev = None
+        prev_pred = None
+        mark = first
+        n = 0
+        while mark is not None:
+            if n % slasti.main.PAGESZ == 0:
+                if tops:
+                    self.emit_page(tag, tops, page, mark)
+                tops = tops[-1:] + [mark]
+                page = []
+            page.append(mark_inputs(mark))
+            if tag is None:
+                if prev is not None:
+                    self.emit_mark(prev, prev_pred, mark)
+                    prev_pred = mark_name(prev)
+                prev = mark
+            mark = mark.succ()
+            n += 1
+        if tops:
+            self.emit_page(tag, tops, page, None)
+        if prev is not None:
+            self.emit_mark(prev, prev_pred, None)
+
+    # The page of tops[-1], the one before it being tops[-2] if any.
+    def emit_page(self, tag, tops, page, next_top):
+        top = tops[-1]
+        inputs = [page, mark_name(tops[-2]) if len(tops) > 1 else None,
+                  mark_name(next_top)]
+        name = "page." + mark_name(top)
+        if tag is None:
+            if len(tops) == 1:
+                self.emit("index.html", "", inputs,
+                          slasti.main.page_any_html, top)
+            self.emit(name, name, inputs, slasti.main.page_any_html, top)
+        else:
+            if len(tops) == 1:
+                self.emit(os.path.join(tag, "index.html"), tag + "/",
+                          inputs, slasti.main.page_any_html, top)
+            self.emit(os.path.join(tag, name), tag + "/" + name, inputs,
+                      slasti.main.page_any_html, top)
+
+    def emit_mark(self, mark, pred_name, succ):
+        name = "mark." + mark_name(mark)
+        inputs = [mark_inputs(mark), pred_name, mark_name(succ)]
+        self.emit(name, name, inputs, slasti.main.mark_get, mark)
+
+    def remove_old(self):
+        for relpath in self.old:
+            if relpath in self.new:
+                continue
+            fname = os.path.join(self.userdir, relpath)
+            if not self.inside(fname):
+                continue
+            try:
+                os.unlink(fname)
+                self.removed += 1
+            except OSError:
+                pass
+            dirname = os.path.dirname(fname)
+            if dirname != self.userdir:
+                try:
+                    os.rmdir(dirname)
+                except OSError:
+                    # Not empty yet.
+                    pass
+
+    # Returns the number of pages (re)written.
+    def run(self):
+        self.load_manifest()
+        self.new = {}
+
+        first = self.base.first()
+        if first is None:
+            self.emit("index.html", "", [], slasti.main.page_empty_html)
+        else:
+            self.walk(first, None)
+
+        tags = []
+        for tag in self.base.tagcurs():
+            tags.append([tag.key(), tag.num()])
+        self.emit("tags", "tags", tags, slasti.main.full_tag_html)
+        for (tag, num) in tags:
+            if not tag_rendered(tag):
+                continue
+            self.walk(self.base.tagfirst(tag), tag)
+
+        self.remove_old()
+        self.save_manifest()
+        return self.written
+
+
+def Usage():
+    sys.stderr.write("Usage: " + TAG +
+                     " [-p prefix] user target_dir output_dir\n")
+    sys.exit(2)
+
+def main(args):
+    prefix = ""
+    if len(args) >= 2 and args[0] == '-p':
+        prefix = args[1].rstrip('/')
+        args = args[2:]
+    if len(args) != 3:
+        Usage()
+    base = slasti.tagbase.TagBase(args[1])
+    base.open()
+    renderer = Renderer(base, args[0], args[2], prefix)
+    renderer.run()
+    base.close()
+    sys.stdout.write("%s: %d written, %d unchanged, %d removed\n" %
+                     (TAG, renderer.written, renderer.kept, renderer.removed))
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except AppError as e:
+        sys.stderr.write(TAG + ": " + str(e) + "\n")
+        sys.exit(1)
@@ -0,0 +1,486 @@
+#
+# Slasti -- A server of our own
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Usage: python -m slasti.serve [-b host:port] [-w workers] [-t threads]
+#                               userconf
+#
+# Serves the WSGI application of slasti/wsgi.py over HTTP/1.1, for small
+# boxes without Apache and for benchmarks. The master process loads the
+# application, warms it up by rendering the front page of every user, and
+# then forks the workers, which share what was loaded. Every worker serves
+# up to SERVE_THREADS connections at a time, with keep-alive: responses
+# of unknown length, like our pages that are sent while generated, go
+# chunked. A connection idle for SERVE_KEEPALIVE seconds is closed.
+#
+# Where the system has SO_REUSEPORT, every worker listens on a socket of
+# its own and the kernel spreads the connections among them; otherwise the
+# workers accept from one socket that the master opened. SIGHUP starts new
+# workers and tells the old ones to finish what they have and exit, e.g.
+# after an update of Slasti (the master itself is not reloaded, so that
+# needs a restart anyway if the master's copy matters). SIGTERM or SIGINT
+# stops it all the same way. A worker that dies is replaced.
+#
+# Put it behind a proxy for SSL. Nothing of the request is trusted to be
+# anything more than what it says, like under mod_wsgi.
+#
+
+import errno
+import io
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from concurrent import futures
+
+import six
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import unquote
+
+import slasti
+import slasti.wsgi
+from slasti import AppError
+
+TAG = "slasti.serve"
+
+SERVE_ADDRESS = "127.0.0.1:8080"
+SERVE_THREADS = 8
+SERVE_KEEPALIVE = 5
+SERVE_BACKLOG = 128
+# Seconds that an old worker has to finish its requests before it is gone.
+SERVE_GRACE = 30
+# A worker that dies sooner than this after its start is not replaced
+# right away, or a broken setup would fork as fast as it can.
+SERVE_RESPAWN_DELAY = 1.0
+SERVE_START_TIMEOUT = 10
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "Slasti"
+    # The socket timeout, which is also how long we keep an idle connection.
+    timeout = SERVE_KEEPALIVE
+
+    def do_request(self):
+        if '?' in self.path:
+            (path, query) = self.path.split('?', 1)
+        else:
+            (path, query) = (self.path, '')
+        # The WSGI way: unquoted bytes of the path, in a str.
+        if six.PY2:
+            path = unquote(path)
+        else:
+            path = unquote(path, encoding='latin-1')
+
+        try:
+            clen = int(self.headers.get('Content-Length', '0'))
+        except ValueError:
+            self.send_error(400)
+            return
+        body = self.rfile.read(clen) if clen > 0 else b''
+
+        environ = dict(self.server.environ)
+        environ.update({
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': self.request_version,
+            'SERVER_NAME': self.server.server_address[0],
+            'SERVER_PORT': str(self.server.server_address[1]),
+            'REMOTE_ADDR': self.client_address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        })
+        for (name, value) in self.headers.items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+                key = 'HTTP_' + key
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+        if 'HTTP_HOST' not in environ:
+            environ['HTTP_HOST'] = "%s:%d" % self.server.server_address
+
+        response = []
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        output = self.server.application(environ, start_response)
+        try:
+            self.send_output(response, output)
+        finally:
+            if hasattr(output, 'close'):
+                output.close()
+        if self.server.stopping:
+            self.close_connection = True
+
+    def send_output(self, response, output):
+        chunks = iter(output)
+        chunk = b''
+        # An application may start the response with its first chunk.
+        if not response:
+            chunk = next(chunks, None)
+        (status, headers) = response
+        (code, reason) = status.split(' ', 1)
+        code = int(code)
+
+        names = [k.lower() for (k, v) in headers]
+        if self.command == 'HEAD' or code in (204, 304) or code < 200 or \
+           'content-length' in names:
+            chunked = False
+        elif self.request_version == 'HTTP/1.1':
+            chunked = True
+        else:
+            chunked = False
+            self.close_connection = True
+
+        self.send_response(code, reason)
+        for (k, v) in headers:
+            self.send_header(k, v)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+        while chunk is not None:
+            if chunk and self.command != 'HEAD':
+                if chunked:
+                    self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+                else:
+                    self.wfile.write(chunk)
+            chunk = next(chunks, None)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    do_GET = do_request
+    do_HEAD = do_request
+    do_POST = do_request
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+
+class WorkerServer(socketserver.TCPServer):
+    def __init__(self, sock, application, environ, threads=SERVE_THREADS,
+                 verbose=False):
+        socketserver.TCPServer.__init__(self, sock.getsockname()[:2],
+                                        RequestHandler,
+                                        bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.application = application
+        self.environ = environ
+        self.verbose = verbose
+        self.stopping = False
+        self.executor = futures.ThreadPoolExecutor(max_workers=threads)
+        # We only accept when a thread is free to take the connection.
+        # The rest wait in the backlog, where another worker may get them.
+        self.free = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self.free.acquire()
+        self.executor.submit(self.process_request_thread, request,
+                             client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.free.release()
+
+    def handle_error(self, request, client_address):
+        e = sys.exc_info()[1]
+        if isinstance(e, socket.error) and \
+           e.errno in (errno.EPIPE, errno.ECONNRESET):
+            return
+        sys.stderr.write("%s: %d: error serving %s\n" %
+                         (TAG, os.getpid(), client_address[0]))
+        traceback.print_exc()
+
+    # Take what is in the backlog already before closing the socket, or the
+    # kernel resets those connections. A few may still come in between.
+    def drain(self):
+        self.socket.setblocking(False)
+        while True:
+            try:
+                (request, client_address) = self.socket.accept()
+            except socket.error:
+                break
+            request.setblocking(True)
+            self.process_request(request, client_address)
+        self.socket.close()
+
+    def stop(self):
+        self.stopping = True
+        self.shutdown()
+        self.drain()
+        self.executor.shutdown(wait=True)
+
+
+def reuseport():
+    return hasattr(socket, "SO_REUSEPORT")
+
+def make_socket(address, listen):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport():
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    if listen:
+        sock.listen(SERVE_BACKLOG)
+    return sock
+
+def parse_address(s):
+    (host, port) = s.rsplit(':', 1)
+    return (host, int(port))
+
+
+# Render the front page of every user, so that the workers start with the
+# code imported and the first pages in the caches. The bases are not
+# watched here: the thread of the watcher does not survive the fork, and
+# a lock that it held then would stay held in the workers forever. The
+# workers watch the bases when they first use them.
+def warm(application, environ):
+    try:
+        users = slasti.wsgi.UserBase()
+        users.open(environ['slasti.userconf'])
+    except AppError as e:
+        sys.stderr.write("%s: %s\n" % (TAG, str(e)))
+        return
+    pool = slasti.tagbase.get_pool()
+    watch = pool.watch
+    pool.watch = False
+    try:
+        warm_users(application, environ, users)
+    finally:
+        pool.watch = watch
+
+def warm_users(application, environ, users):
+    for user in users.users:
+        env = dict(environ)
+        env.update({
+            'REQUEST_METHOD': 'GET',
+            'SCRIPT_NAME': '',
+            'PATH_INFO': '/' + slasti.safestr(user['name']).decode('latin-1')
+                         + '/',
+            'QUERY_STRING': '',
+            'HTTP_HOST': 'localhost',
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(b''),
+        })
+        output = application(env, lambda status, headers, exc_info=None:
+                             None)
+        for chunk in output:
+            pass
+        if hasattr(output, 'close'):
+            output.close()
+
+
+class Master(object):
+    def __init__(self, application, environ, address, workers,
+                 threads=SERVE_THREADS, verbose=False):
+        self.application = application
+        self.environ = environ
+        self.nworkers = workers
+        self.threads = threads
+        self.verbose = verbose
+        # With SO_REUSEPORT, our socket only holds the port: it does not
+        # listen, or connections would wait for us in vain.
+        self.sock = make_socket(address, not reuseport())
+        self.address = self.sock.getsockname()[:2]
+        # workers: pid -> start time
+        self.workers = {}
+        self.old = set()
+        self.stopping = False
+        self.restarting = False
+
+    # Fork a worker and wait until it listens, so that a restart never
+    # leaves the port without anyone to accept.
+    def spawn(self):
+        (rfd, wfd) = os.pipe()
+        pid = os.fork()
+        if pid != 0:
+            os.close(wfd)
+            self.workers[pid] = time.time()
+            (r, w, x) = select.select([rfd], [], [], SERVE_START_TIMEOUT)
+            if not r:
+                sys.stderr.write("%s: worker %d is slow to start\n" %
+                                 (TAG, pid))
+            os.close(rfd)
+            return
+        os.close(rfd)
+        status = 0
+        try:
+            self.worker(wfd)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def worker(self, ready):
+        stop = threading.Event()
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        if reuseport():
+            sock = make_socket(self.address, True)
+            self.sock.close()
+        else:
+            sock = self.sock
+        server = WorkerServer(sock, self.application, self.environ,
+                              self.threads, self.verbose)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.5})
+        thread.daemon = True
+        thread.start()
+        os.write(ready, b'.')
+        os.close(ready)
+        while not stop.is_set():
+            stop.wait(1.0)
+        # Whatever takes longer than this gets killed by SIGALRM.
+        signal.alarm(SERVE_GRACE)
+        server.stop()
+
+    def reap(self):
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            started = self.workers.pop(pid, None)
+            if pid in self.old:
+                self.old.discard(pid)
+                continue
+            if started is None or self.stopping:
+                continue
+            sys.stderr.write("%s: worker %d exited with %d\n" %
+                             (TAG, pid, status))
+            if time.time() - started < SERVE_RESPAWN_DELAY:
+                time.sleep(SERVE_RESPAWN_DELAY)
+            self.spawn()
+
+    def signal_all(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def start(self):
+        def on_stop(signum, frame):
+            self.stopping = True
+        def on_restart(signum, frame):
+            self.restarting = True
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_restart)
+
+        for n in range(self.nworkers):
+            self.spawn()
+
+    def run(self):
+        while not self.stopping:
+            if self.restarting:
+                self.restarting = False
+                old = set(self.workers.keys())
+                self.old |= old
+                for n in range(self.nworkers):
+                    self.spawn()
+                self.signal_all(old, signal.SIGTERM)
+            self.reap()
+            time.sleep(0.2)
+
+        self.signal_all(self.workers.keys(), signal.SIGTERM)
+        while self.workers:
+            self.reap()
+            time.sleep(0.2)
+        self.sock.close()
+
+
+def Usage():
+    sys.stderr.write("Usage: " + TAG + " [-b host:port] [-w workers]"
+                     " [-t threads] [-v] userconf\n")
+    sys.exit(2)
+
+def main(args):
+    address = SERVE_ADDRESS
+    workers = None
+    threads = SERVE_THREADS
+    verbose = False
+    while len(args) > 1:
+        opt = args[0]
+        if opt == '-v':
+            verbose = True
+            args = args[1:]
+            continue
+        val = args[1]
+        args = args[2:]
+        try:
+            if opt == '-b':
+                address = val
+            elif opt == '-w':
+                workers = int(val)
+            elif opt == '-t':
+                threads = int(val)
+            else:
+                Usage()
+        except ValueError:
+            Usage()
+    if len(args) != 1:
+        Usage()
+    try:
+        address = parse_address(address)
+    except ValueError:
+        Usage()
+    if workers is None:
+        try:
+            workers = os.cpu_count() or 2
+        except AttributeError:
+            workers = 2
+
+    # Like SetEnv slasti.userconf under mod_wsgi.
+    environ = {'slasti.userconf': os.path.abspath(args[0])}
+    application = slasti.wsgi.application
+    warm(application, environ)
+
+    try:
+        master = Master(application, environ, address, workers, threads,
+                        verbose)
+    except socket.error as e:
+        raise AppError("%s:%d: %s" % (address[0], address[1], str(e)))
+    master.start()
+    sys.stdout.write("%s: listening on %s:%d, %d workers\n" %
+                     (TAG, master.address[0], master.address[1], workers))
+    sys.stdout.flush()
+    master.run()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except AppError as e:
+        sys.stderr.write(TAG + ": " + str(e) + "\n")
+        sys.exit(1)
@@ -0,0 +1,191 @@
+#
+# Slasti -- Performance statistics
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Counters and histograms live in the process, shared by all the threads
+# that mod_wsgi runs in it, behind one lock. Nothing here is kept across
+# restarts, and with several daemon processes each has its own numbers
+# (the "stats" page shows the pid for that reason).
+#
+# Counters that TagBase and friends bump during a request are also summed
+# per request, in a thread-local, so that we can tell how many files
+# a request for a given page opens, and not only how many in total.
+#
+
+import os
+import threading
+import time
+
+# Upper bounds of buckets, the last one catches everything.
+LATENCY_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                  1.0, 2.0, 5.0, 10.0, float("inf"))
+COUNT_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                float("inf"))
+
+# The counters that are also reported per request.
+PER_REQUEST = ("files.open", "files.listdir")
+
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i in range(len(self.bounds)):
+            if value <= self.bounds[i]:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # The upper bound of the bucket where the quantile q falls,
+    # except that it is never more than the maximum actually seen.
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i in range(len(self.bounds)):
+            seen += self.buckets[i]
+            if seen >= rank:
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.50),
+            "p90": self.quantile(0.90),
+            "p99": self.quantile(0.99),
+            # JSON has no infinity, so the last bound goes as null.
+            "buckets": [[b if b != float("inf") else None, n]
+                        for (b, n) in zip(self.bounds, self.buckets)],
+        }
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        req = getattr(self.local, "req", None)
+        if req is not None:
+            req[name] = req.get(name, 0) + n
+
+    def observe(self, name, value, bounds=LATENCY_BOUNDS):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = Histogram(bounds)
+                self.histograms[name] = hist
+            hist.observe(value)
+
+    def request_begin(self):
+        self.local.req = {}
+
+    # The counters of the request that this thread works for, for servers
+    # that move a request from thread to thread (see slasti/asgi.py).
+    def request_state(self):
+        return getattr(self.local, "req", None)
+
+    def request_resume(self, req):
+        self.local.req = req
+
+    def request_end(self, route, elapsed):
+        req = getattr(self.local, "req", None)
+        self.local.req = None
+        self.incr("requests")
+        self.observe("route." + route, elapsed)
+        if req is not None:
+            for name in PER_REQUEST:
+                self.observe("request." + name, req.get(name, 0),
+                             COUNT_BOUNDS)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "uptime": time.time() - self.started,
+                "counters": dict(self.counters),
+                "histograms": dict((name, hist.to_dict()) for (name, hist)
+                                   in self.histograms.items()),
+            }
+
+
+# The output of a request, timed until the server is done with it,
+# since the pages are generated while they are sent.
+class TimedOutput(object):
+    def __init__(self, stats, output, route, t0, on_finish=None):
+        self.stats = stats
+        self.output = output
+        self.route = route
+        self.t0 = t0
+        self.on_finish = on_finish
+        self.done = False
+
+    def __iter__(self):
+        for chunk in self.output:
+            yield chunk
+        self.finish()
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            self.stats.request_end(self.route, time.time() - self.t0)
+            if self.on_finish is not None:
+                self.on_finish()
+
+    def close(self):
+        if hasattr(self.output, "close"):
+            self.output.close()
+        self.finish()
+
+
+def text_report(snap):
+    lines = []
+    lines.append("pid %d uptime %d" % (snap["pid"], snap["uptime"]))
+    lines.append("")
+    for name in sorted(snap["counters"].keys()):
+        lines.append("%-32s %d" % (name, snap["counters"][name]))
+    lines.append("")
+    lines.append("%-32s %8s %10s %10s %10s %10s" %
+                 ("", "count", "mean", "p50", "p99", "max"))
+    for name in sorted(snap["histograms"].keys()):
+        h = snap["histograms"][name]
+        lines.append("%-32s %8d %10.4f %10.4f %10.4f %10.4f" %
+                     (name, h["count"], h["mean"], h["p50"], h["p99"],
+                      h["max"]))
+    return "\n".join(lines) + "\n"
+
+
+_stats = Stats()
+
+def get_stats():
+    return _stats
+
+def incr(name, n=1):
+    _stats.incr(name, n)
+
+def observe(name, value, bounds=LATENCY_BOUNDS):
+    _stats.observe(name, value, bounds)
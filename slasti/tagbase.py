@@ -8,18 +8,22 @@
 #  codecs
 #
 
+import bisect
 import codecs
 utf8_writer = codecs.getwriter("utf-8")
+import collections
 import os
 import errno
+import fcntl
+import json
 import math
+import threading
 import time
 import base64
 import six
 
-from xml.sax.saxutils import quoteattr
-
 from slasti import AppError
+from slasti.trace import traced
 import slasti
 
 # A WSGI module running on Fedora 15 gets no LANG, so Python decides
@@ -53,6 +57,61 @@ def fs_decode_list(names):
 
 #
 
+# The same as quoteattr of xml.sax.saxutils, which we do not import because
+# it brings in urllib.request, and with it http.client and ssl.
+def quoteattr(data):
+    data = data.replace("&", "&amp;").replace(">", "&gt;")
+    data = data.replace("<", "&lt;").replace("\n", "&#10;")
+    data = data.replace("\r", "&#13;").replace("\t", "&#9;")
+    if '"' in data:
+        if "'" in data:
+            return '"%s"' % data.replace('"', "&quot;")
+        return "'%s'" % data
+    return '"%s"' % data
+
+# A change log record for a mark stored, sequence number to be filled in.
+def store_record(stamp0, stamp1, mtime, title, url, note, tags):
+    return {"op": "store", "key": "%d.%02d" % (stamp0, stamp1),
+            "mtime": mtime, "title": title, "url": url, "note": note,
+            "tags": list(tags)}
+
+# The mark file name is the key with the zero fix omitted.
+def key_name(stamp0, stamp1):
+    if stamp1 == 0:
+        return "%010d" % stamp0
+    return "%010d.%02d" % (stamp0, stamp1)
+
+def name_key(markname):
+    p = markname.split(".")
+    try:
+        stamp0 = int(p[0])
+        stamp1 = int(p[1]) if len(p) > 1 else 0
+    except ValueError:
+        return (0, 0)
+    return (stamp0, stamp1)
+
+# The position of the first name that is not above name in a list sorted
+# newest first, like bisect_left for a list in the usual order.
+def bisect_desc(dlist, name):
+    lo = 0
+    hi = len(dlist)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if dlist[mid] > name:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+# An entry of the link index is broken if the site did not answer at all,
+# or answered with an error. We do not count 401 and 403, because sites
+# behind a login are not gone, they just do not talk to us.
+def link_broken(entry):
+    status = entry.get("status")
+    if status is None:
+        return True
+    return status >= 400 and status not in (401, 403)
+
 def split_marks(tagstr):
     tags = []
     for t in tagstr.split(' '):
@@ -60,7 +119,9 @@ def split_marks(tagstr):
             tags.append(t)
     return tags
 
+@traced("tagbase.load_tag")
 def load_tag(tagdir, tag):
+    slasti.stats.incr("files.open")
     try:
         f = open(tagdir+"/"+fs_encode(tag), "r")
     except IOError as e:
@@ -73,7 +134,9 @@ def load_tag(tagdir, tag):
         tagbuf = ''
     return tagbuf
 
+@traced("tagbase.read_tags")
 def read_tags(markdir, markname):
+    slasti.stats.incr("files.open")
     try:
         f = codecs.open(markdir+"/"+markname, "r",
                         encoding="utf-8", errors="replace")
@@ -151,17 +214,26 @@ def difftags(old, new):
     return (minus, plus)
 
 #
-# TagMark is one bookmark when we manipulate it (extracted from TagBase).
+# MarkRecord is a bookmark as read from its file, and nothing else. Passes
+# over the whole base (the export, the change log, link checks) make one for
+# every mark, so it has slots, and the file name is kept as an integer.
 #
-class TagMark:
-    def __init__(self, base, fromtag, marklist, markindex):
-        markname = marklist[markindex]
-
-        self.base = base
-        self.ourtag = fromtag
-        self.ourlist = marklist
-        self.ourindex = markindex
+class MarkRecord(object):
+    __slots__ = ("namekey", "stamp0", "stamp1", "mtime", "title", "url",
+                 "note", "tags")
+
+    def __init__(self, markdir, markname):
+        # Anything that is not a name of ours is kept as is.
+        (stamp0, stamp1) = name_key(markname)
+        if stamp1 < 100 and key_name(stamp0, stamp1) == markname:
+            self.namekey = stamp0 * 100 + stamp1
+        else:
+            self.namekey = markname
+        self.load(markdir, markname)
+        self.tags = tuple(self.tags)
 
+    @traced("tagmark.parse")
+    def load(self, markdir, markname):
         self.stamp0 = 0
         self.stamp1 = 0
         self.mtime = 0.0
@@ -170,8 +242,9 @@ class TagMark:
         self.note = ""
         self.tags = []
 
+        slasti.stats.incr("files.open")
         try:
-            f = codecs.open(base.markdir+"/"+markname, "r",
+            f = codecs.open(markdir+"/"+markname, "r",
                             encoding="utf-8", errors="replace")
         except IOError:
             # Set a red tag to tell us where we crashed.
@@ -199,7 +272,7 @@ class TagMark:
                 mtime = math.floor(float(os.fstat(f.fileno()).st_mtime))
             except (OSError, ValueError, OverflowError):
                 mtime = 0.0
-            self.mtime = mtime
+        self.mtime = mtime
 
         # Format is defined as two integers over a dot, which unfortunately
         # looks like a decimal fraction. Should've used a space. Oh well.
@@ -250,16 +323,21 @@ class TagMark:
     def __str__(self):
         # There do not seem to be any exceptions raised with weird inputs.
         datestr = time.strftime("%Y-%m-%d", time.gmtime(self.stamp0))
-        return self.ourlist[self.ourindex]+'|'+datestr+'|'+\
+        return self.name()+'|'+datestr+'|'+\
                self.title+'|'+self.url+'|'+self.note+'|'+self.tags
 
     def key(self):
         return (self.stamp0, self.stamp1)
 
-    def tag(self):
-        return self.ourtag
+    # The name of the mark file, which is not quite the same as the key.
+    def name(self):
+        if isinstance(self.namekey, six.string_types):
+            return self.namekey
+        return key_name(self.namekey // 100, self.namekey % 100)
 
-    def xml(self):
+    # The stamped form adds our key and the modification time, which
+    # Del.icio.us does not have. Mirrors need them to apply incremental feeds.
+    def xml(self, stamped=False):
         datestr = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.stamp0))
         datestr = '"%s"' % datestr
 
@@ -270,9 +348,20 @@ class TagMark:
 
         # Del.icio.us also export hash="" (MD5 of URL in href) and meta=""
         # (MD5 of unknown content). We don't know if this is needed for anyone.
+        if stamped:
+            fmt = '  <post href=%s description=%s tag=%s time=%s extended=%s' \
+                  ' key="%d.%02d" mtime="%d" />\n'
+            return fmt % (url, title, tagstr, datestr, note,
+                          self.stamp0, self.stamp1, self.mtime)
         fmt = '  <post href=%s description=%s tag=%s time=%s extended=%s />\n'
         return fmt % (url, title, tagstr, datestr, note)
 
+    def change_record(self, seq):
+        record = store_record(self.stamp0, self.stamp1, self.mtime,
+                              self.title, self.url, self.note, self.tags)
+        record['seq'] = seq
+        return record
+
     # We return mark's jsondict here, not a full-page jsondict, of course.
     def to_jsondict(self, path_prefix):
         title = self.title
@@ -305,40 +394,60 @@ class TagMark:
 
         return jsondict
 
-    def succ(self):
-        if self.ourindex+1 >= len(self.ourlist):
+#
+# TagMark is one bookmark when we manipulate it (extracted from TagBase).
+# It knows where it was found, so pages can step to the next and previous.
+#
+class TagMark(MarkRecord):
+    def __init__(self, base, fromtag, marklist, markindex):
+        self.base = base
+        self.ourtag = fromtag
+        self.ourlist = marklist
+        self.ourindex = markindex
+        self.load(base.markdir, marklist[markindex])
+
+    def name(self):
+        return self.ourlist[self.ourindex]
+
+    def tag(self):
+        return self.ourtag
+
+    # The n lets callers step over a whole page without parsing every mark
+    # in between. Stepping forward past the end returns None.
+    def succ(self, n=1):
+        if self.ourindex+n >= len(self.ourlist):
             return None
         # maybe check here that TagMark returned with nonzero stamp0
-        return TagMark(self.base, self.ourtag, self.ourlist, self.ourindex+1)
+        return TagMark(self.base, self.ourtag, self.ourlist, self.ourindex+n)
 
-    def pred(self):
+    # Stepping back stops at the first mark, so a short page back still
+    # lands somewhere. Only if we are at the first mark already, it's None.
+    def pred(self, n=1):
         if self.ourindex == 0:
             return None
+        index = self.ourindex-n
+        if index < 0:
+            index = 0
         # maybe check here that TagMark returned with nonzero stamp0
-        return TagMark(self.base, self.ourtag, self.ourlist, self.ourindex-1)
+        return TagMark(self.base, self.ourtag, self.ourlist, index)
 
 #
-# TagMarkCursor is an iterator class.
+# TagMarkCursor is an iterator class. It gives MarkRecords, not TagMarks,
+# because nobody steps from a mark of a whole pass, and they are smaller.
 #
 class TagMarkCursor:
+    @traced("tagbase.listdir")
     def __init__(self, base):
         self.base = base
-        # Apparently Python does not provide opendir() and friends, so our
-        # cursor actually loads whole list in memory.
-        # If we cared enough, we'd convert filenames to stamps right away,
-        # then sorted an array of integers. But we don't.
-        # Most likely we'll switch to a database back-end anyway.
-        self.dlist = os.listdir(base.markdir)
-        # Miraclously this sort() works as expected in presence of dot-fix.
-        self.dlist.sort()
-        self.dlist.reverse()
+        # The list comes from the index of the base, see TagBase.index().
+        self.dlist = base.index().marks
         self.index = 0
         self.length = len(self.dlist)
 
     def next(self):
         if self.index >= self.length:
             raise StopIteration
-        mark = TagMark(self.base, None, self.dlist, self.index)
+        mark = MarkRecord(self.base.markdir, self.dlist[self.index])
         self.index += 1
         return mark
 
@@ -349,7 +458,7 @@ class TagTag:
     def __init__(self, base, tagname):
         self.ourname = tagname
 
-        self.nmark = len(split_marks(load_tag(base.tagdir, tagname)))
+        self.nmark = len(base.index().tag(tagname))
 
     def __str__(self):
         return self.ourname
@@ -361,10 +470,10 @@ class TagTag:
         return self.nmark
 
 class TagTagCursor:
+    @traced("tagbase.listtags")
     def __init__(self, base):
         self.base = base
-        self.dlist = fs_decode_list(os.listdir(base.tagdir))
-        self.dlist.sort()
+        self.dlist = base.index().tagnames()
         self.index = 0
         self.length = len(self.dlist)
 
@@ -381,6 +490,218 @@ class TagTagCursor:
     # py3
     __next__ = next
 
+#
+# The Index keeps what every request would otherwise list or read again:
+# the names of all marks, newest first, the names of the tags, and the
+# marks of the tags that were asked for, in the same order. An index is
+# good while the stamp of the base is the same (see TagBase.index_stamp).
+#
+# Indexes are snapshots: nothing in one changes once it is made, except
+# that it remembers the tags it loaded, which are the same whoever loads
+# them. So threads read an index without locking. A write makes a new
+# index from the old one (see derive_index), sharing the lists that did
+# not change, and swaps it in, so a reader has either the old one or the
+# new one, never something in between.
+#
+# The parent is an IndexFile of slasti/indexfile.py that an index was
+# derived from, where the tags that did not change are looked up, and the
+# depth is the number of writes since it, or None if there is no parent,
+# or the writes are not in the journal of the file.
+# An index stops remembering tags once it is at its limit of memory,
+# which is only estimated, by the number of names it holds.
+#
+INDEX_ENTRY_BYTES = 80
+INDEX_LIMIT = 32 * 1024 * 1024
+INDEX_MAPPED = True
+# Without a watch, see TagBase.tags_edited().
+TAGS_SCAN_INTERVAL = 10
+TAGS_SCAN_SLACK = 1.0
+
+class Index(object):
+    def __init__(self, base, stamp, limit, marks=None, tags=None,
+                 tagnames=None, parent=None, depth=None):
+        self.base = base
+        self.stamp = stamp
+        self.limit = limit
+        self.parent = parent
+        self.depth = depth
+        if marks is None:
+            slasti.stats.incr("files.listdir")
+            marks = os.listdir(base.markdir)
+            # Miraclously this sort() works as expected in presence of dot-fix.
+            marks.sort()
+            marks.reverse()
+        self.marks = marks
+        self.tags = tags if tags is not None else {}
+        self._tagnames = tagnames
+        self.entries = _entries(marks) + len(tagnames or ()) + \
+                       sum(_entries(dlist) for dlist in self.tags.values())
+
+    def size(self):
+        return self.entries * INDEX_ENTRY_BYTES
+
+    def tag(self, tagname):
+        dlist = self.tags.get(tagname)
+        if dlist is not None:
+            return dlist
+        if self.parent is not None:
+            return self.parent.tag(tagname)
+        dlist = split_marks(load_tag(self.base.tagdir, tagname))
+        dlist.sort()
+        dlist.reverse()
+        # Two threads may load the same tag, and one of the lists is kept.
+        if self.size() + len(dlist) * INDEX_ENTRY_BYTES <= self.limit:
+            dlist = self.tags.setdefault(tagname, dlist)
+            self.entries += len(dlist)
+        return dlist
+
+    def tagnames(self):
+        names = self._tagnames
+        if names is None:
+            if self.parent is not None:
+                names = self.parent.tagnames()
+            else:
+                slasti.stats.incr("files.listdir")
+                names = fs_decode_list(os.listdir(self.base.tagdir))
+                names.sort()
+                self.entries += len(names)
+            self._tagnames = names
+        return names
+
+#
+# A list of names sorted newest first, made of another list, which is not
+# copied, and of the names inserted into it and removed from it since, so
+# that a write costs as much as the writes since that list was made, not
+# as much as the list. The runs are (start, offset, length, name): either
+# a stretch of the other list, or a name that was inserted, with the
+# offset None. After OVERLAY_CHANGES writes, the list is copied after all.
+#
+OVERLAY_CHANGES = 256
+
+class OverlayList(object):
+    def __init__(self, under, runs, count, changes):
+        self.under = under
+        self.runs = runs
+        self.starts = [run[0] for run in runs]
+        self.count = count
+        self.changes = changes
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.count
+        if n < 0 or n >= self.count:
+            raise IndexError(n)
+        (start, off, length, name) = \
+            self.runs[bisect.bisect_right(self.starts, n) - 1]
+        if off is None:
+            return name
+        return self.under[off + n - start]
+
+    def __iter__(self):
+        for (start, off, length, name) in self.runs:
+            if off is None:
+                yield name
+            elif isinstance(self.under, list):
+                for name in self.under[off:off + length]:
+                    yield name
+            else:
+                for n in range(off, off + length):
+                    yield self.under[n]
+
+# The memory taken by a list, in names. The names of a mapped list are
+# in the pages of the file, see slasti/indexfile.py.
+def _entries(dlist):
+    if isinstance(dlist, OverlayList):
+        if isinstance(dlist.under, list):
+            return len(dlist)
+        return dlist.changes
+    if isinstance(dlist, list):
+        return len(dlist)
+    return 0
+
+# Insert or remove the name in the list sorted newest first, giving a new
+# list and leaving the old one as it was.
+def _cow_names(dlist, name, present):
+    n = bisect_desc(dlist, name)
+    there = n < len(dlist) and dlist[n] == name
+    if present == there:
+        return dlist
+    if isinstance(dlist, OverlayList):
+        under = dlist.under
+        runs = [(off, length, rname)
+                for (start, off, length, rname) in dlist.runs]
+        changes = dlist.changes
+    else:
+        under = dlist
+        runs = [(0, len(dlist), None)]
+        changes = 0
+    if changes + 1 >= OVERLAY_CHANGES:
+        dlist = list(dlist)
+        if present:
+            dlist.insert(n, name)
+        else:
+            del dlist[n]
+        return dlist
+    # Cut the runs at n, which only splits a stretch of the list.
+    before = []
+    after = []
+    start = 0
+    for (off, length, rname) in runs:
+        if start + length <= n:
+            before.append((off, length, rname))
+        elif start >= n:
+            after.append((off, length, rname))
+        else:
+            before.append((off, n - start, None))
+            after.append((off + n - start, length - (n - start), None))
+        start += length
+    if present:
+        before.append((None, 1, name))
+    else:
+        (off, length, rname) = after.pop(0)
+        if off is not None:
+            after.insert(0, (off + 1, length - 1, None))
+    new = []
+    start = 0
+    for (off, length, rname) in before + after:
+        if length != 0:
+            new.append((start, off, length, rname))
+            start += length
+    return OverlayList(under, new, start, changes + 1)
+
+#
+# The index after the mark was stored (present) or deleted, its tags
+# changing from old_tags to new_tags, where old is the index before that.
+# Only what changes is copied: the lists of marks are overlays of the old
+# ones, see OverlayList. The names of tags are copied whole when a tag
+# comes or goes, but there are far fewer of them than of marks.
+#
+def derive_index(base, old, stamp, markname, old_tags, new_tags, present):
+    if isinstance(old, Index):
+        tags = dict(old.tags)
+        parent = old.parent
+        depth = old.depth + 1 if old.depth is not None else None
+    else:
+        tags = {}
+        parent = old
+        depth = 1
+    marks = _cow_names(old.marks, markname, present)
+    names = old.tagnames()
+    for t in set(old_tags) | set(new_tags):
+        dlist = _cow_names(old.tag(t), markname, present and t in new_tags)
+        tags[t] = dlist
+        k = bisect.bisect_left(names, t)
+        there = k < len(names) and names[k] == t
+        if dlist and not there:
+            names = names[:k] + [t] + names[k:]
+        elif not dlist and there:
+            names = names[:k] + names[k+1:]
+    return Index(base, stamp, base.index_limit, marks, tags, names, parent,
+                 depth)
+
 #
 # The open database (any back-end in theory, hardcoded to files for now)
 # XXX files are very inefficient: 870 bookmarks from a 280 KB XML take 6 MB.
@@ -403,6 +724,28 @@ class TagBase:
         self.tagdir = self.dirname+"/tags"
         self.markdir = self.dirname+"/marks"
 
+        self.index_mapped = INDEX_MAPPED
+        self.index_limit = INDEX_LIMIT
+        self.index_lock = threading.Lock()
+        self._index = None
+        # See watch(). Until the watcher says so, the index is current.
+        self._watch = None
+        # The process that last tried to watch, see BasePool.get().
+        self._watch_pid = None
+        self._index_dirty = True
+        # A tag was written in place by someone else, see index_changed().
+        self._index_edited = False
+        # Tags we are writing ourselves: fsname -> count of writes.
+        self._index_own = {}
+        self._index_own_lock = threading.Lock()
+        # The last generation we wrote. No index older than it will do,
+        # or a user would not see what they just saved.
+        self._index_written = 0
+        # Without a watch, see tags_edited(): when we last looked at the
+        # tags, and the tags we wrote ourselves: fsname -> time written.
+        self._tags_scanned = None
+        self._tags_own = {}
+
     def open(self):
         try:
             os.mkdir(self.tagdir)
@@ -418,29 +761,701 @@ class TagBase:
     def close(self):
         pass
 
-    def lookup_name(self, tag, dlist, matchname):
-        ## The antipythonic roll-my-own way:
-        # matchindex = 0
-        # while matchindex < len(dlist):
-        #     if dlist[matchindex] == matchname:
-        #         break
-        #     matchindex += 1
-        # if matchindex == len(dlist):
-        #     return None
-        ## A more pytonic way:
-        try:
-            matchindex = dlist.index(matchname)
+    #
+    # The stamp changes whenever the base is written by us, in any process,
+    # which bumps the generation, and when a mark is added or removed behind
+    # our back, which changes the directory. A directory made anew, like a
+    # copy of the base in place of the old one, has another inode.
+    #
+    def index_stamp(self):
+        try:
+            mst = os.stat(self.markdir)
+            tst = os.stat(self.tagdir)
+        except OSError as e:
+            raise AppError(str(e))
+        return (self.generation(), mst.st_ino, mst.st_mtime,
+                tst.st_ino, tst.st_mtime)
+
+    # The current index, made anew if the base changed since the last one.
+    # It is the shared file of slasti/indexfile.py, unless that cannot be
+    # written or mapped, when we index in memory. An index in memory larger
+    # than our limit is used but not kept.
+    def index(self):
+        if self._watch is not None:
+            if self._watch[0].alive():
+                index = self._index
+                if not self._index_dirty and \
+                   self.index_usable(index, index.stamp if index else None):
+                    return index
+            else:
+                # We were forked, so watch anew in this process.
+                self._watch = None
+                self.watch()
+        # Anything that happens from here on makes it dirty again.
+        self._index_dirty = False
+        edited = self._index_edited
+        self._index_edited = False
+        stamp = self.index_stamp()
+        index = self._index
+        # A tag written in place keeps the stamp. If the stamp changed, it
+        # was a writer, whose write the new index has anyway; if not, it was
+        # an edit by hand, and the index must be made anew from the files.
+        # Without a watch, we only know that some tag is newer than we
+        # can account for, so the index is made anew either way.
+        rebuild = edited and (index is None or index.stamp == stamp)
+        if self._watch is None and self.tags_edited():
+            rebuild = True
+        if index is not None and index.stamp == stamp and not rebuild:
+            return index
+        # Another thread is making the new index. Rather than wait for it,
+        # we read the last one, which is consistent, only a little old,
+        # as long as it has our own writes.
+        if not self.index_lock.acquire(False):
+            if self.index_usable(index, stamp):
+                slasti.stats.incr("index.stale")
+                # And look again the next time.
+                if rebuild:
+                    self._index_edited = True
+                self._index_dirty = True
+                return index
+            self.index_lock.acquire()
+        try:
+            if rebuild:
+                stamp = self.index_stamp()
+            index = self._index
+            if index is not None and index.stamp == stamp and not rebuild:
+                return index
+            index = None
+            if self.index_mapped:
+                try:
+                    # The file of the stamp has the tag as it was.
+                    if rebuild:
+                        slasti.indexfile.build(self, stamp)
+                    index = slasti.indexfile.get_index(self, stamp,
+                                                       self._index)
+                except AppError:
+                    index = None
+            if index is None:
+                index = Index(self, stamp, self.index_limit)
+            if index.size() <= self.index_limit:
+                self._index = index
+            else:
+                self._index = None
+        finally:
+            self.index_lock.release()
+        return index
+
+    #
+    # With a watch, the index is only checked after inotify events that
+    # can change it: names coming and going in marks/, any write of a tag
+    # (that is, also edits of tags by hand, which the stamp cannot see),
+    # the generation, and the directories themselves. Edits of the marks
+    # do not matter, since marks are read from their files anyway.
+    # Returns False if the base cannot be watched, and then it checks the
+    # stamp every time as before, and the tags now and then.
+    #
+    def watch(self):
+        self._watch_pid = os.getpid()
+        watcher = slasti.watch.get_watcher()
+        if watcher is None:
+            return False
+        wds = []
+        try:
+            wds.append(watcher.add(self.markdir, slasti.watch.IN_NAMES,
+                                   self.index_changed))
+            wds.append(watcher.add(self.tagdir, slasti.watch.IN_NAMES |
+                                   slasti.watch.IN_CLOSE_WRITE,
+                                   self.index_changed))
+            wds.append(watcher.add(self.dirname, slasti.watch.IN_NAMES |
+                                   slasti.watch.IN_CLOSE_WRITE,
+                                   self.dir_changed))
+        except AppError:
+            for wd in wds:
+                watcher.remove(wd)
+            return False
+        self._index_dirty = True
+        self._watch = (watcher, wds)
+        return True
+
+    def unwatch(self):
+        watch = self._watch
+        self._watch = None
+        if watch is not None and watch[0].alive():
+            for wd in watch[1]:
+                watch[0].remove(wd)
+
+    # This runs in the thread of the watcher, which only tells the readers
+    # to look; the index is only ever made by index() and the writers.
+    def index_changed(self, mask, name):
+        if mask & slasti.watch.IN_Q_OVERFLOW:
+            with self._index_own_lock:
+                self._index_own.clear()
+            self._index_edited = True
+        elif mask & slasti.watch.IN_CLOSE_WRITE and \
+             not self.index_own_seen(name):
+            self._index_edited = True
+        self._index_dirty = True
+
+    def dir_changed(self, mask, name):
+        if name in (None, "generation", "marks", "tags"):
+            self._index_dirty = True
+
+    # Our own writes of tags are in the index that index_commit() makes,
+    # so their events are not edits. Every write is one event.
+    def index_own_write(self, fsname):
+        if self._watch is None:
+            return
+        with self._index_own_lock:
+            self._index_own[fsname] = self._index_own.get(fsname, 0) + 1
+
+    def index_own_seen(self, fsname):
+        with self._index_own_lock:
+            n = self._index_own.get(fsname, 0)
+            if n == 0:
+                return False
+            if n == 1:
+                del self._index_own[fsname]
+            else:
+                self._index_own[fsname] = n - 1
+            return True
+
+    #
+    # Without a watch, tags edited in place by hand are found by the times
+    # of the tag files, which is a stat of every tag, so we do it at most
+    # every TAGS_SCAN_INTERVAL seconds. A tag that changed since we last
+    # looked is an edit, unless we wrote it ourselves; writers in other
+    # processes look like editors too, so the index is made anew more
+    # often than it must, but never kept stale. File times may lag the
+    # clock a little, so we look back TAGS_SCAN_SLACK seconds more.
+    #
+    def tags_edited(self):
+        now = time.time()
+        last = self._tags_scanned
+        if last is not None and now < last + TAGS_SCAN_INTERVAL:
+            return False
+        self._tags_scanned = now
+        if last is None:
+            # The index is about to be made, and has what is there now.
+            return False
+        since = last - TAGS_SCAN_SLACK
+        with self._index_own_lock:
+            own = self._tags_own
+            self._tags_own = dict((fsname, t) for (fsname, t) in
+                                  own.items() if t >= since)
+        slasti.stats.incr("files.listdir")
+        try:
+            names = os.listdir(self.tagdir)
+        except OSError:
+            return False
+        for fsname in names:
+            try:
+                mtime = os.stat(self.tagdir+"/"+fsname).st_mtime
+            except OSError:
+                continue
+            if mtime > since and mtime > own.get(fsname, 0):
+                return True
+        return False
+
+    def tags_own_wrote(self, fsname):
+        if self._watch is not None:
+            return
+        with self._index_own_lock:
+            self._tags_own[fsname] = time.time()
+
+    # An index that is not current may still be read if it is of the same
+    # directories, and has our own writes.
+    def index_usable(self, index, stamp):
+        if index is None:
+            return False
+        if index.stamp[1] != stamp[1] or index.stamp[3] != stamp[3]:
+            return False
+        return self._index_written <= index.stamp[0] <= stamp[0]
+
+    # A writer takes the index before it changes anything, so that it can
+    # make the next one from it, if the index is current.
+    def index_begin(self):
+        index = self._index
+        if index is None or self._index_edited or \
+           index.stamp != self.index_stamp():
+            return None
+        return index
+
+    # A write ends here: the generation goes up, with the record of the
+    # change, and the index of the new generation is made from the last
+    # one and published while the generation is still locked, so other
+    # processes map it rather than build it. Unless someone else wrote too,
+    # which we know from the generation; then readers make a new one.
+    # Either way, our next read must see the write, even if the watcher
+    # has not got the events for it yet. Returns the new generation.
+    def index_commit(self, old, record, markname, old_tags, new_tags,
+                     present):
+        made = []
+        def derive(gen):
+            made.append(self.index_derive(old, gen, markname, old_tags,
+                                          new_tags, present))
+        gen = self.bump_generation(record, derive)
+        index = made[0]
+        if index is not None:
+            # Not under the generation, see index_stamp_locked().
+            with self.index_lock:
+                if self._index is old and index.size() <= self.index_limit:
+                    self._index = index
+                    slasti.stats.incr("index.derive")
+        return gen
+
+    def index_derive(self, old, gen, markname, old_tags, new_tags, present):
+        self._index_dirty = True
+        if gen > self._index_written:
+            self._index_written = gen
+        if old is None or gen != old.stamp[0] + 1:
+            return None
+        stamp = self.index_stamp()
+        if self.index_mapped and \
+           (isinstance(old, slasti.indexfile.IndexFile) or
+            old.depth is not None):
+            try:
+                index = slasti.indexfile.derive(self, old, stamp, markname,
+                                                old_tags, new_tags, present)
+            except AppError:
+                index = None
+            if index is not None:
+                return index
+        index = derive_index(self, old, stamp, markname, old_tags, new_tags,
+                             present)
+        # Not published, so not to be continued in the journal.
+        index.depth = None
+        return index
+
+    # The stamp as of when no writer is between its generation and the
+    # index of it. Do not call with the generation locked.
+    def index_stamp_locked(self):
+        try:
+            fd = os.open(self.dirname+"/generation", os.O_RDONLY)
+        except OSError:
+            return self.index_stamp()
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            return self.index_stamp()
+        finally:
+            os.close(fd)
+
+    def index_size(self):
+        index = self._index
+        if index is None:
+            return 0
+        return index.size()
+
+    #
+    # The generation is a counter that every add1, edit1, and delete bumps.
+    # Anything derived from the whole base (such as export snapshots) keeps
+    # the generation it was built at and is out of date once it differs.
+    # N.B. Marks edited by hand behind our back do not bump the generation.
+    #
+    def generation(self):
+        try:
+            f = open(self.dirname+"/generation", "r")
+        except IOError:
+            return 0
+        s = f.read()
+        f.close()
+        try:
+            return int(s)
+        except ValueError:
+            return 0
+
+    #
+    # When a change record is given, it is appended to the change log with
+    # the new generation as its sequence number, under the same lock,
+    # so the log is always in the order of sequence numbers. The then is
+    # called with the new generation, also before the lock is let go.
+    #
+    def bump_generation(self, record=None, then=None):
+        try:
+            fd = os.open(self.dirname+"/generation", os.O_RDWR|os.O_CREAT,
+                         0o644)
+        except OSError as e:
+            raise AppError(str(e))
+        try:
+            # Two concurrent writers must not both come up with N+1.
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            s = os.read(fd, 100)
+            try:
+                gen = int(s)
+            except ValueError:
+                gen = 0
+            gen += 1
+            if record is not None:
+                record['seq'] = gen
+                self.changes_append(record)
+            # No truncation needed: the counter only grows, so the new
+            # string is never shorter, and readers never see it half-empty.
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, ("%d\n" % gen).encode('ascii'))
+            if then is not None:
+                then(gen)
+        finally:
+            os.close(fd)
+        return gen
+
+    #
+    # The change log is what a follower replays to mirror the base:
+    # one JSON record per line, for every store and deletion, with full
+    # contents, so that the follower never has to come back for the mark.
+    #
+    def changes_append(self, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        try:
+            fd = os.open(self.dirname+"/changes",
+                         os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644)
+        except OSError as e:
+            raise AppError(str(e))
+        try:
+            os.write(fd, line.encode('ascii'))
+        finally:
+            os.close(fd)
+
+    # Seek f to the first record with the sequence number above after.
+    # The log is sorted by sequence, so we bisect over byte offsets.
+    def changes_seek(self, f, after):
+        f.seek(0, os.SEEK_END)
+        lo = 0
+        hi = f.tell()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._changes_seq_at(f, mid) > after:
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo > 0:
+            f.seek(lo - 1)
+            f.readline()
+        else:
+            f.seek(0)
+
+    # The sequence number of the first record that starts at or after off,
+    # or infinity if none does.
+    def _changes_seq_at(self, f, off):
+        if off > 0:
+            f.seek(off - 1)
+            f.readline()
+        else:
+            f.seek(0)
+        line = f.readline()
+        if not line:
+            return float('inf')
+        try:
+            return json.loads(line.decode('ascii'))['seq']
+        except (ValueError, KeyError):
+            return 0
+
+    #
+    # Generate up to limit change records with sequence numbers above after.
+    # Bases older than the change log have marks that no record covers.
+    # So, if the follower asks for history that the log does not have,
+    # we give it every mark that exists, as if they all were stored just
+    # before the first record, and then the whole log. There may be many
+    # of those marks, so they count against the limit too, and every one
+    # but the last carries its name as "resume": the follower stays at
+    # the same after and passes the name back to get the marks past it.
+    #
+    def changes_after(self, after, limit, resume=None):
+        try:
+            f = open(self.dirname+"/changes", "rb")
+        except IOError:
+            f = None
+        try:
+            first_seq = None
+            if f is not None:
+                line = f.readline()
+                if line:
+                    try:
+                        first_seq = json.loads(line.decode('ascii'))['seq']
+                    except (ValueError, KeyError):
+                        raise AppError("Bad change log in "+self.dirname)
+            if first_seq is None:
+                base_seq = self.generation()
+                # A base older than the generation too. The marks cannot go
+                # at 0, where the follower starts, so we make a generation.
+                if base_seq == 0 and len(self.index().marks) != 0:
+                    base_seq = self.bump_generation()
+            else:
+                base_seq = first_seq - 1
+            n = 0
+            if after < base_seq:
+                dlist = self.index().marks
+                i = 0
+                if resume is not None:
+                    i = bisect_desc(dlist, resume)
+                    if i < len(dlist) and dlist[i] == resume:
+                        i += 1
+                while i < len(dlist):
+                    if n >= limit:
+                        return
+                    mark = MarkRecord(self.markdir, dlist[i])
+                    record = mark.change_record(base_seq)
+                    if i + 1 < len(dlist):
+                        record['resume'] = dlist[i]
+                    yield record
+                    n += 1
+                    i += 1
+            if f is None:
+                return
+            self.changes_seek(f, after)
+            for line in f:
+                if n >= limit:
+                    break
+                try:
+                    record = json.loads(line.decode('ascii'))
+                except ValueError:
+                    # A record being appended right now, perhaps.
+                    break
+                yield record
+                n += 1
+        finally:
+            if f is not None:
+                f.close()
+
+    #
+    # The backfill queue holds marks that were saved without a title,
+    # one file per mark in backfill/, for slasti.backfill to fetch titles.
+    # A job is a JSON dictionary with the url, attempts made, and the time
+    # of the next attempt.
+    #
+    def backfill_add(self, markname, url):
+        self.backfill_put(markname, {"url": url, "attempts": 0, "next": 0})
+
+    def backfill_put(self, markname, job):
+        qdir = self.dirname+"/backfill"
+        try:
+            os.mkdir(qdir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise AppError(str(e))
+        tmpname = qdir+"/."+markname+".tmp"
+        try:
+            f = open(tmpname, "w")
+            f.write(json.dumps(job))
+            f.close()
+            os.rename(tmpname, qdir+"/"+markname)
+        except (IOError, OSError) as e:
+            raise AppError(str(e))
+
+    def backfill_list(self):
+        try:
+            names = os.listdir(self.dirname+"/backfill")
+        except OSError:
+            return []
+        return [name for name in names if not name.startswith(".")]
+
+    def backfill_get(self, markname):
+        try:
+            f = open(self.dirname+"/backfill/"+markname, "r")
+        except IOError:
+            return None
+        try:
+            return json.loads(f.read())
         except ValueError:
             return None
+        finally:
+            f.close()
+
+    def backfill_del(self, markname):
+        try:
+            os.unlink(self.dirname+"/backfill/"+markname)
+        except OSError:
+            pass
+
+    #
+    # The link index is what slasti.linkcheck found out about the URLs of
+    # marks: a JSON dictionary of markname to {"url", "status", "final",
+    # "error", "checked"}. The status is None if there was no HTTP response
+    # at all, in which case the error says why. While a pass runs, every
+    # result is appended to the journal "links.journal", one JSON line of
+    # [markname, entry], and the pass saves the whole index at its end,
+    # which removes the journal; so a large base is not rewritten over
+    # and over, and a pass that was interrupted is not lost.
+    #
+    def links_load(self):
+        try:
+            f = open(self.dirname+"/links", "r")
+        except IOError:
+            index = {}
+        else:
+            try:
+                index = json.loads(f.read())
+            except ValueError:
+                index = {}
+            finally:
+                f.close()
+        try:
+            f = open(self.dirname+"/links.journal", "r")
+        except IOError:
+            return index
+        try:
+            for line in f:
+                try:
+                    (markname, entry) = json.loads(line)
+                except ValueError:
+                    # The last line of a pass that was killed.
+                    continue
+                index[markname] = entry
+        finally:
+            f.close()
+        return index
+
+    def links_append(self, markname, entry):
+        try:
+            fd = os.open(self.dirname+"/links.journal",
+                         os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644)
+        except OSError as e:
+            raise AppError(str(e))
+        try:
+            os.write(fd, (json.dumps([markname, entry], sort_keys=True) +
+                          "\n").encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def links_save(self, index):
+        linkname = self.dirname+"/links"
+        tmpname = linkname+".%d.tmp" % os.getpid()
+        try:
+            f = open(tmpname, "w")
+            f.write(json.dumps(index, sort_keys=True))
+            f.close()
+            os.rename(tmpname, linkname)
+        except (IOError, OSError) as e:
+            raise AppError(str(e))
+        try:
+            os.unlink(self.dirname+"/links.journal")
+        except OSError:
+            pass
+
+    #
+    # The mtime index is a journal of "mtime markname +" for stores and
+    # "mtime markname -" for deletions, appended in the order things happen.
+    # It answers "what changed since T" with one sequential read instead of
+    # opening every mark. The last record for any mark wins.
+    # Bases from before the index get one built by scanning on first use,
+    # or before the first record is appended, but of course nobody knows
+    # what was deleted before that. Appenders hold the lock shared and the
+    # rebuild holds it exclusive, so no record goes into a journal that is
+    # about to be replaced.
+    #
+    def mtime_lock(self, op):
+        try:
+            fd = os.open(self.dirname+"/mtimes.lock",
+                         os.O_RDWR|os.O_CREAT, 0o644)
+        except OSError as e:
+            raise AppError(str(e))
+        fcntl.flock(fd, op)
+        return fd
+
+    def mtime_log(self, markname, mtime, op):
+        # A journal started with only this record would hide the marks
+        # that were there before it.
+        if not os.path.exists(self.dirname+"/mtimes"):
+            self.mtime_rebuild()
+        lockfd = self.mtime_lock(fcntl.LOCK_SH)
+        try:
+            try:
+                fd = os.open(self.dirname+"/mtimes",
+                             os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644)
+            except OSError as e:
+                raise AppError(str(e))
+            try:
+                # O_APPEND writes this short are atomic among appenders.
+                os.write(fd, ("%d %s %s\n" % (mtime, markname, op)
+                              ).encode('ascii'))
+            finally:
+                os.close(fd)
+        finally:
+            os.close(lockfd)
+
+    def mtime_rebuild(self):
+        lockfd = self.mtime_lock(fcntl.LOCK_EX)
+        try:
+            # Someone else may have built it while we waited for the lock.
+            if os.path.exists(self.dirname+"/mtimes"):
+                return
+            tmpname = self.dirname+"/mtimes.%d.tmp" % os.getpid()
+            try:
+                f = open(tmpname, "w")
+            except IOError as e:
+                raise AppError(str(e))
+            # Not from the index, which a writer that calls us is in the
+            # middle of changing.
+            slasti.stats.incr("files.listdir")
+            recs = []
+            for markname in os.listdir(self.markdir):
+                mark = MarkRecord(self.markdir, markname)
+                recs.append((mark.mtime, markname))
+            recs.sort()
+            for rec in recs:
+                f.write("%d %s +\n" % rec)
+            f.close()
+            os.rename(tmpname, self.dirname+"/mtimes")
+        finally:
+            os.close(lockfd)
+
+    # Returns a list of (mtime, markname, op) changed at or after the since
+    # time, in the order of modification. Each mark is listed once. Marks
+    # are stamped in whole seconds, so a client that asks again since the
+    # last mtime it saw gets that second again, and must take what it
+    # already has as a repeat; otherwise it would miss changes made later
+    # in that same second.
+    @traced("tagbase.changed_since")
+    def changed_since(self, since):
+        try:
+            f = open(self.dirname+"/mtimes", "r")
+        except IOError:
+            self.mtime_rebuild()
+            try:
+                f = open(self.dirname+"/mtimes", "r")
+            except IOError as e:
+                raise AppError(str(e))
+        latest = {}
+        seq = 0
+        for line in f:
+            seq += 1
+            p = line.split()
+            if len(p) != 3:
+                continue
+            try:
+                mtime = float(p[0])
+            except ValueError:
+                continue
+            if mtime < since:
+                # A mark that changed before and after the since time ends
+                # up with the later record, so we may drop the earlier one.
+                continue
+            # Within the same second the journal order is the true order.
+            latest[p[1]] = (mtime, seq, p[1], p[2])
+        f.close()
+        result = list(latest.values())
+        result.sort()
+        return [(mtime, markname, op) for (mtime, seq, markname, op) in result]
+
+    # The dlist is sorted newest first, so we bisect it.
+    def lookup_name(self, tag, dlist, matchname):
+        matchindex = bisect_desc(dlist, matchname)
+        if matchindex >= len(dlist) or dlist[matchindex] != matchname:
+            return None
         return TagMark(self, tag, dlist, matchindex)
 
     #
     # XXX Add locking for consistency of concurrent updates
 
     # Store the mark body
-    def store(self, markname, stampkey, title, url, note, tags):
+    # The mark is written aside and put in place whole, so that nobody
+    # reads it half-written. With claim, it only goes in if there is no
+    # mark of the name yet, and then we return False.
+    def store(self, markname, stampkey, title, url, note, tags, mtime,
+              claim=False):
+        # Not in marks/, where it would be taken for a mark.
+        tmpname = self.dirname+"/.mark.%d.%d.tmp" % \
+                  (os.getpid(), threading.current_thread().ident)
         try:
-            f = open(self.markdir+"/"+markname, "wb+")
+            f = open(tmpname, "wb")
         except IOError as e:
             raise AppError(str(e))
 
@@ -449,7 +1464,9 @@ class TagBase:
         f = utf8_writer(f)
 
         # We write the key into the file in case we ever decide to batch marks.
+        # The modification time follows, so it survives copying of the base.
         f.write(stampkey)
+        f.write(" %d" % mtime)
         f.write("\n")
 
         f.write(title)
@@ -466,6 +1483,26 @@ class TagBase:
 
         f.close()
 
+        try:
+            if claim:
+                try:
+                    os.link(tmpname, self.markdir+"/"+markname)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise AppError(str(e))
+                    return False
+            else:
+                try:
+                    os.rename(tmpname, self.markdir+"/"+markname)
+                except OSError as e:
+                    raise AppError(str(e))
+        finally:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+        return True
+
     # Add tag links for a new mark (still, don't double-add)
     def links_add(self, markname, tags):
         for t in tags:
@@ -482,8 +1519,10 @@ class TagBase:
                 f = open(self.tagdir+"/"+fs_encode(t), "w")
             except IOError:
                 continue
+            self.index_own_write(fs_encode(t))
             f.write(tagbuf)
             f.close()
+            self.tags_own_wrote(fs_encode(t))
 
     def links_del(self, markname, tags):
         for t in tags:
@@ -501,8 +1540,10 @@ class TagBase:
                     f = open(self.tagdir+"/"+fs_encode(t), "w")
                 except IOError:
                     continue
+                self.index_own_write(fs_encode(t))
                 f.write(tagbuf)
                 f.close()
+                self.tags_own_wrote(fs_encode(t))
             else:
                 os.remove(self.tagdir+"/"+fs_encode(t))
 
@@ -518,8 +1559,13 @@ class TagBase:
         self.links_add(markname, tags_add)
 
     # The add1 constructs key from UNIX seconds.
+    @traced("tagbase.add1")
     def add1(self, timeint, title, url, note, tags):
 
+        # Before the name is claimed, which changes the directory.
+        index = self.index_begin()
+        mtime = math.floor(time.time())
+
         # for normal website-entered content fix is usually zero
         fix = 0
         while 1:
@@ -529,92 +1575,223 @@ class TagBase:
                 markname = "%010d" % timeint
             else:
                 markname = stampkey
-            if not os.path.exists(self.markdir+"/"+markname):
+            # Claim the name together with the contents, so that two
+            # requests in the same second do not both take it.
+            if self.store(markname, stampkey, title, url, note, tags, mtime,
+                          claim=True):
                 break
             fix += 1
             if fix >= 100:
                 return -1
 
-        self.store(markname, stampkey, title, url, note, tags)
         self.links_add(markname, tags)
+        self.mtime_log(markname, mtime, '+')
+        self.index_commit(index,
+            store_record(timeint, fix, mtime, title, url, note, tags),
+            markname, [], tags, True)
+        if not title:
+            self.backfill_add(markname, url)
         return fix
 
     # Edit a presumably existing tag.
-    def edit1(self, timeint, fix, title, url, note, new_tags):
+    # If it does not exist, it's created, which followers rely upon.
+    # Followers also pass the mtime, so it stays the same as in the primary.
+    @traced("tagbase.edit1")
+    def edit1(self, timeint, fix, title, url, note, new_tags, mtime=None):
         stampkey = "%010d.%02d" % (timeint, fix)
         if fix == 0:
             markname = "%010d" % timeint
         else:
             markname = stampkey
+        index = self.index_begin()
         old_tags = read_tags(self.markdir, markname)
-        self.store(markname, stampkey, title, url, note, new_tags)
+        if mtime is None:
+            mtime = math.floor(time.time())
+        self.store(markname, stampkey, title, url, note, new_tags, mtime)
         self.links_edit(markname, old_tags, new_tags)
+        self.mtime_log(markname, mtime, '+')
+        self.index_commit(index,
+            store_record(timeint, fix, mtime, title, url, note, new_tags),
+            markname, old_tags, new_tags, True)
 
+    @traced("tagbase.delete")
     def delete(self, timeint, fix):
         stampkey = "%010d.%02d" % (timeint, fix)
         if fix == 0:
             markname = "%010d" % timeint
         else:
             markname = stampkey
+        index = self.index_begin()
         old_tags = read_tags(self.markdir, markname)
         self.links_del(markname, old_tags)
         try:
             os.unlink(self.markdir+"/"+markname)
-        except IOError as e:
+        except (IOError, OSError) as e:
             raise AppError(str(e))
+        mtime = math.floor(time.time())
+        self.mtime_log(markname, mtime, '-')
+        self.index_commit(index,
+            {"op": "delete", "key": "%d.%02d" % (timeint, fix),
+             "mtime": mtime},
+            markname, old_tags, [], False)
 
     def __iter__(self):
         return TagMarkCursor(self)
 
+    # Look up a mark by the name of its file, as found in tags or indexes.
+    # Returns None if the file is gone.
+    @traced("tagbase.lookup_file")
+    def lookup_file(self, markname):
+        if not os.path.exists(self.markdir+"/"+markname):
+            return None
+        return TagMark(self, None, [markname], 0)
+
+    @traced("tagbase.lookup")
     def lookup(self, timeint, fix):
         if fix == 0:
                 matchname = "%010d" % timeint
         else:
                 matchname = "%010d.%02d" % (timeint, fix)
+        return self.lookup_name(None, self.index().marks, matchname)
 
-        # Would be nice to cache the directory in TagBase somewhere.
-        # Should we catch OSError here, incase of lookup on un-opened base?
-        dlist = os.listdir(self.markdir)
-        dlist.sort()
-        dlist.reverse()
-
-        return self.lookup_name(None, dlist, matchname)
-
+    @traced("tagbase.first")
     def first(self):
-        dlist = os.listdir(self.markdir)
-        dlist.sort()
-        dlist.reverse()
+        dlist = self.index().marks
         if len(dlist) == 0:
             return None
         return TagMark(self, None, dlist, 0)
 
+    @traced("tagbase.taglookup")
     def taglookup(self, tag, timeint, fix):
         if fix == 0:
                 matchname = "%010d" % timeint
         else:
                 matchname = "%010d.%02d" % (timeint, fix)
 
-        dlist = split_marks(load_tag(self.tagdir, tag))
-        dlist.sort()
-        dlist.reverse()
+        dlist = self.index().tag(tag)
         if len(dlist) == 0:
             return None
 
         return self.lookup_name(tag, dlist, matchname)
 
+    @traced("tagbase.tagfirst")
     def tagfirst(self, tag):
-        dlist = split_marks(load_tag(self.tagdir, tag))
-        dlist.sort()
-        dlist.reverse()
+        dlist = self.index().tag(tag)
         if len(dlist) == 0:
             return None
         return TagMark(self, tag, dlist, 0)
 
+    # The seek is for keyset paging: find the first mark that comes after
+    # the given key in our newest-first order, whether or not the mark with
+    # the key itself still exists. The list is bisected rather than scanned.
+    def seek_name(self, tag, dlist, matchname):
+        n = bisect_desc(dlist, matchname)
+        if n < len(dlist) and dlist[n] == matchname:
+            n += 1
+        if n >= len(dlist):
+            return None
+        return TagMark(self, tag, dlist, n)
+
+    @traced("tagbase.seek")
+    def seek(self, timeint, fix):
+        return self.seek_name(None, self.index().marks,
+                              key_name(timeint, fix))
+
+    @traced("tagbase.tagseek")
+    def tagseek(self, tag, timeint, fix):
+        return self.seek_name(tag, self.index().tag(tag),
+                              key_name(timeint, fix))
+
     def tagcurs(self):
         return TagTagCursor(self)
 
+    @traced("tagbase.keylookup")
     def keylookup(self, tagname):
         tag = TagTag(self, tagname)
         if tag.nmark == 0:
             return None
         return tag
+
+#
+# The BasePool keeps open bases with their indexes across requests, so
+# that a host with many users does not build every index for every request.
+# Bases unused for POOL_IDLE seconds are dropped, as are the least recently
+# used ones when there are more than POOL_SIZE, or when their indexes take
+# more than POOL_MEMORY together. Every base keeps no more than POOL_USER_MEMORY
+# of index, so that one huge account cannot push everyone else out.
+#
+POOL_SIZE = 200
+POOL_IDLE = 600
+POOL_MEMORY = 256 * 1024 * 1024
+POOL_USER_MEMORY = 32 * 1024 * 1024
+# Watch the bases with inotify, see TagBase.watch().
+POOL_WATCH = True
+
+class BasePool(object):
+    def __init__(self, size=POOL_SIZE, idle=POOL_IDLE, memory=POOL_MEMORY,
+                 user_memory=POOL_USER_MEMORY, watch=POOL_WATCH):
+        self.size = size
+        self.watch = watch
+        self.idle = idle
+        self.memory = memory
+        self.user_memory = user_memory
+        self.lock = threading.Lock()
+        # bases: dirname -> (base, last used), oldest first
+        self.bases = collections.OrderedDict()
+
+    def get(self, dirname):
+        now = time.time()
+        with self.lock:
+            entry = self.bases.pop(dirname, None)
+            if entry is not None:
+                self.bases[dirname] = (entry[0], now)
+                self.evict(now)
+        if entry is not None:
+            slasti.stats.incr("pool.hit")
+            base = entry[0]
+            # Opened while the pool did not watch, like before a fork.
+            if self.watch and base._watch is None and \
+               base._watch_pid != os.getpid():
+                base.watch()
+            return base
+        slasti.stats.incr("pool.miss")
+        base = TagBase(dirname)
+        base.open()
+        base.index_limit = self.user_memory
+        if self.watch:
+            base.watch()
+        with self.lock:
+            # Another thread may have opened it meanwhile, no matter.
+            self.bases[dirname] = (base, now)
+            self.evict(now)
+        return base
+
+    # Called with the lock held. The base just used is the last and stays.
+    def evict(self, now):
+        while len(self.bases) > 1:
+            (dirname, (base, used)) = next(iter(self.bases.items()))
+            if used >= now - self.idle and len(self.bases) <= self.size and \
+               self.index_memory() <= self.memory:
+                break
+            del self.bases[dirname]
+            base.unwatch()
+            slasti.stats.incr("pool.evict")
+
+    def index_memory(self):
+        return sum(base.index_size() for (base, used) in self.bases.values())
+
+    def clear(self):
+        with self.lock:
+            for (base, used) in self.bases.values():
+                base.unwatch()
+            self.bases.clear()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BasePool()
+        return _pool
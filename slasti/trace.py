@@ -0,0 +1,163 @@
+#
+# Slasti -- Tracing of requests
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# Spans are recorded around TagBase operations, template rendering, and
+# title fetches, so that we can see where the time of a request goes.
+# Tracing is off unless "SetEnv slasti.trace on" is given. When it is off,
+# a traced function costs one extra call and a test of a global.
+#
+# Spans nest by time. The outermost span of a thread (normally the request
+# made by main.app, but a title fetch in a worker thread also counts) makes
+# a trace, and the last TRACE_RING traces are kept in the process.
+# The logged-in page trace.json returns them as a Chrome trace, which can
+# be loaded into chrome://tracing, Perfetto, or Speedscope.
+#
+
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+TRACE_RING = 100
+# A trace of a page with 10,000 marks would be more than we want to keep.
+TRACE_EVENTS = 5000
+
+_enabled = False
+_local = threading.local()
+_lock = threading.Lock()
+_ring = collections.deque(maxlen=TRACE_RING)
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+def enabled():
+    return _enabled
+
+def configure(environ):
+    on = environ.get('slasti.trace', '').lower() in ('1', 'on', 'yes', 'true')
+    if on != _enabled:
+        enable(on)
+
+
+class Trace(object):
+    def __init__(self):
+        self.events = []
+        self.dropped = 0
+
+class Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.trace = None
+        self.root = False
+
+    def __enter__(self):
+        trace = getattr(_local, "trace", None)
+        if trace is None:
+            trace = Trace()
+            _local.trace = trace
+            self.root = True
+        self.trace = trace
+        self.t0 = time.time()
+        return self
+
+    # A span in an abandoned generator may only exit when the generator is
+    # collected, after its root. It still goes to the trace it started in.
+    def __exit__(self, exc_type, exc_value, tb):
+        t1 = time.time()
+        trace = self.trace
+        if len(trace.events) < TRACE_EVENTS or self.root:
+            trace.events.append((self.name, self.t0, t1 - self.t0,
+                                 threading.current_thread().ident,
+                                 self.args))
+        else:
+            trace.dropped += 1
+        if self.root:
+            # The trace is complete.
+            if getattr(_local, "trace", None) is trace:
+                _local.trace = None
+            with _lock:
+                _ring.append(trace)
+        return False
+
+class NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_nospan = NoSpan()
+
+def span(name, **args):
+    if not _enabled:
+        return _nospan
+    return Span(name, args)
+
+# The root of a request cannot be a with-block, because the request ends
+# when the server is done with the output, after main.app returned.
+def begin(name, **args):
+    if not _enabled:
+        return None
+    return Span(name, args).__enter__()
+
+def end(root):
+    if root is not None:
+        root.__exit__(None, None, None)
+
+# The trace of this thread, so that a server that moves a request to
+# another thread can take it along, like slasti/asgi.py.
+def current():
+    return getattr(_local, "trace", None)
+
+def resume(trace):
+    _local.trace = trace
+
+def traced(name):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def clear():
+    with _lock:
+        _ring.clear()
+
+# The kept traces in the Chrome trace event format, as a dictionary.
+def chrome_trace():
+    with _lock:
+        traces = list(_ring)
+    pid = os.getpid()
+    events = []
+    for trace in traces:
+        for (name, t0, dur, tid, args) in trace.events:
+            event = {"name": name, "cat": name.split(".")[0], "ph": "X",
+                     "ts": int(t0 * 1000000), "dur": int(dur * 1000000),
+                     "pid": pid, "tid": tid}
+            if args:
+                event["args"] = args
+            events.append(event)
+        if trace.dropped:
+            events.append({"name": "dropped", "ph": "i", "s": "t",
+                           "ts": int(trace.events[-1][1] * 1000000),
+                           "pid": pid, "tid": trace.events[-1][3],
+                           "args": {"count": trace.dropped}})
+    events.sort(key=lambda e: e["ts"])
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def dump(filename):
+    with open(filename, "w") as f:
+        json.dump(chrome_trace(), f)
@@ -0,0 +1,148 @@
+#
+# Slasti -- Watching bases for changes with inotify
+#
+# Copyright (C) 2011 Pete Zaitcev
+# See file COPYING for licensing information (expect GPL 2).
+#
+# A base in the pool checks the stamp of its index (see TagBase.index_stamp)
+# on every request, which costs a read of the generation and two stats,
+# because admins run scripts and del2sla against live bases. On Linux we
+# can be told instead: a thread reads inotify events for the directories
+# of the watched bases and marks their indexes dirty, and until then a
+# request uses the index without looking at the disk at all.
+#
+# We talk to inotify through ctypes, so nothing needs to be installed.
+# Where inotify does not work, or we run out of watches, or after a fork
+# (the thread does not survive it), bases go back to checking the stamp.
+#
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import threading
+
+from slasti import AppError
+import slasti
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+# What adds or removes names in a directory, or moves it away.
+IN_NAMES = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+           IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT = struct.Struct("iIII")
+READSZ = 65536
+
+
+class Watcher(object):
+    def __init__(self):
+        name = ctypes.util.find_library("c") or "libc.so.6"
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            self.rm_watch = libc.inotify_rm_watch
+            fd = libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise AppError("No inotify: %s" % str(e))
+        if fd < 0:
+            raise AppError("inotify_init1: %s" %
+                           os.strerror(ctypes.get_errno()))
+        self.fd = fd
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # callbacks: wd -> callback(mask, name)
+        self.callbacks = {}
+        self.thread = threading.Thread(target=self.run, name="slasti-watch")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # A watcher made by our parent before the fork is no good to us.
+    def alive(self):
+        return self.pid == os.getpid() and self.thread.is_alive()
+
+    def add(self, path, mask, callback):
+        wd = self.add_watch(self.fd, slasti.safestr(path), mask)
+        if wd < 0:
+            raise AppError("inotify_add_watch %s: %s" %
+                           (path, os.strerror(ctypes.get_errno())))
+        with self.lock:
+            self.callbacks[wd] = callback
+        return wd
+
+    def remove(self, wd):
+        with self.lock:
+            if self.callbacks.pop(wd, None) is None:
+                return
+        # The kernel may have dropped it already if the directory is gone.
+        self.rm_watch(self.fd, wd)
+
+    def run(self):
+        while True:
+            try:
+                buf = os.read(self.fd, READSZ)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            self.dispatch(buf)
+        # Nobody tells the bases any more, so they must look themselves.
+        self.overflow()
+
+    def dispatch(self, buf):
+        pos = 0
+        while pos + EVENT.size <= len(buf):
+            (wd, mask, cookie, length) = EVENT.unpack_from(buf, pos)
+            name = buf[pos + EVENT.size:pos + EVENT.size + length]
+            name = name.rstrip(b"\0").decode('utf-8', 'replace') or None
+            pos += EVENT.size + length
+            slasti.stats.incr("watch.events")
+            if mask & IN_Q_OVERFLOW:
+                self.overflow()
+                continue
+            with self.lock:
+                if mask & IN_IGNORED:
+                    callback = self.callbacks.pop(wd, None)
+                else:
+                    callback = self.callbacks.get(wd)
+            if callback is not None:
+                callback(mask, name)
+
+    # Events were lost, so everyone is told that something changed.
+    def overflow(self):
+        with self.lock:
+            callbacks = list(self.callbacks.values())
+        for callback in callbacks:
+            callback(IN_Q_OVERFLOW, None)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+# The process where making a watcher failed, so we do not try every time.
+_watcher_failed = None
+
+# The watcher of this process, or None if inotify does not work here.
+def get_watcher():
+    global _watcher, _watcher_failed
+    with _watcher_lock:
+        if _watcher is not None and _watcher.alive():
+            return _watcher
+        if _watcher_failed == os.getpid():
+            return None
+        try:
+            _watcher = Watcher()
+        except AppError:
+            _watcher = None
+            _watcher_failed = os.getpid()
+        return _watcher
@@ -1,15 +1,217 @@
+import asyncio
 import bs4
+import errno
+import gzip
+import importlib.machinery
+import importlib.util
+import io
+import json
 import math
+import os
+import pstats
+import random
 import shutil
+import signal
+import socket
+import subprocess
+import sys
 import tempfile
+import threading
 import time
 import unittest
 
 from jinja2 import Environment, DictLoader
 
 import six
+from six.moves import BaseHTTPServer, http_client, socketserver
 
 import slasti
+import slasti.asgi
+import slasti.fetch
+import slasti.follow
+import slasti.linkcheck
+import slasti.render
+import slasti.wsgi
+
+
+# The slasti.wsgi is not a module name, so it cannot be simply imported.
+def load_wsgi():
+    wsgi_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "slasti.wsgi")
+    loader = importlib.machinery.SourceFileLoader("slasti_wsgi", wsgi_path)
+    spec = importlib.util.spec_from_loader("slasti_wsgi", loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def load_bench(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, "bench", name + ".py")
+    loader = importlib.machinery.SourceFileLoader("bench_" + name, path)
+    spec = importlib.util.spec_from_loader("bench_" + name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+# Call the WSGI application in-process as if it came over HTTP.
+def wsgi_call(application, userconf, method, path, body=None, headers=None,
+              extra=None):
+    if isinstance(body, six.text_type):
+        body = body.encode('utf-8')
+    if '?' in path:
+        path, query = path.split('?', 1)
+    else:
+        query = ''
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'HTTP_HOST': 'localhost',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body or b''),
+        'slasti.userconf': userconf,
+    }
+    if body is not None:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    for name, value in (headers or {}).items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    environ.update(extra or {})
+
+    status_ = [None]
+    headers_ = [None]
+
+    def start_response(status, response_headers):
+        status_[0] = status
+        headers_[0] = response_headers
+
+    output = application(environ, start_response)
+    body = b''.join(output)
+    if hasattr(output, 'close'):
+        output.close()
+    return (int(status_[0].split()[0]),
+            dict((k.lower(), v) for (k, v) in headers_[0]), body)
+
+# The same for an ASGI application, with nothing but asyncio.
+async def asgi_request(application, method, path, body=None, headers=None):
+    if isinstance(body, six.text_type):
+        body = body.encode('utf-8')
+    if '?' in path:
+        path, query = path.split('?', 1)
+    else:
+        query = ''
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'root_path': '',
+        'query_string': query.encode('latin-1'),
+        'scheme': 'http',
+        'http_version': '1.1',
+        'server': ('localhost', 80),
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                    for (k, v) in (headers or {}).items()],
+    }
+    if body is not None:
+        scope['headers'].append((b'content-length',
+                                 str(len(body)).encode('ascii')))
+    messages = []
+    sent = [False]
+
+    async def receive():
+        if sent[0]:
+            # Nobody disconnects in tests.
+            await asyncio.Event().wait()
+        sent[0] = True
+        return {'type': 'http.request', 'body': body or b'',
+                'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await application(scope, receive, send)
+    start = messages[0]
+    return (start['status'],
+            dict((k.decode('latin-1'), v.decode('latin-1'))
+                 for (k, v) in start['headers']),
+            b''.join(m.get('body', b'') for m in messages[1:]))
+
+def asgi_call(application, method, path, body=None, headers=None):
+    return asyncio.run(asgi_request(application, method, path, body,
+                                    headers))
+
+
+# A local web server for the fetching tests. The pages are a dict of path
+# to (delay, content type, body), or to (delay, None, location) to redirect.
+# Every request is logged as (client port, path), so that tests can see
+# how many connections were used.
+class LocalHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def start_http_server(pages, log=None):
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if log is not None:
+                log.append((self.client_address[1], self.path))
+            if self.path not in pages:
+                self.send_error(404)
+                return
+            delay, ctype, body = pages[self.path]
+            time.sleep(delay)
+            if ctype is None:
+                self.send_response(302)
+                self.send_header("Location", body)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        do_HEAD = do_GET
+
+        def log_message(self, format, *args):
+            pass
+
+    server = LocalHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+def stop_http_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+# user_password = "PassWord"
+TEST_USER_SALT = "abcdef"
+TEST_USER_PASS = "8bb4b4f91dcfafbfea438ae0132bbd20"
+
+def write_userconf(dirname, users):
+    userconf = os.path.join(dirname, "slasti-users.conf")
+    with open(userconf, "w") as f:
+        json.dump([{"name": name, "type": "fs", "root": root,
+                    "salt": TEST_USER_SALT, "pass": TEST_USER_PASS}
+                   for (name, root) in users], f)
+    return userconf
+
+# Log in as the user of userpath and return the Cookie: header for it.
+def wsgi_login(application, userconf, userpath):
+    status, headers, body = wsgi_call(
+        application, userconf, 'POST', userpath + '/login',
+        'password=PassWord&OK=Enter',
+        {'Content-Type': 'application/x-www-form-urlencoded'})
+    assert status == 303
+    return headers['set-cookie'].split(';')[0]
 
 
 class FakeMark(object):
@@ -21,6 +223,13 @@ class FakeMark(object):
         # Setting the modification time to be the same as creation time.
         self.mtime = float(stamp0)
 
+        self.stamp0 = stamp0
+        self.stamp1 = 0
+        self.title = "Test_title"
+        self.url = "http://www.ibm.com/"
+        self.note = ""
+        self.tags = [ourtag or "test_tag"]
+
     def key(self):
         return (self._stamp0, 0)
 
@@ -47,10 +256,10 @@ class FakeMark(object):
         }
         return jsondict
 
-    def succ(self):
+    def succ(self, n=1):
         return None
 
-    def pred(self):
+    def pred(self, n=1):
         return None
 
 
@@ -59,6 +268,7 @@ class FakeBase(object):
     def __init__(self, time0=None, tag=None):
         self._time0 = time0
         self._tag = tag or "test"
+        self.dirname = "/missing"
 
     def lookup(self, timeint, fix):
         if fix != 0:
@@ -178,6 +388,288 @@ class TestUnit(unittest.TestCase):
 
         shutil.rmtree(base_dir)
 
+    def test_export_snapshot(self):
+
+        status_ = [None]
+        headers_ = [None]
+
+        def fake_start_response(status, headers):
+            status_[0] = status
+            headers_[0] = dict(headers)
+
+        base_dir = tempfile.mkdtemp()
+        user = {'name': "auser", 'type': "fs", 'root': base_dir}
+        base = slasti.tagbase.TagBase(base_dir)
+        base.open()
+        base.add1(1348242433, "moo", "http://xxxx", "", ["a", "b"])
+
+        def export(headers):
+            ctx = slasti.Context("", user, base, 'GET', 'http', 'localhost',
+                                 'export.xml', None, None, None, None,
+                                 headers)
+            return b''.join(slasti.main.full_mark_xml(fake_start_response,
+                                                      ctx))
+
+        full = export({})
+        self.assertTrue(status_[0].startswith("200 "))
+        self.assertEqual(headers_[0]['Content-Length'], str(len(full)))
+        self.assertIn(b'description="moo"', full)
+        etag = headers_[0]['ETag']
+
+        # Unchanged base, unchanged tag.
+        body = export({'If-None-Match': etag})
+        self.assertTrue(status_[0].startswith("304 "))
+        self.assertEqual(body, b'')
+
+        body = export({'Range': 'bytes=5-9'})
+        self.assertTrue(status_[0].startswith("206 "))
+        self.assertEqual(body, full[5:10])
+        self.assertEqual(headers_[0]['Content-Range'],
+                         'bytes 5-9/%d' % len(full))
+
+        body = export({'Range': 'bytes=-4'})
+        self.assertEqual(body, full[-4:])
+
+        body = export({'Range': 'bytes=%d-' % (len(full) + 10)})
+        self.assertTrue(status_[0].startswith("416 "))
+
+        # A Range with a stale If-Range gets the whole thing.
+        body = export({'Range': 'bytes=5-9', 'If-Range': '"stale"'})
+        self.assertTrue(status_[0].startswith("200 "))
+        self.assertEqual(body, full)
+
+        body = export({'Accept-Encoding': 'deflate, gzip'})
+        self.assertEqual(headers_[0]['Content-Encoding'], 'gzip')
+        self.assertNotEqual(headers_[0]['ETag'], etag)
+        self.assertEqual(gzip.GzipFile(fileobj=six.BytesIO(body)).read(),
+                         full)
+
+        # Any change to the base makes a new snapshot.
+        base.add1(1348242440, "new", "http://yyyy", "", ["a"])
+        body = export({'If-None-Match': etag})
+        self.assertTrue(status_[0].startswith("200 "))
+        self.assertNotEqual(headers_[0]['ETag'], etag)
+        self.assertIn(b'description="new"', body)
+
+        # Old generations are cleaned up.
+        self.assertEqual(len(os.listdir(base_dir + "/cache")), 2)
+
+        # Another request writes and prunes our snapshot after we made
+        # sure of it, but before we opened it.
+        ensure = slasti.export.Snapshot.ensure
+        def racing_ensure(snap, dumper):
+            ret = ensure(snap, dumper)
+            if racing_ensure.once:
+                racing_ensure.once = False
+                base.add1(1348242450, "third", "http://zzzz", "", ["a"])
+                later = slasti.export.Snapshot(base)
+                later.ensure(slasti.main.MarkDumper(base, user))
+            return ret
+        racing_ensure.once = True
+        slasti.export.Snapshot.ensure = racing_ensure
+        try:
+            body = export({})
+        finally:
+            slasti.export.Snapshot.ensure = ensure
+        self.assertTrue(status_[0].startswith("200 "))
+        self.assertIn(b'description="third"', body)
+        self.assertEqual(headers_[0]['ETag'],
+                         slasti.export.Snapshot(base).etag(False))
+
+        shutil.rmtree(base_dir)
+
+    def test_export_since(self):
+
+        def fake_start_response(status, headers):
+            pass
+
+        base_dir = tempfile.mkdtemp()
+        user = {'name': "auser", 'type': "fs", 'root': base_dir}
+        base = slasti.tagbase.TagBase(base_dir)
+        base.open()
+
+        def export(since):
+            ctx = slasti.Context("", user, base, 'GET', 'http', 'localhost',
+                                 'export.xml', 'since=%d' % since, None,
+                                 None, None)
+            body = b''.join(slasti.main.full_mark_xml(fake_start_response,
+                                                      ctx))
+            soup = bs4.BeautifulSoup(body, "xml")
+            return ([(p['key'], p['description']) for p in soup('post')],
+                    [d['key'] for d in soup('deleted')])
+
+        now = math.floor(time.time())
+        base.add1(1348242431, "one", "http://one", "", ["a"])
+        base.add1(1348242433, "two", "http://two", "", ["a", "b"])
+        base.add1(1348242435, "three", "http://three", "", ["b"])
+
+        # The mtime is kept in the mark itself.
+        mark = base.lookup(1348242433, 0)
+        self.assertGreaterEqual(mark.mtime, now)
+
+        posts, deleted = export(now - 1)
+        self.assertEqual(posts, [('1348242431.00', 'one'),
+                                 ('1348242433.00', 'two'),
+                                 ('1348242435.00', 'three')])
+        self.assertEqual(deleted, [])
+
+        base.edit1(1348242431, 0, "uno", "http://one", "", ["a"])
+        base.delete(1348242433, 0)
+        posts, deleted = export(now - 1)
+        self.assertEqual(posts, [('1348242435.00', 'three'),
+                                 ('1348242431.00', 'uno')])
+        self.assertEqual(deleted, ['1348242433.00'])
+
+        posts, deleted = export(time.time() + 1)
+        self.assertEqual((posts, deleted), ([], []))
+
+        # Since the second of the last change, later changes in the same
+        # second are not missed, and the last one is sent again.
+        since = base.lookup(1348242431, 0).mtime
+        base.edit1(1348242435, 0, "tres", "http://three", "", ["b"],
+                   mtime=since)
+        posts, deleted = export(since)
+        self.assertIn(('1348242431.00', 'uno'), posts)
+        self.assertIn(('1348242435.00', 'tres'), posts)
+
+        # A lost index is rebuilt from the marks, minus the tombstones.
+        os.unlink(base_dir + "/mtimes")
+        posts, deleted = export(now - 1)
+        self.assertEqual(sorted(posts), [('1348242431.00', 'uno'),
+                                         ('1348242435.00', 'tres')])
+        self.assertEqual(deleted, [])
+
+        # A base from before the index, where a write comes first: the
+        # marks that were there before it are not lost.
+        os.unlink(base_dir + "/mtimes")
+        base.add1(1348242437, "four", "http://four", "", ["b"])
+        posts, deleted = export(0)
+        self.assertEqual(sorted(posts), [('1348242431.00', 'uno'),
+                                         ('1348242435.00', 'tres'),
+                                         ('1348242437.00', 'four')])
+
+        shutil.rmtree(base_dir)
+
+    def test_follow(self):
+
+        top_dir = tempfile.mkdtemp()
+        primary_dir = os.path.join(top_dir, "primary")
+        mirror_dir = os.path.join(top_dir, "mirror")
+        os.mkdir(primary_dir)
+        os.mkdir(mirror_dir)
+        userconf = write_userconf(top_dir, [("auser", primary_dir)])
+        wsgi = load_wsgi()
+
+        class WSGISource(slasti.follow.HTTPSource):
+            def request(self, method, path, body, headers):
+                status, rhdrs, rbody = wsgi_call(
+                    wsgi.application, userconf, method, path, body, headers)
+                return (status, rhdrs, io.BytesIO(rbody))
+
+        primary = slasti.tagbase.TagBase(primary_dir)
+        primary.open()
+        primary.add1(1348242431, "one", "http://one", "", ["a"])
+        primary.add1(1348242433, "two", "http://two", "note", ["a", "b"])
+        # Pretend these marks predate the change log.
+        os.unlink(primary_dir + "/changes")
+        primary.add1(1348242435, "three", "http://three", "", ["b"])
+
+        mirror = slasti.tagbase.TagBase(mirror_dir)
+        mirror.open()
+        follower = slasti.follow.Follower(
+            mirror, WSGISource("http://localhost/auser", "PassWord"))
+
+        def dump(base):
+            marks = [(m.key(), m.mtime, m.title, m.url, m.note, m.tags)
+                     for m in base]
+            tags = [(t.key(), t.num()) for t in base.tagcurs()]
+            return (marks, tags)
+
+        # All 3 marks as of now, then the 1 record in the log.
+        self.assertEqual(follower.poll(), 4)
+        self.assertEqual(dump(mirror), dump(primary))
+        self.assertEqual(follower.position(), primary.generation())
+        self.assertEqual(follower.poll(), 0)
+
+        primary.edit1(1348242431, 0, "uno", "http://one", "", ["c"])
+        primary.delete(1348242433, 0)
+        primary.add1(1348242435, "three again", "http://3", "", ["b", "c"])
+        self.assertEqual(follower.poll(), 3)
+        self.assertEqual(dump(mirror), dump(primary))
+        self.assertEqual(follower.position(), primary.generation())
+
+        gen = primary.generation()
+        records = list(primary.changes_after(gen - 2, 1))
+        self.assertEqual([r['seq'] for r in records], [gen - 1])
+
+        # Without the login cookie, there are no changes to be had.
+        status, rhdrs, body = wsgi_call(wsgi.application, userconf,
+                                        'GET', '/auser/changes?after=0')
+        self.assertEqual(status, 403)
+
+        # A base made before the generation and the change log.
+        os.unlink(primary_dir + "/changes")
+        os.unlink(primary_dir + "/generation")
+        mirror_dir = os.path.join(top_dir, "mirror2")
+        os.mkdir(mirror_dir)
+        mirror = slasti.tagbase.TagBase(mirror_dir)
+        mirror.open()
+        follower = slasti.follow.Follower(
+            mirror, WSGISource("http://localhost/auser", "PassWord"))
+        # The marks count against the limit, and the follower resumes.
+        records = list(primary.changes_after(0, 2))
+        self.assertEqual([r.get('resume') for r in records],
+                         ["1348242435.01", "1348242435"])
+        records = list(primary.changes_after(0, 2, "1348242435"))
+        self.assertEqual([(r['key'], r.get('resume')) for r in records],
+                         [("1348242431.00", None)])
+        limit = slasti.main.CHANGES_LIMIT
+        slasti.main.CHANGES_LIMIT = 2
+        try:
+            self.assertEqual(follower.poll(), 3)
+        finally:
+            slasti.main.CHANGES_LIMIT = limit
+        self.assertEqual(dump(mirror), dump(primary))
+        self.assertEqual(follower.read_position(),
+                         (primary.generation(), None))
+        self.assertEqual(follower.poll(), 0)
+        primary.add1(1348242437, "four", "http://four", "", ["a"])
+        self.assertEqual(follower.poll(), 1)
+        self.assertEqual(dump(mirror), dump(primary))
+
+        shutil.rmtree(top_dir)
+
+    def test_follow_http(self):
+
+        record = {"op": "delete", "key": "1348242431.00", "mtime": 1,
+                  "seq": 1}
+        server, url = start_http_server({
+            "/auser/changes?after=0":
+                (0, "application/json", json.dumps(record).encode('ascii')),
+        })
+        conns = []
+        saved = http_client.HTTPConnection
+
+        class CountingConnection(saved):
+            def __init__(self, *args, **kwargs):
+                saved.__init__(self, *args, **kwargs)
+                conns.append(self)
+
+        http_client.HTTPConnection = CountingConnection
+        try:
+            source = slasti.follow.HTTPSource(url + "/auser", "PassWord")
+            source.cookie = "login=x"
+            self.assertEqual(list(source.changes(0)), [record])
+            self.assertRaises(slasti.AppError, list, source.changes(1))
+        finally:
+            http_client.HTTPConnection = saved
+            stop_http_server(server)
+
+        # Every response closes its connection, read through or not.
+        self.assertEqual(len(conns), 2)
+        for conn in conns:
+            self.assertIsNone(conn.sock)
+
     def test_fetch_parse(self):
 
         html1 = """
@@ -186,7 +678,7 @@ class TestUnit(unittest.TestCase):
                 <body><p>moo</p></body>
             </html>
         """
-        title1 = slasti.main.fetch_parse(html1)
+        title1 = slasti.fetch.fetch_parse(html1)
         self.assertEqual('Simple Test', title1)
 
         html2 = """
@@ -195,9 +687,745 @@ class TestUnit(unittest.TestCase):
                 <body><p>moo</p></body>
             </html>
         """
-        title2 = slasti.main.fetch_parse(html2)
+        title2 = slasti.fetch.fetch_parse(html2)
         self.assertEqual(u'The Online Comic \xa91999-2010 Greg Dean', title2)
 
+    def test_fetch_title(self):
+
+        # The title comes after a head stuffed with a big script, and we do
+        # not send the rest of the page until the title was read. If the
+        # fetch wants more than it needs, it hangs and fails the test.
+        script = b"<script>" + b"var x = '<title>no</title>';\n" * 2000 + \
+                 b"</script>"
+        head = b"<html><head>" + script + \
+               b"<title>\xd0\x97\xd0\xb0\xd0\xb3\n &amp; more</title>"
+        rest = b"</head><body>moo</body></html>"
+        event = threading.Event()
+
+        class StallingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                ctype = {"/utf8": "text/html; charset=utf-8",
+                         "/meta": "text/html"}[self.path]
+                self.send_header("Content-Type", ctype)
+                self.end_headers()
+                if self.path == "/meta":
+                    self.wfile.write(
+                        b'<html><head><meta http-equiv="Content-Type" '
+                        b'content="text/html; charset=koi8-r">'
+                        b'<title>\xfa\xc1\xc7</title></head></html>')
+                    return
+                self.wfile.write(head)
+                self.wfile.flush()
+                event.wait(10)
+                self.wfile.write(rest)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = LocalHTTPServer(("127.0.0.1", 0), StallingHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+        try:
+            title = slasti.fetch.fetch_url_title(url + "/utf8", timeout=5)
+            self.assertEqual(title, u'\u0417\u0430\u0433 & more')
+            title = slasti.fetch.fetch_url_title(url + "/meta", timeout=5)
+            self.assertEqual(title, u'\u0417\u0430\u0433')
+        finally:
+            event.set()
+            stop_http_server(server)
+
+        # No title at all is an error of the target.
+        self.assertRaises(slasti.App400Error, slasti.fetch.fetch_parse,
+                          b"<html><body>moo</body></html>")
+        self.assertEqual(slasti.fetch.fetch_parse(b"<title>&#x263a;</title>"),
+                         u'\u263a')
+
+    def test_fetch_cache(self):
+
+        html = b"<html><head><title>Fast</title></head><body>" + \
+               b"moo" * 1000 + b"</body></html>"
+        log = []
+        server, url = start_http_server({
+            "/fast": (0, "text/html", html),
+            "/text": (0, "text/plain", b"Fast"),
+            "/r1": (0, None, "/r2"),
+            "/r2": (0, None, "/fast"),
+            "/loop": (0, None, "/loop"),
+        }, log)
+        save_cache = slasti.fetch._cache
+        save_conns = slasti.fetch._conns
+        slasti.fetch._cache = slasti.fetch.TitleCache()
+        slasti.fetch._conns = slasti.fetch.ConnPool()
+        try:
+            self.assertEqual(slasti.fetch.fetch_title(url + "/fast"), "Fast")
+            self.assertEqual(slasti.fetch.fetch_title(url + "/fast"), "Fast")
+            self.assertEqual(len(log), 1)
+
+            # Failures are cached too.
+            for n in range(2):
+                self.assertRaises(slasti.App400Error,
+                                  slasti.fetch.fetch_title, url + "/text")
+            self.assertEqual(len(log), 2)
+
+            self.assertEqual(slasti.fetch.fetch_title(url + "/r1"), "Fast")
+            self.assertEqual(len(log), 5)
+            self.assertRaises(slasti.App400Error,
+                              slasti.fetch.fetch_title, url + "/loop")
+
+            # All of it went over the one kept-alive connection.
+            self.assertEqual(len(set(port for (port, path) in log)), 1)
+        finally:
+            slasti.fetch._conns.close()
+            slasti.fetch._cache = save_cache
+            slasti.fetch._conns = save_conns
+            stop_http_server(server)
+
+    def test_fetch_pool(self):
+
+        html = b"<html><head><title>Fast</title></head></html>"
+        server, url = start_http_server({
+            "/fast": (0, "text/html", html),
+            "/slow": (1.0, "text/html", html),
+            "/text": (0, "text/plain", b"Fast"),
+        })
+        try:
+            pool = slasti.fetch.FetchPool(workers=2, queue=0, per_host=5,
+                                          deadline=0.3, failures=2,
+                                          cooldown=60)
+            fn = slasti.fetch.fetch_url_title
+
+            self.assertEqual(pool.call(url + "/fast", fn), "Fast")
+            self.assertRaises(slasti.App400Error,
+                              pool.call, url + "/text", fn)
+
+            # The deadline trips, and then the breaker opens for the host,
+            # so the third attempt does not even wait for the deadline.
+            for n in range(2):
+                self.assertRaises(slasti.App503Error,
+                                  pool.call, url + "/slow", fn)
+            t0 = time.time()
+            self.assertRaises(slasti.App503Error,
+                              pool.call, url + "/fast", fn)
+            self.assertLess(time.time() - t0, 0.1)
+
+            # Workers still stuck on /slow hold both slots; a different
+            # host (same server by another name) finds the pool saturated.
+            other = url.replace("127.0.0.1", "localhost")
+            t0 = time.time()
+            self.assertRaises(slasti.App503Error,
+                              pool.call, other + "/fast", fn)
+            self.assertLess(time.time() - t0, 0.1)
+
+            # Once the workers finish, the other host works fine.
+            time.sleep(1.0)
+            self.assertEqual(pool.call(other + "/fast", fn), "Fast")
+
+            # A host that refuses is an error of the URL, not a timeout,
+            # and does not open the breaker.
+            sock = socket.socket()
+            sock.bind(("127.0.0.1", 0))
+            refused = "http://127.0.0.1:%d/" % sock.getsockname()[1]
+            sock.close()
+            for n in range(3):
+                self.assertRaises(slasti.App400Error, pool.call, refused, fn)
+            pool.shutdown()
+        finally:
+            stop_http_server(server)
+
+    def test_asgi(self):
+
+        html = b"<html><head><title>Slow</title></head></html>"
+        server, url = start_http_server({
+            "/slow": (1.0, "text/html", html),
+        })
+        top_dir = tempfile.mkdtemp()
+        base_dir = os.path.join(top_dir, "base")
+        os.mkdir(base_dir)
+        try:
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(30):
+                base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                          ["a"])
+            base.close()
+            userconf = write_userconf(top_dir, [("auser", base_dir)])
+            wsgi = load_wsgi()
+            # One thread, so a fetch that held it would stop everything.
+            app = slasti.asgi.Application(userconf, threads=1)
+
+            for path in ("/auser/", "/auser/a/page.1348242440.00",
+                         "/auser/mark.1348242431.00", "/auser/tags"):
+                status, headers, body = asgi_call(app, 'GET', path)
+                self.assertEqual(status, 200)
+                self.assertEqual(headers['content-type'],
+                                 'text/html; charset=utf-8')
+                self.assertEqual(body, wsgi_call(wsgi.application, userconf,
+                                                 'GET', path)[2])
+            status, headers, body = asgi_call(app, 'GET', '/auser/nosuch')
+            self.assertEqual(status, 404)
+            status, headers, body = asgi_call(app, 'GET', '/')
+            self.assertEqual(status, 200)
+
+            status, headers, body = asgi_call(app, 'POST', '/auser/login',
+                'password=PassWord&OK=Enter',
+                {'Content-Type': 'application/x-www-form-urlencoded'})
+            self.assertEqual(status, 303)
+            cookie = {'Cookie': headers['set-cookie'].split(';')[0]}
+            status, headers, body = asgi_call(app, 'POST',
+                '/auser/mark.1348242431.00',
+                'title=Edited&href=http%3A%2F%2Fx%2F0&tags=a&extra=',
+                cookie)
+            self.assertEqual(status, 200)
+            self.assertIn(b"Edited", body)
+
+            fetch = '/auser/fetchtitle?url=' + url + '/slow'
+            status, headers, body = asgi_call(app, 'GET', fetch)
+            self.assertEqual(status, 403)
+
+            done = []
+            async def timed(name, path):
+                result = await asgi_request(app, 'GET', path, None, cookie)
+                done.append(name)
+                return result
+            async def both():
+                return await asyncio.gather(timed("fetch", fetch),
+                                            timed("page", '/auser/'))
+            t0 = time.time()
+            (fetched, page) = asyncio.run(both())
+            self.assertEqual(done, ["page", "fetch"])
+            self.assertGreaterEqual(time.time() - t0, 1.0)
+            self.assertEqual(fetched[0], 200)
+            self.assertEqual(fetched[2], b"Slow\r\n")
+            self.assertEqual(page[0], 200)
+
+            # The chunks of a page come from any of the threads, but the
+            # counters and the trace stay with their request.
+            app = slasti.asgi.Application(userconf, threads=4,
+                                          extra={'slasti.trace': 'on'})
+            slasti.stats.get_stats().reset()
+            slasti.trace.clear()
+            async def many():
+                return await asyncio.gather(*[
+                    asgi_request(app, 'GET', '/auser/a/') for n in range(6)])
+            try:
+                for result in asyncio.run(many()):
+                    self.assertEqual(result[0], 200)
+            finally:
+                slasti.trace.enable(False)
+            hists = slasti.stats.get_stats().snapshot()["histograms"]
+            self.assertEqual(hists["request.files.open"]["count"], 6)
+            traces = list(slasti.trace._ring)
+            self.assertEqual(len(traces), 6)
+            for trace in traces:
+                roots = [e for e in trace.events
+                         if e[0].startswith("request.")]
+                self.assertEqual(len(roots), 1)
+        finally:
+            stop_http_server(server)
+            shutil.rmtree(top_dir)
+
+    def test_serve(self):
+        top_dir = tempfile.mkdtemp()
+        base_dir = os.path.join(top_dir, "base")
+        os.mkdir(base_dir)
+        proc = None
+        try:
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(30):
+                base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                          ["a"])
+            base.close()
+            userconf = write_userconf(top_dir, [("auser", base_dir)])
+            wsgi = load_wsgi()
+            front = wsgi_call(wsgi.application, userconf, 'GET', '/auser/')[2]
+
+            proc = subprocess.Popen(
+                [sys.executable, "-m", "slasti.serve", "-b", "127.0.0.1:0",
+                 "-w", "2", "-t", "2", userconf],
+                cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 os.pardir),
+                stdout=subprocess.PIPE)
+            line = proc.stdout.readline().decode('ascii')
+            port = int(line.split()[3].rstrip(',').rsplit(':', 1)[1])
+
+            def session():
+                conn = http_client.HTTPConnection("127.0.0.1", port,
+                                                  timeout=10)
+                # Several requests over one connection, the page chunked.
+                conn.request('GET', '/auser/')
+                resp = conn.getresponse()
+                self.assertEqual(resp.status, 200)
+                self.assertEqual(resp.getheader('Transfer-Encoding'),
+                                 'chunked')
+                self.assertEqual(resp.read(), front)
+                conn.request('HEAD', '/auser/mark.1348242431.00')
+                resp = conn.getresponse()
+                self.assertEqual(resp.status, 200)
+                self.assertEqual(resp.read(), b'')
+                conn.request('POST', '/auser/login',
+                             'password=PassWord&OK=Enter',
+                             {'Content-Type':
+                                  'application/x-www-form-urlencoded'})
+                resp = conn.getresponse()
+                self.assertEqual(resp.status, 303)
+                resp.read()
+                conn.request('GET', '/auser/nosuch')
+                resp = conn.getresponse()
+                self.assertEqual(resp.status, 404)
+                resp.read()
+                conn.close()
+
+            session()
+            # The new workers serve just the same.
+            proc.send_signal(signal.SIGHUP)
+            time.sleep(0.5)
+            session()
+
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(proc.wait(20), 0)
+            proc.stdout.close()
+            proc = None
+        finally:
+            if proc is not None:
+                proc.kill()
+                proc.wait()
+                proc.stdout.close()
+            shutil.rmtree(top_dir)
+
+    def test_backfill(self):
+
+        html = b"<html><head><title>Found</title></head></html>"
+        server, url = start_http_server({
+            "/found": (0, "text/html", html),
+        })
+        base_dir = tempfile.mkdtemp()
+        try:
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            base.add1(1348242431, "", url + "/found", "a note", ["a"])
+            base.add1(1348242433, "", url + "/missing", "", ["b"])
+            base.add1(1348242435, "titled", url + "/found", "", ["c"])
+            self.assertEqual(len(base.backfill_list()), 2)
+
+            backfiller = slasti.backfill.Backfiller(
+                fetch=slasti.fetch.fetch_url_title, interval=0,
+                host_interval=0)
+            # The 404 fails, and waits for its next attempt.
+            self.assertEqual(backfiller.run_once(base), 1)
+            mark = base.lookup_file("1348242431")
+            self.assertEqual(mark.title, "Found")
+            self.assertEqual(mark.note, "a note")
+            self.assertEqual(mark.tags, ["a"])
+
+            # Not due yet, so nothing happens.
+            self.assertEqual(backfiller.run_once(base), 1)
+            job = base.backfill_get("1348242433")
+            self.assertEqual(job["attempts"], 1)
+
+            # Keep retrying until the job is dropped.
+            for n in range(slasti.backfill.BACKFILL_ATTEMPTS - 1):
+                job["next"] = 0
+                base.backfill_put("1348242433", job)
+                backfiller.run_once(base)
+                job = base.backfill_get("1348242433")
+            self.assertEqual(job, None)
+            self.assertEqual(base.backfill_list(), [])
+            self.assertEqual(base.lookup_file("1348242433").title, "")
+
+            # The thread of the server outlives errors that are not ours.
+            calls = []
+            def fetch(url):
+                calls.append(url)
+                if len(calls) == 1:
+                    raise socket.error(errno.ECONNRESET, "reset")
+                return "Later"
+            thread = slasti.backfill.BackfillThread(
+                slasti.backfill.Backfiller(fetch=fetch, interval=0,
+                                           host_interval=0))
+            base.add1(1348242437, "", url + "/later", "", ["d"])
+            stderr = sys.stderr
+            sys.stderr = six.StringIO()
+            try:
+                thread.kick(base_dir)
+                t0 = time.time()
+                while thread.dirnames and time.time() < t0 + 5:
+                    time.sleep(0.01)
+                self.assertIn("error in backfill", sys.stderr.getvalue())
+            finally:
+                sys.stderr = stderr
+            self.assertEqual(len(calls), 1)
+            thread.kick(base_dir)
+            t0 = time.time()
+            while base.lookup_file("1348242437").title != "Later" and \
+                  time.time() < t0 + 5:
+                time.sleep(0.01)
+            self.assertEqual(base.lookup_file("1348242437").title, "Later")
+            slasti.tagbase.get_pool().clear()
+            base.close()
+        finally:
+            shutil.rmtree(base_dir)
+            stop_http_server(server)
+
+    def test_linkcheck(self):
+
+        log = []
+        server, url = start_http_server({
+            "/ok": (0, "text/html", b"<html></html>"),
+            "/moved": (0, None, "/ok"),
+            "/slow": (1.0, "text/html", b"<html></html>"),
+        }, log)
+        top_dir = tempfile.mkdtemp()
+        base_dir = os.path.join(top_dir, "base")
+        os.mkdir(base_dir)
+        try:
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            base.add1(1348242431, "ok", url + "/ok", "", ["a"])
+            base.add1(1348242433, "moved", url + "/moved", "", ["a"])
+            base.add1(1348242435, "gone", url + "/gone", "", ["a"])
+            base.add1(1348242437, "slow", url + "/slow", "", ["a"])
+            base.add1(1348242439, "nobody", "http://127.0.0.1:1/", "", ["a"])
+
+            checker = slasti.linkcheck.LinkChecker(timeout=0.5)
+            self.assertEqual(checker.check(base), 5)
+            index = base.links_load()
+            self.assertEqual(index["1348242431"]["status"], 200)
+            self.assertEqual(index["1348242433"]["status"], 200)
+            self.assertEqual(index["1348242433"]["final"], url + "/ok")
+            self.assertEqual(index["1348242435"]["status"], 404)
+            self.assertEqual(index["1348242437"]["error"], "timeout")
+            self.assertEqual(index["1348242439"]["status"], None)
+            broken = sorted(k for (k, e) in index.items()
+                            if slasti.tagbase.link_broken(e))
+            self.assertEqual(broken,
+                             ["1348242435", "1348242437", "1348242439"])
+            # The pass saved the index at its end, without the journal.
+            self.assertFalse(os.path.exists(base_dir + "/links.journal"))
+
+            # What a pass that was killed had found is in the journal,
+            # and is read along with the index, up to a torn last line.
+            entry = dict(index["1348242435"], status=200)
+            base.links_append("1348242435", entry)
+            with open(base_dir + "/links.journal", "a") as f:
+                f.write('["1348242431", {"sta')
+            self.assertEqual(base.links_load()["1348242435"]["status"], 200)
+            self.assertEqual(base.links_load()["1348242431"]["status"], 200)
+            base.links_save(index)
+            self.assertFalse(os.path.exists(base_dir + "/links.journal"))
+            self.assertEqual(base.links_load(), index)
+
+            # The next pass only looks at the broken ones (with the max age
+            # of 0 for them) and at the marks that changed.
+            del log[:]
+            checker = slasti.linkcheck.LinkChecker(timeout=0.5)
+            slasti.linkcheck.LINKCHECK_BROKEN_AGE, save_age = \
+                0, slasti.linkcheck.LINKCHECK_BROKEN_AGE
+            try:
+                base.edit1(1348242431, 0, "ok", url + "/moved", "", ["a"])
+                base.delete(1348242437, 0)
+                self.assertEqual(checker.check(base), 3)
+            finally:
+                slasti.linkcheck.LINKCHECK_BROKEN_AGE = save_age
+            self.assertEqual(sorted(path for (port, path) in log),
+                             ["/gone", "/moved", "/ok"])
+            self.assertNotIn("1348242437", base.links_load())
+            base.close()
+
+            userconf = write_userconf(top_dir, [("auser", base_dir)])
+            wsgi = load_wsgi()
+            status, headers, body = wsgi_call(wsgi.application, userconf,
+                                              'GET', '/auser/broken')
+            self.assertEqual(status, 303)
+            cookie = wsgi_login(wsgi.application, userconf, '/auser')
+            status, headers, body = wsgi_call(wsgi.application, userconf,
+                                              'GET', '/auser/broken', None,
+                                              {'Cookie': cookie})
+            self.assertEqual(status, 200)
+            soup = bs4.BeautifulSoup(body, "lxml")
+            titles = [a.text for a in soup.find_all("a")]
+            self.assertIn("gone", titles)
+            self.assertIn("nobody", titles)
+            self.assertNotIn("ok", titles)
+            self.assertIn("404", body.decode('utf-8'))
+        finally:
+            shutil.rmtree(top_dir)
+            stop_http_server(server)
+
+    def test_stats(self):
+
+        st = slasti.stats.Stats()
+        def worker():
+            for n in range(1000):
+                st.incr("x")
+                st.observe("t", 0.003)
+        threads = [threading.Thread(target=worker) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        snap = st.snapshot()
+        self.assertEqual(snap["counters"]["x"], 4000)
+        self.assertEqual(snap["histograms"]["t"]["count"], 4000)
+        self.assertEqual(snap["histograms"]["t"]["p50"], 0.003)
+        self.assertEqual(snap["histograms"]["t"]["p99"], 0.003)
+        json.dumps(snap)
+
+        top_dir = tempfile.mkdtemp()
+        base_dir = os.path.join(top_dir, "base")
+        os.mkdir(base_dir)
+        try:
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(30):
+                base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                          ["a"])
+            base.close()
+            userconf = write_userconf(top_dir, [("auser", base_dir)])
+            wsgi = load_wsgi()
+
+            slasti.stats.get_stats().reset()
+            for path in ("/auser/", "/auser/", "/auser/a/",
+                         "/auser/mark.1348242431.00", "/auser/nosuch"):
+                wsgi_call(wsgi.application, userconf, 'GET', path)
+            status, headers, body = wsgi_call(wsgi.application, userconf,
+                                              'GET', '/auser/stats.json')
+            self.assertEqual(status, 403)
+
+            cookie = wsgi_login(wsgi.application, userconf, '/auser')
+            status, headers, body = wsgi_call(wsgi.application, userconf,
+                                              'GET', '/auser/stats.json',
+                                              None, {'Cookie': cookie})
+            self.assertEqual(status, 200)
+            snap = json.loads(body.decode('utf-8'))
+            hists = snap["histograms"]
+            self.assertEqual(hists["route.root"]["count"], 2)
+            self.assertEqual(hists["route.tag"]["count"], 1)
+            self.assertEqual(hists["route.mark"]["count"], 1)
+            self.assertEqual(hists["route.other"]["count"], 1)
+            # The 404 and the 403.
+            self.assertEqual(snap["counters"]["errors"], 2)
+            # A page of 25 marks opens every one of them, at least.
+            self.assertGreaterEqual(hists["request.files.open"]["max"], 25)
+            self.assertEqual(hists["request.files.open"]["count"],
+                             snap["counters"]["requests"])
+
+            status, headers, body = wsgi_call(wsgi.application, userconf,
+                                              'GET', '/auser/stats',
+                                              None, {'Cookie': cookie})
+            self.assertEqual(status, 200)
+            self.assertIn(b"route.root", body)
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_profiling(self):
+
+        top_dir = tempfile.mkdtemp()
+        base_dir = os.path.join(top_dir, "base")
+        prof_dir = os.path.join(top_dir, "prof")
+        slowlog = os.path.join(top_dir, "slow.log")
+        os.mkdir(base_dir)
+        os.mkdir(prof_dir)
+        try:
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(30):
+                base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                          ["a"])
+            base.close()
+            userconf = write_userconf(top_dir, [("auser", base_dir)])
+            wsgi = load_wsgi()
+
+            # Nothing configured, nothing written.
+            status, headers, plain = wsgi_call(wsgi.application, userconf,
+                                               'GET', '/auser/')
+            self.assertEqual(os.listdir(prof_dir), [])
+
+            extra = {'slasti.profile.dir': prof_dir,
+                     'slasti.profile': 'on',
+                     'slasti.slowlog': slowlog,
+                     'slasti.slowlog.threshold': '0'}
+            status, headers, body = wsgi_call(wsgi.application, userconf,
+                                              'GET', '/auser/', None, None,
+                                              extra)
+            self.assertEqual(status, 200)
+            self.assertEqual(body, plain)
+            names = os.listdir(prof_dir)
+            self.assertEqual(len(names), 1)
+            self.assertIn(".auser.root.", names[0])
+            stats = pstats.Stats(os.path.join(prof_dir, names[0]))
+            funcs = [f[2] for f in stats.stats.keys()]
+            self.assertIn("page_any_html", funcs)
+
+            # Only the slow log, with a threshold the request cannot meet.
+            extra = {'slasti.slowlog': slowlog,
+                     'slasti.slowlog.threshold': '1000'}
+            wsgi_call(wsgi.application, userconf, 'GET', '/auser/a/',
+                      None, None, extra)
+            with open(slowlog) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(len(records), 1)
+            self.assertEqual(records[0]["route"], "root")
+            self.assertEqual(records[0]["user"], "auser")
+            self.assertEqual(records[0]["profile"],
+                             os.path.join(prof_dir, names[0]))
+            self.assertTrue(isinstance(records[0]["top"], list))
+
+            tally = slasti.profiling.Tally()
+            def leaf():
+                tally.add(sys._getframe())
+            leaf()
+            leaf()
+            self.assertEqual(tally.samples, 2)
+            self.assertTrue(tally.top(1)[0][0].endswith("(leaf)"))
+            self.assertEqual(tally.top(1)[0][1], 2)
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_trace(self):
+
+        top_dir = tempfile.mkdtemp()
+        base_dir = os.path.join(top_dir, "base")
+        os.mkdir(base_dir)
+        try:
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(30):
+                base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                          ["a"])
+            base.close()
+            userconf = write_userconf(top_dir, [("auser", base_dir)])
+            wsgi = load_wsgi()
+            cookie = wsgi_login(wsgi.application, userconf, '/auser')
+
+            slasti.trace.clear()
+            wsgi_call(wsgi.application, userconf, 'GET', '/auser/')
+            self.assertEqual(slasti.trace.chrome_trace()["traceEvents"], [])
+
+            extra = {'slasti.trace': 'on'}
+            try:
+                wsgi_call(wsgi.application, userconf, 'GET', '/auser/',
+                          None, None, extra)
+                status, headers, body = wsgi_call(
+                    wsgi.application, userconf, 'GET', '/auser/trace.json',
+                    None, {'Cookie': cookie}, extra)
+            finally:
+                slasti.trace.enable(False)
+            self.assertEqual(status, 200)
+            events = json.loads(body.decode('utf-8'))["traceEvents"]
+            names = [e["name"] for e in events]
+            self.assertEqual(names[0], "request.root")
+            self.assertGreaterEqual(names.count("tagmark.parse"), 25)
+            self.assertIn("tagbase.first", names)
+            self.assertIn("render.page.html", names)
+            # Everything nests within the request.
+            root = events[0]
+            for e in events[1:]:
+                self.assertGreaterEqual(e["ts"], root["ts"])
+                self.assertLessEqual(e["ts"] + e["dur"],
+                                     root["ts"] + root["dur"] + 1)
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_bench(self):
+
+        corpus = load_bench("corpus")
+        marks = list(corpus.Corpus(200, seed=7))
+        self.assertEqual(marks, list(corpus.Corpus(200, seed=7)))
+        self.assertEqual([m[0] for m in marks], sorted(m[0] for m in marks))
+        counts = {}
+        for m in marks:
+            for t in m[4]:
+                counts[t] = counts.get(t, 0) + 1
+        top = corpus.Corpus(200, seed=7).top_tag()
+        self.assertEqual(max(counts.values()), counts[top])
+
+        run = load_bench("run")
+        work_dir = tempfile.mkdtemp()
+        try:
+            results = run.run([50], 2, work_dir)
+            self.assertEqual(sorted(results["50"].keys()), sorted(run.OPS))
+            # A mark view opens the mark and its neighbours, not the base.
+            self.assertLess(results["50"]["mark"]["files"], 10)
+            self.assertEqual(results["50"]["export"]["files"], 50 + 1)
+            self.assertEqual(run.compare(results, results, 0.25), [])
+            worse = json.loads(json.dumps(results))
+            worse["50"]["tags"]["files"] -= 1
+            self.assertEqual(len(run.compare(results, worse, 0.25)), 1)
+
+            # The base built once is reused, and left as it was built.
+            base = slasti.tagbase.TagBase(
+                os.path.join(work_dir, "corpus-50-s1"))
+            base.open()
+            self.assertEqual(len(list(base)), 50)
+            base.close()
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_load(self):
+
+        run = load_bench("run")
+        load = load_bench("load")
+        work_dir = tempfile.mkdtemp()
+        try:
+            dirname = run.corpus_dir(work_dir, 100, 1)
+            workload = load.Workload(dirname)
+            reqs = list(workload.requests(load.MIX, 5, 1, 50))
+            self.assertEqual(reqs, list(workload.requests(load.MIX, 5, 1, 50)))
+            self.assertNotEqual(reqs,
+                                list(workload.requests(load.MIX, 5, 2, 50)))
+            self.assertEqual(set(kind for (kind, r) in reqs),
+                             set(load.MIX.keys()))
+
+            total = load.load(dirname, processes=1, threads=4, count=10)
+            self.assertEqual(total["requests"], 40)
+            self.assertEqual(total["errors"], 0)
+            total = load.load(dirname, processes=2, threads=2, count=10)
+            self.assertEqual(total["requests"], 40)
+            self.assertEqual(total["errors"], 0)
+            self.assertGreater(total["kinds"]["browse"]["p99"], 0)
+            load.report(total, io.StringIO())
+
+            # The load runs on a copy, the base itself is unchanged.
+            self.assertEqual(len(os.listdir(os.path.join(dirname, "marks"))),
+                             100)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_coldstart(self):
+        # Pages are served without jinja2 until the first one, and without
+        # the fetch and what it needs at all.
+        topdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir)
+        out = subprocess.check_output([sys.executable, "-c",
+            "import sys; sys.path.insert(0, sys.argv[1]); import slasti.wsgi;"
+            " print(' '.join(m for m in sys.argv[2:] if m in sys.modules))",
+            topdir, "jinja2", "http.client", "ssl", "slasti.fetch"])
+        self.assertEqual(out.strip(), b"")
+
+        coldstart = load_bench("coldstart")
+        run = load_bench("run")
+        work_dir = tempfile.mkdtemp()
+        try:
+            dirname = run.corpus_dir(work_dir, 100, 1)
+            results = coldstart.measure(dirname, 1)
+            self.assertLess(results["cold"]["preload"],
+                            results["preload"]["preload"])
+            coldstart.report(results, io.StringIO())
+
+            userconf = run.write_userconf(dirname)
+            pool = slasti.tagbase.get_pool()
+            pool.clear()
+            self.assertEqual(slasti.wsgi.preload(userconf), 1)
+            self.assertIn(os.path.abspath(dirname),
+                          [os.path.abspath(d) for d in pool.bases.keys()])
+            pool.clear()
+        finally:
+            shutil.rmtree(work_dir)
+
     def test_ctx_parse_args(self):
 
         ctx = slasti.Context(
@@ -483,6 +1711,716 @@ class TestUnit(unittest.TestCase):
             self.assertIn(k, a_result)
             self.assertEqual(a_result[k], a_pattern[k])
 
+    def test_page_stream(self):
+
+        base_dir = tempfile.mkdtemp()
+        user_entry = {"name": "testuser", "type": "fs", "root": base_dir}
+        base = slasti.tagbase.TagBase(base_dir)
+        base.open()
+
+        stamp0 = 1524461179
+        nmarks = slasti.main.PAGESZ + 5
+        for n in range(nmarks):
+            base.add1(stamp0 + n, "Title %d" % n, "http://x/%d" % n, "",
+                      ["t%d" % (n % 3)])
+
+        status_ = [None]
+
+        def fake_start_response(status, headers):
+            status_[0] = status
+
+        # The newest mark is on top, so the mark 3 seconds older than it
+        # has 3 marks before it and the back page must stop at the top.
+        top = stamp0 + nmarks - 1
+        ctx = slasti.Context(
+            "", user_entry, base,
+            'GET', 'http', "localhost:8080",
+            u"page.%d.00" % (top - 3,),
+            None, None, None, None)
+        ctx.j2env = Environment(loader=DictLoader(slasti.main.templates))
+        result_ = slasti.main.page_mark_html(
+            fake_start_response, ctx, top - 3, 0)
+
+        self.assertTrue(status_[0].startswith("200 "))
+        self.assertNotIsInstance(result_, list)
+        # Make chunks small enough that our small page takes several.
+        save_chunk = slasti.main.RENDER_CHUNK
+        slasti.main.RENDER_CHUNK = 512
+        try:
+            chunks = list(result_)
+        finally:
+            slasti.main.RENDER_CHUNK = save_chunk
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertTrue(isinstance(chunk, six.binary_type))
+        # The stream can be walked twice with the same result.
+        self.assertEqual(b''.join(result_), b''.join(chunks))
+
+        soup = bs4.BeautifulSoup(b''.join(chunks), "lxml")
+        a_result = dict((a.string, a['href']) for a in soup.select('a'))
+        self.assertEqual(a_result[u'\xab'],
+                         '/testuser/page.%d.00' % (top,))
+        self.assertEqual(a_result[u'\xbb'],
+                         '/testuser/page.%d.00' % (top - 3 -
+                                                   slasti.main.PAGESZ,))
+        n_marks = len([p for p in soup.select('p')
+                       if p.get_text().strip().startswith('20')])
+        self.assertEqual(n_marks, slasti.main.PAGESZ)
+
+        shutil.rmtree(base_dir)
+
+    def test_fragment_cache(self):
+        top_dir = tempfile.mkdtemp()
+        base_dir = os.path.join(top_dir, "base")
+        os.mkdir(base_dir)
+        try:
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(30):
+                base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                          ["a"])
+            userconf = write_userconf(top_dir, [("auser", base_dir)])
+            wsgi = load_wsgi()
+
+            slasti.main.get_fragments().clear()
+            slasti.stats.get_stats().reset()
+            status, headers, first = wsgi_call(wsgi.application, userconf,
+                                               'GET', '/auser/')
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["fragment.miss"], slasti.main.PAGESZ)
+            self.assertNotIn("fragment.hit", counters)
+
+            # The same marks on the tag page link to the same places.
+            status, headers, body = wsgi_call(wsgi.application, userconf,
+                                              'GET', '/auser/')
+            self.assertEqual(body, first)
+            wsgi_call(wsgi.application, userconf, 'GET', '/auser/a/')
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["fragment.miss"], slasti.main.PAGESZ)
+            self.assertEqual(counters["fragment.hit"], 2 * slasti.main.PAGESZ)
+
+            # An edit within the same second as the add keeps the mtime.
+            base.edit1(1348242431 + 29, 0, "edited", "http://x/29", "",
+                       ["a"])
+            status, headers, body = wsgi_call(wsgi.application, userconf,
+                                              'GET', '/auser/')
+            self.assertIn(b"edited", body)
+            self.assertNotIn(b">t29<", body)
+
+            # Logged in, the marks have the edit link.
+            cookie = wsgi_login(wsgi.application, userconf, '/auser')
+            status, headers, body = wsgi_call(wsgi.application, userconf,
+                                              'GET', '/auser/', None,
+                                              {'Cookie': cookie})
+            self.assertIn(b"/auser/edit?mark=1348242460.00", body)
+            self.assertNotIn(b"/auser/edit?mark=1348242460.00", first)
+            base.close()
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_base_pool(self):
+        top_dir = tempfile.mkdtemp()
+        try:
+            dirs = []
+            for n in range(3):
+                base_dir = os.path.join(top_dir, "base%d" % n)
+                os.mkdir(base_dir)
+                base = slasti.tagbase.TagBase(base_dir)
+                base.open()
+                for m in range(5):
+                    base.add1(1348242431 + m, "t%d" % m, "http://x/%d" % m,
+                              "", ["a", "b%d" % m])
+                dirs.append(base_dir)
+
+            slasti.stats.get_stats().reset()
+            pool = slasti.tagbase.BasePool(size=2)
+            base = pool.get(dirs[0])
+            self.assertEqual(base.first().key(), (1348242435, 0))
+            self.assertEqual(base.tagfirst("a").key(), (1348242435, 0))
+            self.assertEqual(base.taglookup("a", 1348242433, 0).succ().key(),
+                             (1348242432, 0))
+            self.assertEqual(base.seek(1348242434, 5).key(), (1348242434, 0))
+            self.assertIsNone(base.lookup(1348242436, 0))
+            self.assertEqual([t.key() for t in base.tagcurs()][:2],
+                             ["a", "b0"])
+            self.assertIs(pool.get(dirs[0]), base)
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["pool.miss"], 1)
+            self.assertEqual(counters["pool.hit"], 1)
+
+            # The index is kept until the base changes, also elsewhere.
+            slasti.stats.get_stats().reset()
+            base.first()
+            base.tagfirst("a")
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertNotIn("files.listdir", counters)
+            other = slasti.tagbase.TagBase(dirs[0])
+            other.add1(1348242440, "new", "http://x/new", "", ["a"])
+            self.assertEqual(base.first().key(), (1348242440, 0))
+            self.assertEqual(base.tagfirst("a").key(), (1348242440, 0))
+
+            # The least recently used base goes first.
+            pool.get(dirs[1])
+            pool.get(dirs[0])
+            pool.get(dirs[2])
+            self.assertEqual(sorted(pool.bases.keys()),
+                             sorted([dirs[0], dirs[2]]))
+
+            # A base over its limit works, but its index is not kept.
+            pool = slasti.tagbase.BasePool(user_memory=1)
+            base = pool.get(dirs[1])
+            base.index_mapped = False
+            self.assertEqual(base.first().key(), (1348242435, 0))
+            self.assertEqual(base.index_size(), 0)
+
+            # Idle bases are dropped.
+            pool = slasti.tagbase.BasePool(idle=-1)
+            pool.get(dirs[0])
+            pool.get(dirs[1])
+            self.assertEqual(list(pool.bases.keys()), [dirs[1]])
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_index_file(self):
+        top_dir = tempfile.mkdtemp()
+        try:
+            base_dir = os.path.join(top_dir, "base")
+            os.mkdir(base_dir)
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(5):
+                base.add1(1348242431, "t%d" % n, "http://x/%d" % n, "",
+                          ["a", u"\u0442\u0435\u0433"] if n % 2 else ["a"])
+
+            slasti.stats.get_stats().reset()
+            index = base.index()
+            self.assertIsInstance(index, slasti.indexfile.IndexFile)
+            self.assertEqual(list(index.marks),
+                             ["1348242431.04", "1348242431.03",
+                              "1348242431.02", "1348242431.01",
+                              "1348242431"])
+            self.assertEqual(index.tagnames(), [u"a", u"\u0442\u0435\u0433"])
+            self.assertEqual(list(index.tag(u"\u0442\u0435\u0433")),
+                             ["1348242431.03", "1348242431.01"])
+            self.assertEqual(len(index.tag("missing")), 0)
+            self.assertEqual([(t.key(), t.num()) for t in base.tagcurs()],
+                             [(u"a", 5), (u"\u0442\u0435\u0433", 2)])
+            self.assertEqual(base.taglookup(u"\u0442\u0435\u0433",
+                                            1348242431, 1).pred().key(),
+                             (1348242431, 3))
+
+            # Another process maps the same file, without building it.
+            other = slasti.tagbase.TagBase(base_dir)
+            self.assertEqual(other.first().key(), (1348242431, 4))
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["indexfile.build"], 1)
+
+            # A write elsewhere goes to the journal, and the file is mapped
+            # with the journal applied, not built again.
+            other.delete(1348242431, 4)
+            self.assertEqual(base.first().key(), (1348242431, 3))
+            self.assertEqual(base.tagfirst("a").key(), (1348242431, 3))
+            self.assertEqual(list(base.index().tag(u"\u0442\u0435\u0433")),
+                             ["1348242431.03", "1348242431.01"])
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["indexfile.build"], 1)
+            self.assertEqual(counters["indexfile.derive"], 1)
+            self.assertEqual(base.index().depth, 1)
+            self.assertEqual(other.index().depth, 1)
+
+            # An index from something else is not trusted.
+            with open(os.path.join(base_dir, "index"), "wb") as f:
+                f.write(b"garbage")
+            other = slasti.tagbase.TagBase(base_dir)
+            self.assertEqual(other.first().key(), (1348242431, 3))
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["indexfile.build"], 2)
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_index_journal(self):
+        top_dir = tempfile.mkdtemp()
+        saved_max = slasti.indexfile.JOURNAL_MAX
+        try:
+            slasti.indexfile.JOURNAL_MAX = 3
+            base_dir = os.path.join(top_dir, "base")
+            os.mkdir(base_dir)
+            writer = slasti.tagbase.TagBase(base_dir)
+            writer.open()
+            for n in range(5):
+                writer.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                            ["a", "b%d" % (n % 2)])
+            self.assertIsInstance(writer.index(),
+                                  slasti.indexfile.IndexFile)
+            reader = slasti.tagbase.TagBase(base_dir)
+            self.assertIsInstance(reader.index(),
+                                  slasti.indexfile.IndexFile)
+
+            slasti.stats.get_stats().reset()
+            journal = os.path.join(base_dir, "index.journal")
+            for n in range(7):
+                if n % 3 == 1:
+                    writer.delete(1348242431 + n, 0)
+                else:
+                    writer.add1(1348242441 + n, "u%d" % n, "http://y/%d" % n,
+                                "", ["b%d" % (n % 2), "c"])
+                # A reader that kept its index, and one that starts anew.
+                for other in (reader, slasti.tagbase.TagBase(base_dir)):
+                    index = other.index()
+                    self.assertEqual(index.stamp, writer.index_stamp())
+                    fresh = slasti.tagbase.Index(writer, index.stamp,
+                                                 writer.index_limit)
+                    self.assertEqual(list(index.marks), list(fresh.marks))
+                    self.assertEqual(index.tagnames(), fresh.tagnames())
+                    for t in fresh.tagnames():
+                        self.assertEqual(list(index.tag(t)),
+                                         list(fresh.tag(t)))
+                if n % 3 == 2:
+                    # Every third record wrote the file anew instead.
+                    self.assertIsInstance(index, slasti.indexfile.IndexFile)
+                    self.assertFalse(os.path.exists(journal))
+                else:
+                    self.assertTrue(os.path.exists(journal))
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["indexfile.derive"], 5)
+            self.assertEqual(counters["indexfile.compact"], 2)
+            self.assertNotIn("indexfile.build", counters)
+
+            # A journal of another file is not applied.
+            with open(journal) as f:
+                lines = f.read().split("\n")
+            with open(journal, "w") as f:
+                f.write("\n".join(['{"stamp": [0, 0, 0, 0, 0]}'] + lines[1:]))
+            other = slasti.tagbase.TagBase(base_dir)
+            self.assertEqual(other.first().key(), (1348242447, 0))
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["indexfile.build"], 1)
+        finally:
+            slasti.indexfile.JOURNAL_MAX = saved_max
+            shutil.rmtree(top_dir)
+
+    def test_overlay_list(self):
+        under = ["%010d" % n for n in range(1000, 0, -10)]
+        plain = list(under)
+        dlist = under
+        olds = []
+        copied = None
+        rnd = random.Random(1)
+        for n in range(slasti.tagbase.OVERLAY_CHANGES + 50):
+            if plain and rnd.random() < 0.4:
+                name = rnd.choice(plain)
+                plain.remove(name)
+                present = False
+            else:
+                name = "%010d" % rnd.randint(0, 1100)
+                if name not in plain:
+                    plain.append(name)
+                    plain.sort(reverse=True)
+                present = True
+            olds.append((dlist, list(dlist)))
+            dlist = slasti.tagbase._cow_names(dlist, name, present)
+            self.assertEqual(len(dlist), len(plain))
+            self.assertEqual(list(dlist), plain)
+            self.assertEqual(dlist[-1], plain[-1])
+            if isinstance(dlist, list) and dlist is not under:
+                copied = True
+            else:
+                self.assertLess(dlist.changes,
+                                slasti.tagbase.OVERLAY_CHANGES)
+        # At the limit, the list was copied with the changes.
+        self.assertTrue(copied)
+        # And none of the lists it was made from changed.
+        for (old, was) in olds:
+            self.assertEqual(list(old), was)
+        self.assertEqual(list(under), ["%010d" % n
+                                       for n in range(1000, 0, -10)])
+
+    def test_index_snapshot(self):
+        top_dir = tempfile.mkdtemp()
+        try:
+            for mapped in (True, False):
+                base_dir = os.path.join(top_dir, "base%d" % mapped)
+                os.mkdir(base_dir)
+                base = slasti.tagbase.TagBase(base_dir)
+                base.index_mapped = mapped
+                base.open()
+                for n in range(5):
+                    base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n,
+                              "", ["a", "b%d" % n])
+                old = base.index()
+                old_marks = list(old.marks)
+                old_a = list(old.tag("a"))
+                old.tagnames()
+
+                # Our own writes make the next index from the last one.
+                slasti.stats.get_stats().reset()
+                base.add1(1348242440, "new", "http://x/new", "", ["a", "c"])
+                base.edit1(1348242431, 0, "t0", "http://x/0", "", ["b0", "d"])
+                base.delete(1348242432, 0)
+                counters = slasti.stats.get_stats().snapshot()["counters"]
+                self.assertEqual(counters["index.derive"], 3)
+                self.assertNotIn("files.listdir", counters)
+                self.assertNotIn("indexfile.build", counters)
+
+                index = base.index()
+                fresh = slasti.tagbase.TagBase(base_dir)
+                fresh.index_mapped = False
+                self.assertEqual(list(index.marks), list(fresh.index().marks))
+                self.assertEqual(index.tagnames(), fresh.index().tagnames())
+                for t in index.tagnames():
+                    self.assertEqual(list(index.tag(t)),
+                                     list(fresh.index().tag(t)))
+                self.assertEqual(len(index.tag("b1")), 0)
+                # Whoever still holds the old index sees it as it was.
+                self.assertEqual(list(old.marks), old_marks)
+                self.assertEqual(list(old.tag("a")), old_a)
+
+                # A reader does not wait while the index is being made.
+                other = slasti.tagbase.TagBase(base_dir)
+                other.add1(1348242450, "other", "http://x/o", "", ["a"])
+                base.index_lock.acquire()
+                try:
+                    self.assertEqual(base.first().key(), (1348242440, 0))
+                finally:
+                    base.index_lock.release()
+                counters = slasti.stats.get_stats().snapshot()["counters"]
+                self.assertEqual(counters["index.stale"], 1)
+                self.assertEqual(base.first().key(), (1348242450, 0))
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_watch(self):
+        if slasti.watch.get_watcher() is None:
+            self.skipTest("no inotify")
+        top_dir = tempfile.mkdtemp()
+        try:
+            base_dir = os.path.join(top_dir, "base")
+            os.mkdir(base_dir)
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(3):
+                base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                          ["a"])
+            self.assertTrue(base.watch())
+            self.assertEqual(base.first().key(), (1348242433, 0))
+
+            stamps = []
+            index_stamp = base.index_stamp
+            def counting_stamp():
+                stamps.append(1)
+                return index_stamp()
+            base.index_stamp = counting_stamp
+            def wait_dirty():
+                t0 = time.time()
+                while not base._index_dirty and time.time() < t0 + 5:
+                    time.sleep(0.01)
+
+            # Nothing changed, so nothing is looked at.
+            base.first()
+            base.tagfirst("a")
+            self.assertEqual(stamps, [])
+
+            # A mark copied in by hand is noticed.
+            shutil.copy(os.path.join(base_dir, "marks", "1348242433"),
+                        os.path.join(base_dir, "marks", "1348242499"))
+            wait_dirty()
+            self.assertEqual(base.first().key(), (1348242433, 0))
+            self.assertEqual(base.first().name(), "1348242499")
+            # Once, and again with the generation locked, since no writer
+            # published the index of it.
+            self.assertEqual(len(stamps), 2)
+
+            # So is a tag edited in place, which keeps the stamp.
+            self.assertEqual(base.tagfirst("a").name(), "1348242433")
+            with open(os.path.join(base_dir, "tags",
+                                   slasti.tagbase.fs_encode("a")), "w") as f:
+                f.write("1348242431 1348242432")
+            t0 = time.time()
+            while base.tagfirst("a").name() != "1348242432" and \
+                  time.time() < t0 + 5:
+                time.sleep(0.01)
+            self.assertEqual(base.tagfirst("a").name(), "1348242432")
+
+            # Our own writes are not edits by hand, so the index made
+            # from the last one stays, and the file is not built again.
+            slasti.stats.get_stats().reset()
+            index = base.index()
+            base.add1(1348242440, "new", "http://x/new", "", ["a", "b"])
+            t0 = time.time()
+            while base._index_own and time.time() < t0 + 5:
+                time.sleep(0.01)
+            self.assertEqual(base._index_own, {})
+            self.assertIsNot(base.index(), index)
+            self.assertEqual(base.tagfirst("b").name(), "1348242440")
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["index.derive"], 1)
+            self.assertNotIn("indexfile.build", counters)
+
+            # A pool that did not watch when it opened a base, like the
+            # master of slasti.serve, watches it when it may again.
+            pool = slasti.tagbase.BasePool(watch=False)
+            self.assertIsNone(pool.get(base_dir)._watch)
+            pool.watch = True
+            self.assertIsNotNone(pool.get(base_dir)._watch)
+            pool.clear()
+
+            # The master of slasti.serve warms up without the watcher.
+            topdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  os.pardir)
+            userconf = write_userconf(top_dir, [("auser", base_dir)])
+            out = subprocess.check_output([sys.executable, "-c",
+                "import sys, threading; sys.path.insert(0, sys.argv[1]);"
+                " import slasti.serve, slasti.wsgi;"
+                " slasti.serve.warm(slasti.wsgi.application,"
+                " {'slasti.userconf': sys.argv[2]});"
+                " print(' '.join(t.name for t in threading.enumerate()))",
+                topdir, userconf])
+            self.assertNotIn(b"slasti-watch", out)
+
+            # Without a watch, the stamp is checked every time.
+            base.unwatch()
+            del stamps[:]
+            base.first()
+            base.first()
+            self.assertEqual(len(stamps), 2)
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_watch_fallback(self):
+        top_dir = tempfile.mkdtemp()
+        interval = slasti.tagbase.TAGS_SCAN_INTERVAL
+        slasti.tagbase.TAGS_SCAN_INTERVAL = 0
+        try:
+            base_dir = os.path.join(top_dir, "base")
+            os.mkdir(base_dir)
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(3):
+                base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                          ["a"])
+            self.assertIsNone(base._watch)
+            self.assertEqual(base.tagfirst("a").name(), "1348242433")
+
+            # Our own writes do not make the index anew.
+            slasti.stats.get_stats().reset()
+            base.add1(1348242440, "new", "http://x/new", "", ["a", "b"])
+            self.assertEqual(base.tagfirst("b").name(), "1348242440")
+            self.assertEqual(base.tagfirst("a").name(), "1348242440")
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertNotIn("indexfile.build", counters)
+
+            # A tag edited in place keeps the stamp, but is noticed.
+            time.sleep(0.05)
+            stamp = base.index_stamp()
+            with open(os.path.join(base_dir, "tags",
+                                   slasti.tagbase.fs_encode("a")), "w") as f:
+                f.write("1348242431 1348242432")
+            self.assertEqual(base.index_stamp(), stamp)
+            self.assertEqual(base.tagfirst("a").name(), "1348242432")
+            counters = slasti.stats.get_stats().snapshot()["counters"]
+            self.assertEqual(counters["indexfile.build"], 1)
+        finally:
+            slasti.tagbase.TAGS_SCAN_INTERVAL = interval
+            shutil.rmtree(top_dir)
+
+    def test_mark_record(self):
+        top_dir = tempfile.mkdtemp()
+        try:
+            base_dir = os.path.join(top_dir, "base")
+            os.mkdir(base_dir)
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            base.add1(1348242431, "one", "http://one", "n1", ["a", "b"])
+            base.add1(1348242431, "two", "http://two", "", ["a"])
+            shutil.copy(os.path.join(base_dir, "marks", "1348242431"),
+                        os.path.join(base_dir, "marks", "junk"))
+
+            records = list(base)
+            self.assertEqual([r.name() for r in records],
+                             ["junk", "1348242431.01", "1348242431"])
+            for r in records:
+                self.assertIsInstance(r, slasti.tagbase.MarkRecord)
+                self.assertFalse(hasattr(r, "__dict__"))
+            self.assertEqual(records[1].namekey, 134824243101)
+            self.assertEqual(records[2].tags, ("a", "b"))
+
+            # Same as the marks of the pages, but for the tags being a tuple.
+            for r in records[1:]:
+                mark = base.lookup(*r.key())
+                self.assertEqual(r.name(), mark.name())
+                self.assertEqual((r.mtime, r.title, r.url, r.note),
+                                 (mark.mtime, mark.title, mark.url,
+                                  mark.note))
+                self.assertEqual(list(r.tags), mark.tags)
+                self.assertEqual(r.xml(stamped=True),
+                                 mark.xml(stamped=True))
+
+            # A mark claimed in the same second is never seen empty.
+            empty = []
+            done = threading.Event()
+            def reader():
+                while not done.is_set():
+                    for name in os.listdir(base.markdir):
+                        r = slasti.tagbase.MarkRecord(base.markdir, name)
+                        if r.stamp0 == 0:
+                            empty.append(name)
+            thread = threading.Thread(target=reader)
+            thread.start()
+            try:
+                for n in range(50):
+                    self.assertEqual(base.add1(1348242500, "x", "http://x",
+                                               "", ["c"]), n)
+            finally:
+                done.set()
+                thread.join()
+            self.assertEqual(empty, [])
+            self.assertEqual([name for name in os.listdir(base_dir)
+                              if name.endswith(".tmp")], [])
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_render(self):
+        top_dir = tempfile.mkdtemp()
+        base_dir = os.path.join(top_dir, "base")
+        out_dir = os.path.join(top_dir, "out")
+        os.mkdir(base_dir)
+        try:
+            base = slasti.tagbase.TagBase(base_dir)
+            base.open()
+            for n in range(30):
+                base.add1(1348242431 + n, "t%d" % n, "http://x/%d" % n, "",
+                          ["a", "b%d" % (n % 2)])
+            userconf = write_userconf(top_dir, [("auser", base_dir)])
+            wsgi = load_wsgi()
+
+            r = slasti.render.Renderer(base, "auser", out_dir)
+            # 30 marks, 2 pages and the front, the same for a, one page
+            # and the first for each b, and the tags.
+            self.assertEqual(r.run(), 30 + 3 + 3 + 2 + 2 + 1)
+            user_dir = os.path.join(out_dir, "auser")
+            for (path, fname) in (
+                    ("/auser/", "index.html"),
+                    ("/auser/page.1348242435.00", "page.1348242435.00"),
+                    ("/auser/mark.1348242440.00", "mark.1348242440.00"),
+                    ("/auser/a/", "a/index.html"),
+                    ("/auser/b1/page.1348242460.00", "b1/page.1348242460.00"),
+                    ("/auser/tags", "tags")):
+                status, headers, body = wsgi_call(wsgi.application, userconf,
+                                                  'GET', path)
+                self.assertEqual(status, 200)
+                with open(os.path.join(user_dir, fname), "rb") as f:
+                    self.assertEqual(f.read(), body)
+
+            # Nothing changed, nothing is written.
+            r = slasti.render.Renderer(base, "auser", out_dir)
+            self.assertEqual(r.run(), 0)
+
+            # Only the pages that show the mark are written, and the pages
+            # of b0 and b1, because it moved from one to the other.
+            base.edit1(1348242432, 0, "edited", "http://x/1", "",
+                       ["a", "b1"])
+            r = slasti.render.Renderer(base, "auser", out_dir)
+            written = r.run()
+            with open(os.path.join(user_dir, "page.1348242435.00")) as f:
+                self.assertIn("edited", f.read())
+            self.assertLess(written, 15)
+            self.assertEqual(r.removed, 0)
+
+            # A tag that is gone takes its pages along.
+            base.edit1(1348242432, 0, "edited", "http://x/1", "",
+                       ["a", "b1", "c"])
+            slasti.render.Renderer(base, "auser", out_dir).run()
+            self.assertTrue(os.path.exists(os.path.join(user_dir, "c")))
+            base.edit1(1348242432, 0, "edited", "http://x/1", "",
+                       ["a", "b1"])
+            r = slasti.render.Renderer(base, "auser", out_dir)
+            r.run()
+            self.assertEqual(r.removed, 2)
+            self.assertFalse(os.path.exists(os.path.join(user_dir, "c")))
+
+            # A hostile tag is left to the application, and a manifest
+            # naming files elsewhere does not get them removed.
+            base.edit1(1348242432, 0, "edited", "http://x/1", "",
+                       ["a", "b1", "x/../../escaped", ".."])
+            victim = os.path.join(top_dir, "victim")
+            with open(victim, "w") as f:
+                f.write("mine")
+            with open(os.path.join(user_dir, ".manifest")) as f:
+                manifest = json.load(f)
+            manifest["../../victim"] = "0"
+            with open(os.path.join(user_dir, ".manifest"), "w") as f:
+                json.dump(manifest, f)
+            slasti.render.Renderer(base, "auser", out_dir).run()
+            self.assertEqual(sorted(os.listdir(out_dir)), ["auser"])
+            self.assertEqual(sorted(os.listdir(top_dir)),
+                             ["base", "out", "slasti-users.conf", "victim"])
+            self.assertFalse(os.path.exists(os.path.join(user_dir, "x")))
+            self.assertTrue(os.path.exists(victim))
+            base.close()
+        finally:
+            shutil.rmtree(top_dir)
+
+    def test_json_pages(self):
+
+        base_dir = tempfile.mkdtemp()
+        user_entry = {"name": "testuser", "type": "fs", "root": base_dir}
+        base = slasti.tagbase.TagBase(base_dir)
+        base.open()
+
+        stamp0 = 1524461179
+        nmarks = slasti.main.PAGESZ + 5
+        for n in range(nmarks):
+            base.add1(stamp0 + n, "Title %d" % n, "http://x/%d" % n, "",
+                      ["all", "t%d" % (n % 2)])
+
+        status_ = [None]
+
+        def fake_start_response(status, headers):
+            status_[0] = status
+
+        def get(path, query=None):
+            ctx = slasti.Context("", user_entry, base, 'GET', 'http',
+                                 "localhost:8080", path,
+                                 query, None, None, None)
+            result_ = slasti.main.app(fake_start_response, ctx)
+            self.assertTrue(status_[0].startswith("200 "))
+            return json.loads(b''.join(result_).decode('utf-8'))
+
+        page1 = get("page.json")
+        keys1 = [m['key'] for m in page1['marks']]
+        self.assertEqual(len(keys1), slasti.main.PAGESZ)
+        self.assertEqual(keys1[0], "%d.00" % (stamp0 + nmarks - 1))
+        self.assertIsNotNone(page1['next'])
+
+        # Deleting the mark under the cursor does not throw the paging off.
+        last0 = int(keys1[-1].split('.')[0])
+        base.delete(last0, 0)
+        page2 = get("page.json", "cursor=" + page1['next'])
+        keys2 = [m['key'] for m in page2['marks']]
+        self.assertEqual(keys2, ["%d.00" % (stamp0 + n)
+                                 for n in range(nmarks - 26, -1, -1)])
+        self.assertIsNone(page2['next'])
+
+        tpage = get("t1/page.json")
+        self.assertEqual(tpage['tag'], "t1")
+        for m in tpage['marks']:
+            self.assertIn("t1", [t['name_tag'] for t in m['tags']])
+        self.assertIsNone(tpage['next'])
+
+        mark = get("mark.%d.00.json" % (stamp0 + 1))
+        self.assertEqual(mark['mark']['title'], "Title 1")
+        self.assertEqual(mark['href_next'],
+                         "/testuser/mark.%d.00.json" % (stamp0,))
+        self.assertNotIn('_main_path', mark['mark'])
+
+        ctx = slasti.Context("", user_entry, base, 'GET', 'http',
+                             "localhost:8080", "page.json",
+                             "cursor=garbage", None, None, None)
+        self.assertRaises(slasti.App400Error, slasti.main.app,
+                          fake_start_response, ctx)
+
+        shutil.rmtree(base_dir)
+
     def test_head_conditional(self):
 
         stamp0 = 1524461179